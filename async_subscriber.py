@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Asyncio MQTT Recorder
+
+Records exactly like subscriber.py, but drives every broker connection from
+one asyncio event loop through paho's socket callbacks (loop_read and
+loop_write on socket readiness) instead of a network thread per client.
+Batches are written by a single writer task that runs the blocking file I/O
+in a worker thread, so the loop keeps reading while data goes to disk, and
+blocking TCP connects and reconnects run in other worker threads. When
+the disk falls behind, reading from the sockets pauses until the backlog
+drains, which pushes back on the brokers instead of growing memory.
+
+Run it like the subscriber:
+    python async_subscriber.py
+
+or embed it in an asyncio application or test harness:
+    recorder = AsyncMQTTSubscriber("config.yml", handle_signals=False)
+    task = asyncio.create_task(recorder.run())
+    ...
+    recorder.stop()
+    await task
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import signal
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+from subscriber import MQTTSubscriber, record_size
+
+
+# Longest time to wait for DISCONNECT packets to go out on shutdown
+DISCONNECT_TIMEOUT = 1.0
+
+
+class AsyncMQTTSubscriber(MQTTSubscriber):
+    """MQTT recorder running all broker connections and writes on one event loop."""
+    
+    # Batches go through the async pipeline instead of a writer thread
+    supports_writer_thread = False
+    
+    def __init__(self, config_file: str = "config.yml", topics: Optional[List[str]] = None,
+                 storage_file: Optional[str] = None, handle_signals: bool = True):
+        """Initialize the recorder; handle_signals=False leaves signals to the embedding application."""
+        self.handle_signals = handle_signals
+        super().__init__(config_file, topics=topics, storage_file=storage_file)
+        
+        self.max_pending_batches = max(1, self.config["storage"].get("pending_batches", 4))
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.batches: "Optional[asyncio.Queue[Optional[Tuple[List[Dict[str, Any]], int]]]]" = None
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._loop_thread: Optional[int] = None
+        self._stop_requested = asyncio.Event()
+        
+        # Open sockets by source ID, to pause and resume reading
+        self.sockets: Dict[Optional[str], Tuple[mqtt.Client, Any]] = {}
+        self._reading_paused = False
+        self.pause_count = 0
+    
+    def _install_signal_handlers(self):
+        """Signals are handled by the event loop once run() starts."""
+    
+    def _signal_handler(self, signum, frame):
+        """Stop gracefully; runs as an event loop callback, not in a raw signal handler."""
+        logging.info(f"Received signal {signum}, shutting down gracefully...")
+        self.stop()
+    
+    def _dump_signal_handler(self, signum, frame):
+        """Dump the flight recorder ring; runs as an event loop callback."""
+        self.flight_recorder.trigger(f"signal {signum}")
+    
+    def _attach(self, client: mqtt.Client):
+        """Route a client's socket events through the event loop."""
+        client.on_socket_open = self._on_loop(self._on_socket_open)
+        client.on_socket_close = self._on_loop(self._on_socket_close, closing=True)
+        client.on_socket_register_write = self._on_loop(self._on_socket_register_write)
+        client.on_socket_unregister_write = self._on_loop(self._on_socket_unregister_write, closing=True)
+    
+    def _on_loop(self, callback: Callable[[mqtt.Client, Any, Any], None],
+                 closing: bool = False) -> Callable[[mqtt.Client, Any, Any], None]:
+        """Wrap a socket callback so it always runs on the event loop.
+        
+        Connects and reconnects run in worker threads, which is where paho
+        then calls the socket callbacks. Those are handed to the loop; the
+        ones that may see the socket closed before they run get its file
+        descriptor instead.
+        """
+        def call(client, userdata, sock):
+            if threading.get_ident() == self._loop_thread:
+                callback(client, userdata, sock)
+            else:
+                self.loop.call_soon_threadsafe(callback, client, userdata, sock.fileno() if closing else sock)
+        return call
+    
+    def _on_socket_open(self, client, userdata, sock):
+        """Start reading a newly connected socket."""
+        if client.socket() is not sock:
+            # Closed again before the loop got to it
+            return
+        self.sockets[userdata] = (client, sock)
+        if not self._reading_paused:
+            self.loop.add_reader(sock, self._read, client)
+    
+    def _on_socket_close(self, client, userdata, sock):
+        """Stop watching a closed socket."""
+        self.sockets.pop(userdata, None)
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+    
+    def _on_socket_register_write(self, client, userdata, sock):
+        """Write queued packets once the socket is writable."""
+        if client.socket() is sock:
+            self.loop.add_writer(sock, client.loop_write)
+    
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        """Nothing left to write on this socket."""
+        self.loop.remove_writer(sock)
+    
+    def _read(self, client: mqtt.Client):
+        """Read incoming packets when the socket is readable."""
+        client.loop_read()
+        
+        # TLS may hold decrypted data that the selector cannot see
+        sock = client.socket()
+        while sock is not None and hasattr(sock, "pending") and sock.pending():
+            client.loop_read()
+            sock = client.socket()
+    
+    def _pause_reading(self):
+        """Stop reading from the brokers while the writer catches up."""
+        self._reading_paused = True
+        self.pause_count += 1
+        for _, sock in self.sockets.values():
+            self.loop.remove_reader(sock)
+        logging.debug(f"Writer is {self.batches.qsize()} batches behind, pausing reads")
+    
+    def _resume_reading(self):
+        """Resume reading from the brokers."""
+        self._reading_paused = False
+        for client, sock in self.sockets.values():
+            self.loop.add_reader(sock, self._read, client)
+        logging.debug("Writer caught up, resuming reads")
+    
+    def _enqueue(self, data: Dict[str, Any]):
+        """Buffer a received message and hand full batches to the writer task."""
+        if self.flight_recorder:
+            self.flight_recorder.add(data)
+            return
+        
+        self.buffer.append(data)
+        self.flush_controller.add(record_size(data))
+        
+        # Submit the batch when it reaches the count, size or age limit
+        if self.flush_controller.should_flush():
+            self._submit_buffer()
+    
+    def _submit_buffer(self):
+        """Hand the buffered messages to the writer task as one batch."""
+        if not self.buffer:
+            return
+        
+        self.batches.put_nowait((self.buffer, self.flush_controller.take()))
+        self.buffer = []
+        if not self._reading_paused and self.batches.qsize() >= self.max_pending_batches:
+            self._pause_reading()
+    
+    async def _write_loop(self):
+        """Write batches in order, running the file I/O in a worker thread."""
+        while True:
+            item = await self.batches.get()
+            if item is None:
+                return
+            
+            batch, count = item
+            write_start = time.monotonic()
+            await self.loop.run_in_executor(self.executor, self._write_messages, batch)
+            self.flush_controller.record_flush(time.monotonic() - write_start, count)
+            
+            if self._reading_paused and self.batches.qsize() < self.max_pending_batches:
+                self._resume_reading()
+    
+    async def _age_flush_task(self):
+        """Submit the buffer when messages sit in it longer than the max age."""
+        interval = max(0.01, self.flush_controller.max_age / 4)
+        while True:
+            await asyncio.sleep(interval)
+            if self.flush_controller.should_flush():
+                self._submit_buffer()
+    
+    async def _client_task(self, source_id: Optional[str], client: mqtt.Client):
+        """Run a client's keepalive housekeeping and reconnect after connection loss."""
+        source = f" {source_id}" if source_id is not None else ""
+        while True:
+            await asyncio.sleep(1)
+            if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    logging.info(f"Reconnecting to MQTT broker{source}...")
+                    # A blocking TCP connect, which must not stall the other sources
+                    await self.loop.run_in_executor(None, client.reconnect)
+                except OSError as e:
+                    logging.error(f"Reconnect{source} failed: {e}")
+    
+    async def run(self):
+        """Connect to all brokers and record until stop() is called."""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.batches = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="recording-io")
+        if self.handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self.loop.add_signal_handler(signum, self._signal_handler, signum, None)
+            if self.flight_recorder:
+                self.loop.add_signal_handler(signal.SIGUSR1, self._dump_signal_handler, signal.SIGUSR1, None)
+        
+        if self.metrics:
+            self.metrics.gauge("pending_batches", "Batches waiting for the writer task.", self.batches.qsize)
+            self.metrics.gauge("reads_paused", "1 while socket reads wait for the writer.",
+                               lambda: int(self._reading_paused))
+        if self.metrics_exporter:
+            self.metrics_exporter.start()
+        
+        logging.info("Starting asyncio MQTT subscriber...")
+        if self.flight_recorder:
+            self.flight_recorder.start_control_socket()
+        else:
+            logging.info(f"Messages will be saved to: {self.storage_file}")
+        writer = asyncio.create_task(self._write_loop())
+        tasks = [asyncio.create_task(self._age_flush_task())]
+        try:
+            for source_id, client in self.clients.items():
+                self._attach(client)
+                await self.loop.run_in_executor(
+                    None, client.connect, self.sources[source_id]["broker"], self.sources[source_id]["port"], 60
+                )
+                tasks.append(asyncio.create_task(self._client_task(source_id, client)))
+            
+            await self._stop_requested.wait()
+        finally:
+            await self._shutdown(writer, tasks)
+    
+    async def _shutdown(self, writer: "asyncio.Task[None]", tasks: List["asyncio.Task[None]"]):
+        """Disconnect, write everything still buffered and close the recording."""
+        logging.info("Stopping asyncio MQTT subscriber...")
+        self._stopping.set()
+        for task in tasks:
+            task.cancel()
+        
+        # Let the DISCONNECT packets go out before the loop stops serving sockets
+        for client in self.clients.values():
+            client.disconnect()
+        deadline = time.monotonic() + DISCONNECT_TIMEOUT
+        while self.sockets and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        
+        self._submit_buffer()
+        self.batches.put_nowait(None)
+        await writer
+        if self.flight_recorder:
+            await self.loop.run_in_executor(
+                self.executor, self.flight_recorder.close, self.flight_config.get("dump_on_exit", False)
+            )
+        
+        try:
+            await self.loop.run_in_executor(self.executor, self.recording.close)
+            if self.journal:
+                self.journal.close()
+        except Exception as e:
+            logging.error(f"Error closing recording file: {e}")
+        self.executor.shutdown()
+        self._catalog_recording(self.storage_file, self.recording)
+        if self.metrics_exporter:
+            self.metrics_exporter.close()
+        
+        if self.handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1):
+                self.loop.remove_signal_handler(signum)
+        
+        logging.info(f"Total messages received: {self.message_count}")
+        if self.sampler:
+            self.sampler.log_stats()
+        self._log_persist_latency()
+        if self.pause_count:
+            logging.info(f"Reads were paused {self.pause_count} times waiting for the writer")
+        logging.info("Subscriber stopped")
+    
+    def stop(self):
+        """Ask run() to finish; safe to call from the event loop thread only."""
+        self._stop_requested.set()
+
+
+def main():
+    """Main function to run the asyncio MQTT subscriber."""
+    try:
+        asyncio.run(AsyncMQTTSubscriber().run())
+    except Exception as e:
+        logging.error(f"Unexpected error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
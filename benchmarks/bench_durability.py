@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Durability Policy Benchmark
+
+Measures recording throughput and per-batch write latency for each
+storage.durability mode by writing synthetic messages through RecordingFile.
+
+Usage:
+    python benchmarks/bench_durability.py --messages 200000 --batch 1000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import DurabilityPolicy, RecordingFile, remove_recording
+
+
+POLICIES = [
+    ("never", DurabilityPolicy("never")),
+    ("messages=1000", DurabilityPolicy("messages", every_messages=1000)),
+    ("messages=10000", DurabilityPolicy("messages", every_messages=10000)),
+    ("interval=10ms", DurabilityPolicy("interval", every_ms=10)),
+    ("interval=100ms", DurabilityPolicy("interval", every_ms=100)),
+    ("on_rotate", DurabilityPolicy("on_rotate")),
+]
+
+
+def make_batch(start: int, size: int) -> List[Dict[str, Any]]:
+    """Generate a batch of sample sensor messages."""
+    return [
+        {"topic": f"site/line/cell/device{i % 50}/metric", "payload": f"{20 + (i % 100) / 10:.1f}",
+         "timestamp_ns": 1699123456_000_000_000 + i * 1_000_000}
+        for i in range(start, start + size)
+    ]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Return the given percentile of a list of values."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def run(name: str, policy: DurabilityPolicy, total: int, batch_size: int, directory: str):
+    """Write the synthetic recording with one policy and print the results."""
+    path = os.path.join(directory, f"bench_{name.replace('=', '_')}.json")
+    recording = RecordingFile(path, policy)
+    batches = [make_batch(i, batch_size) for i in range(0, total, batch_size)]
+    latencies = []
+    
+    start = time.perf_counter()
+    for batch in batches:
+        batch_start = time.perf_counter()
+        recording.write(batch)
+        latencies.append((time.perf_counter() - batch_start) * 1000)
+    recording.close()
+    elapsed = time.perf_counter() - start
+    
+    print(
+        f"{name:<16} {total / elapsed:>12,.0f} msg/s  "
+        f"p50 {percentile(latencies, 50):7.3f} ms  "
+        f"p99 {percentile(latencies, 99):7.3f} ms  "
+        f"max {max(latencies):7.3f} ms  "
+        f"fsyncs {recording.sync_count}"
+    )
+    remove_recording(path)
+
+
+def main():
+    """Run the benchmark for every durability policy."""
+    parser = argparse.ArgumentParser(description="Benchmark recording durability policies")
+    parser.add_argument("--messages", type=int, default=200000, help="Messages to write per policy")
+    parser.add_argument("--batch", type=int, default=1000, help="Messages per write batch")
+    parser.add_argument("--dir", type=str, default=None, help="Directory to write into (default: temp dir)")
+    args = parser.parse_args()
+    
+    directory = args.dir or tempfile.mkdtemp(prefix="mqtt_bench_")
+    print(f"Writing {args.messages:,} messages in batches of {args.batch} to {directory}")
+    for name, policy in POLICIES:
+        run(name, policy, args.messages, args.batch, directory)
+    
+    if not args.dir:
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Recording Format Benchmark
+
+Generates the same synthetic recording in JSON Lines and binary format, with
+and without numeric payload encoding, and compares file size and parse
+throughput of read_messages for each.
+
+Usage:
+    python benchmarks/bench_formats.py --messages 10000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Any, Iterator, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import BinaryCodec, JsonLinesCodec, RecordingFile, read_messages, remove_recording
+from serialization import JSON_BACKEND
+
+
+BATCH_SIZE = 10000
+START_NS = 1699123456_000_000_000
+
+
+def generate_batches(total: int) -> Iterator[List[Dict[str, Any]]]:
+    """Yield batches of sample sensor messages shaped like the recorder's, with realistic topics and payloads."""
+    timestamp_ns = START_NS
+    for start in range(0, total, BATCH_SIZE):
+        batch = []
+        for i in range(start, min(total, start + BATCH_SIZE)):
+            timestamp_ns += 500_000
+            batch.append({
+                "topic": f"site{i % 3}/line{i % 7}/cell{i % 11}/device{i % 50}/temperature",
+                "payload": f"{20 + (i % 1000) / 100:.2f}".encode('utf-8'),
+                "timestamp_ns": timestamp_ns,
+                "qos": i % 2,
+                "retain": False,
+                "dup": False,
+            })
+        yield batch
+
+
+def write_recording(path: str, codec, total: int):
+    """Write the synthetic recording with the given codec."""
+    recording = RecordingFile(path, codec=codec)
+    for batch in generate_batches(total):
+        recording.write(batch)
+    recording.close()
+
+
+def measure_parse(path: str) -> float:
+    """Return the time in seconds to parse every message in a recording."""
+    start = time.perf_counter()
+    count = 0
+    for _ in read_messages(path):
+        count += 1
+    return time.perf_counter() - start
+
+
+def main():
+    """Run the format comparison."""
+    parser = argparse.ArgumentParser(description="Compare JSON Lines and binary recording formats")
+    parser.add_argument("--messages", type=int, default=10_000_000, help="Messages in the generated recording")
+    parser.add_argument("--dir", type=str, default=None, help="Directory to write into (default: temp dir)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated recordings")
+    args = parser.parse_args()
+    
+    directory = args.dir or tempfile.mkdtemp(prefix="mqtt_bench_")
+    formats = [
+        ("json (text)", JsonLinesCodec("text"), "bench.json"),
+        ("json (base64)", JsonLinesCodec("base64"), "bench_b64.json"),
+        ("binary", BinaryCodec(START_NS), "bench.mqr"),
+        ("binary numeric", BinaryCodec(START_NS, numeric=True), "bench_numeric.mqr"),
+    ]
+    
+    print(f"Generating {args.messages:,} messages in {directory}, JSON backend: {JSON_BACKEND}")
+    for name, codec, filename in formats:
+        path = os.path.join(directory, filename)
+        write_recording(path, codec, args.messages)
+        size = os.path.getsize(path)
+        elapsed = measure_parse(path)
+        print(
+            f"{name:<15} size {size / 1e6:10.1f} MB  ({size / args.messages:6.1f} B/msg)  "
+            f"parse {args.messages / elapsed:>12,.0f} msg/s  {size / elapsed / 1e6:8.1f} MB/s"
+        )
+        if not args.keep:
+            remove_recording(path)
+    
+    if not args.dir and not args.keep:
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Write-Ahead Journal Benchmark
+
+Measures the cost the journal adds per message: appending every message
+and checkpointing after each batch, as the subscriber does, with and
+without writing the batches to a recording file.
+
+Usage:
+    python benchmarks/bench_journal.py --messages 500000 --batch 1000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import BinaryCodec, Journal, RecordingFile, remove_recording
+
+
+START_NS = 1699123456_000_000_000
+
+
+def make_messages(total: int) -> List[Dict[str, Any]]:
+    """Generate sample sensor messages as the subscriber receives them."""
+    return [
+        {"topic": f"site/line/cell/device{i % 50}/metric", "payload": f"{20 + (i % 100) / 10:.1f}".encode('utf-8'),
+         "timestamp_ns": START_NS + i * 1_000_000, "qos": 0, "retain": False, "dup": False}
+        for i in range(total)
+    ]
+
+
+def run(name: str, messages: List[Dict[str, Any]], batch_size: int, directory: str,
+        journal: bool, record: bool):
+    """Feed the messages through the journal and/or a recording and print the rate."""
+    recording_path = os.path.join(directory, "bench.mqr")
+    recording = RecordingFile(recording_path, codec=BinaryCodec(START_NS)) if record else None
+    journal_file = Journal(recording_path + ".journal", {"recording": "bench.mqr"}) if journal else None
+    
+    start = time.perf_counter()
+    for offset in range(0, len(messages), batch_size):
+        batch = messages[offset:offset + batch_size]
+        if journal_file:
+            for message in batch:
+                message["journal_seq"] = journal_file.append(message)
+        if recording:
+            recording.write(batch)
+        if journal_file:
+            journal_file.checkpoint(batch[-1]["journal_seq"])
+    elapsed = time.perf_counter() - start
+    
+    if recording:
+        recording.close()
+        remove_recording(recording_path)
+    if journal_file:
+        journal_file.close()
+    
+    print(f"{name:<20} {len(messages) / elapsed:>12,.0f} msg/s  {elapsed * 1e6 / len(messages):6.2f} us/msg")
+
+
+def main():
+    """Run the benchmark with and without the journal."""
+    parser = argparse.ArgumentParser(description="Benchmark the write-ahead journal")
+    parser.add_argument("--messages", type=int, default=500000, help="Messages to write per run")
+    parser.add_argument("--batch", type=int, default=1000, help="Messages per checkpointed batch")
+    parser.add_argument("--dir", type=str, default=None, help="Directory to write into (default: temp dir)")
+    args = parser.parse_args()
+    
+    directory = args.dir or tempfile.mkdtemp(prefix="mqtt_bench_")
+    messages = make_messages(args.messages)
+    print(f"Writing {args.messages:,} messages in batches of {args.batch} to {directory}")
+    run("journal only", messages, args.batch, directory, journal=True, record=False)
+    run("recording only", messages, args.batch, directory, journal=False, record=True)
+    run("recording + journal", messages, args.batch, directory, journal=True, record=True)
+    
+    if not args.dir:
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
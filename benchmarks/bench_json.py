@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+JSON Backend Benchmark
+
+Serializes and parses typical JSON Lines records with every installed JSON
+backend. Each backend is first checked for parity with the standard library:
+its output must parse back to the same records, and it must parse the
+standard library's output to the same records, or the benchmark stops.
+
+Usage:
+    python benchmarks/bench_json.py --records 200000
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import encode_json_record
+from serialization import BACKENDS, JSON_BACKEND
+
+
+START_NS = 1699123456_000_000_000
+
+
+def generate_records(total: int) -> List[Dict[str, Any]]:
+    """Return JSON Lines records like the ones the recorder writes."""
+    records = []
+    for i in range(total):
+        message = {
+            "topic": f"site{i % 3}/line{i % 7}/device{i % 50}/telemetry",
+            "payload": (
+                f'{{"temp":{20 + (i % 1000) / 100:.2f},"status":"ok","seq":{i}}}'.encode('utf-8')
+                if i % 4 else f"{i % 100} °C".encode('utf-8')
+            ),
+            "timestamp_ns": START_NS + i * 500_000,
+            "qos": i % 3,
+            "retain": i % 10 == 0,
+            "dup": False,
+        }
+        if i % 16 == 0:
+            message["properties"] = {"ContentType": "application/json", "UserProperty": [("k", "v")]}
+        if i % 1000 == 999:
+            records.append({"timestamp_ns": message["timestamp_ns"], "dropped": {"buffer": i}})
+        records.append(encode_json_record(message))
+    return records
+
+
+def check_parity(name: str, records: List[Dict[str, Any]]):
+    """Fail unless the backend round trips the records exactly like the standard library."""
+    dumps, loads = BACKENDS[name]
+    stdlib_dumps, stdlib_loads = BACKENDS["stdlib"]
+    for record in records:
+        expected = stdlib_loads(stdlib_dumps(record))
+        if not isinstance(dumps(record), bytes):
+            raise SystemExit(f"{name}: dumps did not return bytes")
+        if loads(dumps(record)) != expected:
+            raise SystemExit(f"{name}: round trip differs from stdlib for {record!r}")
+        if stdlib_loads(dumps(record)) != expected:
+            raise SystemExit(f"{name}: stdlib cannot read its output for {record!r}")
+        if loads(stdlib_dumps(record)) != expected:
+            raise SystemExit(f"{name}: cannot read stdlib output for {record!r}")
+    try:
+        loads(b'{"topic": "a/b", "payload": ')
+    except ValueError:
+        pass
+    else:
+        raise SystemExit(f"{name}: truncated record did not raise ValueError")
+
+
+def main():
+    """Run the JSON backend comparison."""
+    parser = argparse.ArgumentParser(description="Compare JSON backends on recording records")
+    parser.add_argument("--records", type=int, default=200_000, help="Records to serialize and parse")
+    args = parser.parse_args()
+    
+    records = generate_records(args.records)
+    print(f"{args.records:,} records, default backend: {JSON_BACKEND}")
+    for name, (dumps, loads) in BACKENDS.items():
+        check_parity(name, records[:2000])
+        
+        start = time.perf_counter()
+        lines = [dumps(record) for record in records]
+        dumps_elapsed = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for line in lines:
+            loads(line)
+        loads_elapsed = time.perf_counter() - start
+        
+        size = sum(len(line) for line in lines)
+        print(
+            f"{name:<9} dumps {args.records / dumps_elapsed:>12,.0f} rec/s  "
+            f"loads {args.records / loads_elapsed:>12,.0f} rec/s  ({size / args.records:5.1f} B/rec)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+MQTT Recording Catalog
+
+A small SQLite database next to the recordings (mqtt_recordings.db) that
+lists every recording with its message count, time range, topic count and
+size. The recorder reserves the next recording number in it when a session
+starts and stores the statistics when the file is finished, so picking the
+next file name, finding the latest recording and listing recordings need
+no directory scan and no stat per file.
+
+The catalog trusts its entries. Recordings added or deleted behind its
+back (merged, converted or copied in, written with the catalog disabled,
+or removed by hand) are picked up by reconciling it with the directory,
+which adds new files with their size and modification time only and drops
+entries whose file is gone. Run as a script to reconcile it, or with
+--scan to rebuild it, reading every recording for full statistics:
+    python catalog.py
+    python catalog.py --scan
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from recording import (
+    RECORDING_PREFIX,
+    find_recordings,
+    is_manifest,
+    read_manifest,
+    read_messages,
+    recording_number,
+)
+
+
+CATALOG_FILENAME = "mqtt_recordings.db"
+
+# Seconds to wait for another process holding the catalog lock
+CATALOG_TIMEOUT = 10.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    name TEXT PRIMARY KEY,
+    number INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    messages INTEGER,
+    first_timestamp REAL,
+    last_timestamp REAL,
+    topics INTEGER,
+    bytes INTEGER,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recordings_number ON recordings (number);
+CREATE INDEX IF NOT EXISTS recordings_updated_at ON recordings (updated_at);
+"""
+
+_COLUMNS = ("name", "number", "status", "messages", "first_timestamp", "last_timestamp",
+            "topics", "bytes", "updated_at")
+
+
+def scan_recording(path: str) -> Dict[str, Any]:
+    """Read a whole recording and return its message count, time range, topic count and size."""
+    messages = 0
+    first_timestamp_ns = None
+    last_timestamp_ns = None
+    topics = set()
+    for message in read_messages(path):
+        # Gap records mark dropped messages and are not messages themselves
+        if "topic" not in message:
+            continue
+        messages += 1
+        if first_timestamp_ns is None:
+            first_timestamp_ns = message["timestamp_ns"]
+        last_timestamp_ns = message["timestamp_ns"]
+        topics.add(message["topic"])
+    
+    return {
+        "messages": messages,
+        "first_timestamp": first_timestamp_ns / 1e9 if first_timestamp_ns is not None else None,
+        "last_timestamp": last_timestamp_ns / 1e9 if last_timestamp_ns is not None else None,
+        "topics": len(topics),
+        "bytes": _recording_bytes(path),
+    }
+
+
+def _recording_bytes(path: str) -> int:
+    """Return the size of a recording, summing the segments of a manifest."""
+    if is_manifest(path):
+        size = 0
+        for segment in read_manifest(path):
+            try:
+                size += os.path.getsize(segment["path"])
+            except FileNotFoundError:
+                pass
+        return size
+    return os.path.getsize(path)
+
+
+class RecordingCatalog:
+    """SQLite index of the recordings in one directory."""
+    
+    def __init__(self, dir_path: str = "."):
+        """Open the catalog of a directory."""
+        self.dir_path = dir_path
+        self.path = os.path.join(dir_path, CATALOG_FILENAME)
+        
+        # Flight recorder dumps catalog their files from other threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            self.path, timeout=CATALOG_TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_SCHEMA)
+    
+    @classmethod
+    def from_config(cls, storage_config: Dict[str, Any], dir_path: str = ".") -> Optional["RecordingCatalog"]:
+        """Open the catalog unless storage.catalog is false; None if it cannot be opened."""
+        if not storage_config.get("catalog", True):
+            return None
+        try:
+            return cls(dir_path)
+        except sqlite3.Error as e:
+            logging.warning(f"Recording catalog unavailable, scanning the directory instead: {e}")
+            return None
+    
+    def _upsert(self, name: str, status: str, stats: Dict[str, Any], updated_at: Optional[float] = None):
+        """Insert or replace the entry of a recording."""
+        self.connection.execute(
+            f"INSERT OR REPLACE INTO recordings ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+            (
+                name, recording_number(name), status, stats.get("messages"),
+                stats.get("first_timestamp"), stats.get("last_timestamp"),
+                stats.get("topics"), stats.get("bytes"), updated_at or time.time()
+            )
+        )
+    
+    def _import(self, path: str, scan: bool):
+        """Insert the entry of a recording found in the directory."""
+        if scan:
+            try:
+                stats, status = scan_recording(path), "complete"
+            except Exception as e:
+                logging.warning(f"Could not read {path}: {e}")
+                stats, status = {"bytes": _recording_bytes(path)}, "unknown"
+        else:
+            stats, status = {"bytes": _recording_bytes(path)}, "unknown"
+        self._upsert(os.path.basename(path), status, stats, os.path.getmtime(path))
+    
+    def import_existing(self, scan: bool = False) -> int:
+        """Add the recordings found in the directory, returning how many were added.
+        
+        Without scan, only the size and modification time of each file are
+        recorded; with scan, every recording is read for full statistics.
+        """
+        paths = find_recordings(self.dir_path)
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            for path in paths:
+                self._import(path, scan)
+        return len(paths)
+    
+    def reconcile(self) -> int:
+        """Add recordings missing from the catalog and drop entries whose file is gone.
+        
+        Costs one directory listing and one query; only new files are
+        stat'ed. Reserved recordings that have not written their first
+        message yet are kept. Returns the number of entries changed.
+        """
+        paths = {os.path.basename(path): path for path in find_recordings(self.dir_path)}
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute("SELECT name, status FROM recordings").fetchall()
+            known = {row["name"] for row in rows}
+            vanished = [row["name"] for row in rows
+                        if row["name"] not in paths and row["status"] != "recording"]
+            for name in vanished:
+                self.connection.execute("DELETE FROM recordings WHERE name = ?", (name,))
+            added = [path for name, path in paths.items() if name not in known]
+            for path in added:
+                self._import(path, scan=False)
+        return len(vanished) + len(added)
+    
+    def rebuild(self, scan: bool = False) -> int:
+        """Replace all entries with the recordings currently in the directory."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM recordings")
+        return self.import_existing(scan)
+    
+    def reserve(self, extension: str) -> str:
+        """Claim the next recording number and return the new recording's path.
+        
+        The number is taken inside a write transaction, so recorders started
+        at the same time in one directory never pick the same file.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("SELECT MAX(number) FROM recordings").fetchone()
+            number = (row[0] or 0) + 1
+            while os.path.exists(os.path.join(self.dir_path, f"{RECORDING_PREFIX}{number}{extension}")):
+                number += 1
+            name = f"{RECORDING_PREFIX}{number}{extension}"
+            self._upsert(name, "recording", {})
+        return os.path.join(self.dir_path, name)
+    
+    def update(self, path: str, stats: Dict[str, Any]):
+        """Store the statistics of a finished recording."""
+        if recording_number(path) is None:
+            return
+        with self.lock, self.connection:
+            self._upsert(os.path.basename(path), "complete", stats)
+    
+    def scan(self, path: str):
+        """Read a recording and store its statistics."""
+        self.update(path, scan_recording(path))
+    
+    def remove(self, path: str):
+        """Drop the entry of a recording that was never written or was deleted."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM recordings WHERE name = ?", (os.path.basename(path),))
+    
+    def latest(self) -> Optional[str]:
+        """Return the path of the most recently written recording."""
+        with self.lock:
+            row = self.connection.execute("SELECT name FROM recordings ORDER BY updated_at DESC LIMIT 1").fetchone()
+        return os.path.join(self.dir_path, row["name"]) if row else None
+    
+    def entries(self) -> List[Dict[str, Any]]:
+        """Return the entry of every recording, ordered by recording number."""
+        with self.lock:
+            rows = self.connection.execute(f"SELECT {', '.join(_COLUMNS)} FROM recordings ORDER BY number")
+            return [dict(row) for row in rows]
+    
+    def close(self):
+        """Close the database connection."""
+        with self.lock:
+            self.connection.close()
+
+
+def format_entry(entry: Dict[str, Any]) -> str:
+    """Describe a catalog entry on one line for recording listings."""
+    details = [f"{entry['bytes'] or 0:,} bytes"]
+    if entry["messages"] is not None:
+        details.append(f"{entry['messages']:,} messages")
+        details.append(f"{entry['topics']:,} topics")
+    if entry["first_timestamp"] is not None:
+        start = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["first_timestamp"]))
+        end = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_timestamp"]))
+        details.append(f"{start} to {end}")
+    else:
+        details.append(time.ctime(entry["updated_at"]))
+    if entry["status"] == "recording":
+        details.append("in progress or interrupted")
+    return f"{entry['name']} ({', '.join(details)})"
+
+
+def main():
+    """Reconcile or rebuild the recording catalog of a directory."""
+    parser = argparse.ArgumentParser(description="Reconcile or rebuild the MQTT recording catalog")
+    parser.add_argument("--dir", default=".", help="Directory holding the recordings")
+    parser.add_argument("--scan", action="store_true",
+                        help="Rebuild the catalog, reading every recording for message, time range "
+                             "and topic statistics")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    
+    if not os.path.isdir(args.dir):
+        print(f"Error: Directory '{args.dir}' not found.")
+        sys.exit(1)
+    
+    catalog = RecordingCatalog(args.dir)
+    if args.scan:
+        count = catalog.rebuild(scan=True)
+        print(f"Cataloged {count} recordings in {catalog.path}")
+    else:
+        count = catalog.reconcile()
+        print(f"Added or removed {count} recordings in {catalog.path}")
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
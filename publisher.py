@@ -2,12 +2,13 @@
 """
 MQTT Message Publisher and Replayer
 
-This script reads previously recorded MQTT messages from a JSON file
-and replays them with the same timing and order as originally received.
+This script reads previously recorded MQTT messages from a JSON Lines or
+binary recording and replays them with the same timing and order as originally received.
 """
 
 import paho.mqtt.client as mqtt
-import json
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import time
 import yaml
 import logging
@@ -15,9 +16,34 @@ import ssl
 import sys
 import signal
 import os
-import glob
 import argparse
-from typing import Dict, Any, Iterator, List
+import bisect
+import sqlite3
+from datetime import datetime
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from catalog import RecordingCatalog, format_entry
+from metrics import LATENESS_SECONDS_BUCKETS, Metrics, MetricsExporter
+from recording import (
+    PAYLOAD_CACHE_SIZE,
+    find_recordings,
+    is_gap_record,
+    is_manifest,
+    read_block_index,
+    read_manifest,
+    read_messages,
+)
+
+
+# Longest gap between two messages that is reproduced during replay
+MAX_DELAY_NS = 60 * 1_000_000_000
+
+# Supported MQTT protocol versions, by config value
+MQTT_PROTOCOLS = {
+    "3.1": mqtt.MQTTv31,
+    "3.1.1": mqtt.MQTTv311,
+    "5": mqtt.MQTTv5,
+}
 
 
 class MQTTPublisher:
@@ -31,14 +57,52 @@ class MQTTPublisher:
         self.config = self._load_config(config_file)
         self.publish_config = self.config["publish"]
         
+        # Recording catalog, to find and list recordings without scanning the directory
+        self.catalog = RecordingCatalog.from_config(self.config["storage"])
+        
         # Use provided storage file or determine from existing recordings
         if storage_file:
             self.storage_file = storage_file
         else:
             self.storage_file = self._get_latest_recording()
         
-        # Setup MQTT client
-        self.client = self._setup_mqtt_client()
+        # Number of messages to skip at the start of the recording
+        self.start_offset = 0
+        
+        # Per-field overrides of recorded QoS, retain and properties
+        self.overrides: Dict[str, Any] = dict(self.publish_config.get("overrides") or {})
+        
+        # Optional time window (epoch seconds) to replay
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        
+        # Deduplicated payloads are read through an LRU cache of this many payloads
+        self.payload_cache_size = self.publish_config.get("payload_cache", PAYLOAD_CACHE_SIZE)
+        
+        # Live metrics; publish.metrics overrides the metrics section shared
+        # with the recorder, so both can run side by side
+        self.metrics: Optional[Metrics] = None
+        self.metrics_exporter: Optional[MetricsExporter] = None
+        metrics_config = self.publish_config.get("metrics") or self.config.get("metrics") or {}
+        if metrics_config.get("enabled"):
+            self.metrics = Metrics("mqtt_replay", metrics_config.get("topic_depth", 1))
+            self.metrics_exporter = MetricsExporter.from_config(metrics_config, self.metrics)
+            self.lateness_seconds = self.metrics.histogram(
+                "lateness_seconds", "How late messages were published against the recorded timing.",
+                LATENESS_SECONDS_BUCKETS
+            )
+        self.failed_count = 0
+        
+        # Setup one MQTT client per target broker; recorded source IDs with a
+        # route go to their own broker, everything else to the default one
+        self.protocols: Dict[Optional[str], int] = {}
+        self.routes = self._route_configs()
+        self.clients = {
+            route: self._setup_mqtt_client(route_config, route)
+            for route, route_config in self.routes.items()
+        }
+        self.client = self.clients[None]
+        self.protocol = self.protocols[None]
         
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -68,9 +132,24 @@ class MQTTPublisher:
     
     def _get_latest_recording(self) -> str:
         """Find the latest recording file or use config default."""
-        # Look for mqtt_record_*.json files
-        pattern = "mqtt_record_*.json"
-        recording_files = glob.glob(pattern)
+        if self.catalog:
+            try:
+                latest_file = self.catalog.latest()
+                if latest_file and not os.path.exists(latest_file):
+                    # Deleted or moved behind the catalog's back
+                    logging.info(f"{latest_file} is gone, reconciling the recording catalog")
+                    self.catalog.reconcile()
+                    latest_file = self.catalog.latest()
+                if latest_file and os.path.exists(latest_file):
+                    logging.info(f"Using latest recording: {latest_file}")
+                    return latest_file
+                recording_files = [] if latest_file is None else find_recordings()
+            except sqlite3.Error as e:
+                logging.warning(f"Recording catalog unavailable, scanning the directory instead: {e}")
+                recording_files = find_recordings()
+        else:
+            # Look for mqtt_record_* files in any recording format
+            recording_files = find_recordings()
         
         if recording_files:
             # Sort by modification time, newest first
@@ -81,15 +160,21 @@ class MQTTPublisher:
         else:
             # Fall back to config file path
             config_file = self.config["storage"]["file_path"]
-            logging.info(f"No mqtt_record_*.json files found, using config file: {config_file}")
+            logging.info(f"No mqtt_record_* files found, using config file: {config_file}")
             return config_file
     
     def list_available_recordings(self) -> List[str]:
-        """List all available recording files."""
-        pattern = "mqtt_record_*.json"
-        recording_files = glob.glob(pattern)
-        recording_files.sort(key=lambda x: int(x.split('_')[2].split('.')[0]))
-        return recording_files
+        """Describe all available recording files, with their statistics when cataloged."""
+        if self.catalog:
+            try:
+                return [format_entry(entry) for entry in self.catalog.entries()]
+            except sqlite3.Error as e:
+                logging.warning(f"Recording catalog unavailable, scanning the directory instead: {e}")
+        
+        return [
+            f"{os.path.basename(path)} ({os.path.getsize(path):,} bytes, {time.ctime(os.path.getmtime(path))})"
+            for path in find_recordings()
+        ]
     
     def _setup_logging(self):
         """Setup logging configuration."""
@@ -108,12 +193,31 @@ class MQTTPublisher:
             force=True  # Force reconfiguration
         )
     
-    def _setup_mqtt_client(self) -> mqtt.Client:
-        """Setup and configure MQTT client."""
-        client = mqtt.Client()
+    def _route_configs(self) -> Dict[Optional[str], Dict[str, Any]]:
+        """Return the target broker settings by recorded source ID.
+        
+        The publish section itself is the default target (key None). Each
+        entry of publish.routes maps a source ID to a broker and inherits
+        unset keys from the publish section.
+        """
+        defaults = {key: value for key, value in self.publish_config.items() if key != "routes"}
+        configs: Dict[Optional[str], Dict[str, Any]] = {None: defaults}
+        for source_id, route in (self.publish_config.get("routes") or {}).items():
+            configs[str(source_id)] = {**defaults, **(route or {})}
+        return configs
+    
+    def _setup_mqtt_client(self, publish_config: Optional[Dict[str, Any]] = None,
+                           route: Optional[str] = None) -> mqtt.Client:
+        """Setup and configure an MQTT client for one target broker."""
+        publish_config = publish_config or self.publish_config
+        protocol = str(publish_config.get("protocol", "3.1.1"))
+        if protocol not in MQTT_PROTOCOLS:
+            raise ValueError(f"Unknown MQTT protocol version: {protocol} (expected 3.1, 3.1.1 or 5)")
+        self.protocols[route] = MQTT_PROTOCOLS[protocol]
+        client = mqtt.Client(protocol=self.protocols[route], userdata=route)
         client.username_pw_set(
-            self.publish_config["username"], 
-            self.publish_config["password"]
+            publish_config["username"], 
+            publish_config["password"]
         )
         
         # Set callbacks
@@ -122,55 +226,129 @@ class MQTTPublisher:
         client.on_publish = self._on_publish
         
         # Setup TLS if required
-        if self.publish_config.get("tls"):
+        if publish_config.get("tls"):
             client.tls_set(tls_version=ssl.PROTOCOL_TLSv1_2)
-            if not self.publish_config.get("validate_certificate"):
+            if not publish_config.get("validate_certificate"):
                 client.tls_insecure_set(True)
         
         return client
     
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback for when the client connects to the broker."""
+        route = f" for source {userdata}" if userdata is not None else ""
         if rc == 0:
-            logging.info("Successfully connected to MQTT broker")
+            logging.info(f"Successfully connected to MQTT broker{route}")
         else:
-            logging.error(f"Failed to connect, return code {rc}")
+            logging.error(f"Failed to connect{route}, return code {rc}")
             sys.exit(1)
     
-    def _on_disconnect(self, client, userdata, rc):
+    def _on_disconnect(self, client, userdata, rc, properties=None):
         """Callback for when the client disconnects."""
+        route = f" for source {userdata}" if userdata is not None else ""
         if rc != 0:
-            logging.error(f"Unexpected disconnection, return code {rc}")
+            logging.error(f"Unexpected disconnection{route}, return code {rc}")
         else:
-            logging.info("Disconnected from MQTT broker")
+            logging.info(f"Disconnected from MQTT broker{route}")
     
     def _on_publish(self, client, userdata, mid):
         """Callback for when a message is published."""
         logging.debug(f"Message {mid} published successfully")
     
     def _read_messages(self) -> Iterator[Dict[str, Any]]:
-        """Generator to read messages from the storage file."""
+        """Generator to read messages from the storage file or segmented session."""
         try:
             if not os.path.exists(self.storage_file):
                 raise FileNotFoundError(f"Storage file {self.storage_file} not found")
             
-            with open(self.storage_file, "r", encoding='utf-8') as file:
-                for line_num, line in enumerate(file, 1):
-                    line = line.strip()
-                    if not line:
+            start_ns = int(self.start_time * 1e9) if self.start_time is not None else None
+            end_ns = int(self.end_time * 1e9) if self.end_time is not None else None
+            
+            for path, start_block, skip in self._replay_plan():
+                for message in read_messages(path, start_block, self.payload_cache_size):
+                    if skip:
+                        skip -= 1
                         continue
                     
-                    try:
-                        message = json.loads(line)
-                        yield message
-                    except json.JSONDecodeError as e:
-                        logging.warning(f"Invalid JSON on line {line_num}: {e}")
+                    # Apply the requested time window
+                    if start_ns is not None and message["timestamp_ns"] < start_ns:
                         continue
-        
+                    if end_ns is not None and message["timestamp_ns"] > end_ns:
+                        return
+                    yield message
+                    
         except Exception as e:
             logging.error(f"Error reading messages: {e}")
             raise
     
+    def _replay_plan(self) -> Iterator[Tuple[str, int, int]]:
+        """Yield (file, start block, messages to skip) for each file to replay."""
+        if not is_manifest(self.storage_file):
+            yield (self.storage_file, *self._locate(self.storage_file, self.start_offset))
+            return
+        
+        offset = self.start_offset
+        segments = read_manifest(self.storage_file)
+        for number, segment in enumerate(segments, 1):
+            first_timestamp = segment.get("first_timestamp")
+            last_timestamp = segment.get("last_timestamp")
+            is_last = number == len(segments)
+            
+            # Skip whole segments before the offset or outside the time window
+            if offset and not is_last and offset >= segment.get("messages", 0):
+                offset -= segment.get("messages", 0)
+                continue
+            if self.start_time is not None and last_timestamp is not None and last_timestamp < self.start_time and not is_last:
+                logging.debug(f"Skipping segment {segment['path']}, it ends before the time window")
+                offset = 0
+                continue
+            if self.end_time is not None and first_timestamp is not None and first_timestamp > self.end_time:
+                logging.debug(f"Segment {segment['path']} starts after the time window, stopping")
+                return
+            
+            yield (segment["path"], *self._locate(segment["path"], offset))
+            offset = 0
+    
+    def _locate(self, path: str, offset: int) -> Tuple[int, int]:
+        """Find where to start reading a file: at a message offset, else at the start time."""
+        if offset or self.start_time is None:
+            return self._locate_offset(path, offset)
+        return self._locate_time(path, self.start_time), 0
+    
+    def _locate_time(self, path: str, start_time: float) -> int:
+        """Binary search the block index for the last block starting before start_time."""
+        blocks = read_block_index(path)
+        if not blocks:
+            logging.info(
+                f"{path} has no time index, reading from the start "
+                f"(build one with: python recording.py index {path})"
+            )
+            return 0
+        
+        first_timestamps = [block["first_timestamp"] for block in blocks]
+        start_block = max(0, bisect.bisect_left(first_timestamps, start_time) - 1)
+        if start_block:
+            logging.info(f"Seeking to block {start_block} of {len(blocks)} for the start time")
+        return start_block
+    
+    def _locate_offset(self, path: str, offset: int) -> Tuple[int, int]:
+        """Find the block containing offset, returning (block, messages to skip in it)."""
+        if not offset:
+            return 0, 0
+        
+        # Indexed recordings have a block index to seek with
+        start_block = 0
+        skip = offset
+        blocks = read_block_index(path)
+        for block_number, block in enumerate(blocks[:-1]):
+            if block["messages"] > skip:
+                break
+            skip -= block["messages"]
+            start_block = block_number + 1
+        
+        if start_block:
+            logging.info(f"Seeking to block {start_block}, skipping {skip} more messages")
+        return start_block, skip
+    
     def _signal_handler(self, signum, frame):
         """Handle shutdown signals gracefully."""
         logging.info(f"Received signal {signum}, shutting down gracefully...")
@@ -182,19 +360,25 @@ class MQTTPublisher:
             logging.info("Starting MQTT publisher...")
             logging.info(f"Replaying messages from: {self.storage_file}")
             
-            # Connect to broker
-            self.client.connect(
-                self.publish_config["broker"], 
-                self.publish_config["port"], 
-                60
-            )
-            
-            # Start the loop in a separate thread
-            self.client.loop_start()
+            # Connect to the target brokers
+            for route, client in self.clients.items():
+                client.connect(
+                    self.routes[route]["broker"], 
+                    self.routes[route]["port"], 
+                    60
+                )
+                
+                # Start the loop in a separate thread
+                client.loop_start()
             
             # Wait for connection
             time.sleep(1)
             
+            if self.metrics_exporter:
+                self.metrics.gauge("failed_messages", "Messages the client refused to publish.",
+                                   lambda: self.failed_count)
+                self.metrics_exporter.start()
+            
             # Start publishing messages
             self._publish_messages()
             
@@ -202,12 +386,17 @@ class MQTTPublisher:
             logging.error(f"Connection failed: {e}")
             sys.exit(1)
         finally:
-            self.client.loop_stop()
+            for client in self.clients.values():
+                client.loop_stop()
+            if self.metrics_exporter:
+                self.metrics_exporter.close()
     
     def _publish_messages(self):
         """Publish messages with original timing."""
         try:
-            previous_timestamp = None
+            previous_ns = None
+            first_ns = 0
+            replay_start_ns = 0
             message_count = 0
             
             logging.info("Starting message replay...")
@@ -216,30 +405,58 @@ class MQTTPublisher:
                 if self.should_stop:
                     break
                 
-                # Calculate delay based on original timestamps
-                if previous_timestamp is not None:
-                    delay = message["timestamp"] - previous_timestamp
-                    if delay > 0:
-                        time.sleep(min(delay, 60))  # Cap delay at 60 seconds
+                if is_gap_record(message):
+                    # The recorder dropped messages here under overload
+                    dropped = sum(message["dropped"].values())
+                    logging.warning(f"Recording gap: {dropped} messages were dropped by the recorder")
+                    continue
                 
-                # Publish the message
+                # Schedule against the replay start in integer nanoseconds so
+                # sleep overshoot never accumulates into drift
+                timestamp_ns = message["timestamp_ns"]
+                if previous_ns is None:
+                    first_ns = timestamp_ns
+                    replay_start_ns = time.monotonic_ns()
+                else:
+                    gap_ns = timestamp_ns - previous_ns
+                    if gap_ns > MAX_DELAY_NS:
+                        # Cap idle gaps by shifting the schedule
+                        replay_start_ns -= gap_ns - MAX_DELAY_NS
+                    wait_ns = replay_start_ns + (timestamp_ns - first_ns) - time.monotonic_ns()
+                    if wait_ns > 0:
+                        time.sleep(wait_ns / 1e9)
+                    if self.metrics:
+                        late_ns = time.monotonic_ns() - (replay_start_ns + timestamp_ns - first_ns)
+                        self.metrics.observe(self.lateness_seconds, max(0, late_ns) / 1e9)
+                
+                # Publish the message (bytes payloads are passed through untouched)
                 try:
-                    result = self.client.publish(
+                    route = message.get("source")
+                    if route not in self.clients:
+                        route = None
+                    qos, retain, properties = self._publish_options(message, self.protocols[route])
+                    result = self.clients[route].publish(
                         message["topic"], 
-                        message["payload"]
+                        message["payload"],
+                        qos=qos,
+                        retain=retain,
+                        properties=properties
                     )
                     
                     if result.rc != mqtt.MQTT_ERR_SUCCESS:
                         logging.warning(f"Failed to publish message to {message['topic']}")
+                        self.failed_count += 1
                     else:
                         message_count += 1
+                        if self.metrics:
+                            self.metrics.count_message(message["topic"], len(message["payload"]))
                         if message_count % 1000 == 0:
                             logging.info(f"Published {message_count} messages")
-                
+                            
                 except Exception as e:
                     logging.error(f"Error publishing message: {e}")
                 
-                previous_timestamp = message["timestamp"]
+                previous_ns = timestamp_ns
             
             logging.info(f"Finished replaying {message_count} messages")
             
@@ -247,21 +464,83 @@ class MQTTPublisher:
             logging.error(f"Error during message replay: {e}")
             raise
     
+    def _publish_options(self, message: Dict[str, Any],
+                         protocol: Optional[int] = None) -> Tuple[int, bool, Optional[Properties]]:
+        """Return QoS, retain flag and v5 properties for a message, applying overrides."""
+        if protocol is None:
+            protocol = self.protocol
+        qos = self.overrides.get("qos")
+        if qos is None:
+            qos = message.get("qos", 0)
+        retain = self.overrides.get("retain")
+        if retain is None:
+            retain = message.get("retain", False)
+        
+        properties = None
+        recorded = message.get("properties")
+        if recorded and self.overrides.get("properties", True) and protocol == mqtt.MQTTv5:
+            properties = Properties(PacketTypes.PUBLISH)
+            for name, value in recorded.items():
+                setattr(properties, name, value)
+        
+        return qos, retain, properties
+    
     def stop(self):
         """Stop the MQTT publisher."""
         logging.info("Stopping MQTT publisher...")
         self.should_stop = True
-        self.client.disconnect()
+        for client in self.clients.values():
+            client.disconnect()
         logging.info("Publisher stopped")
 
 
+def parse_time(value: str) -> float:
+    """Parse epoch seconds or an ISO 8601 date/time into epoch seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
 def main():
     """Main function to run the MQTT publisher."""
     parser = argparse.ArgumentParser(description="MQTT Message Publisher and Replayer")
     parser.add_argument(
         "--file", "-f", 
         type=str, 
-        help="Specific recording file to replay (e.g., mqtt_record_1.json)"
+        help="Specific recording file or session manifest to replay (e.g., mqtt_record_1.json)"
+    )
+    parser.add_argument(
+        "--offset",
+        type=int,
+        default=0,
+        help="Skip the first N messages (compressed recordings seek via their block index)"
+    )
+    parser.add_argument(
+        "--start",
+        type=parse_time,
+        help="Only replay messages recorded at or after this time (epoch seconds or ISO 8601)"
+    )
+    parser.add_argument(
+        "--end",
+        type=parse_time,
+        help="Only replay messages recorded at or before this time (epoch seconds or ISO 8601)"
+    )
+    parser.add_argument(
+        "--qos",
+        type=int,
+        choices=[0, 1, 2],
+        help="Publish every message with this QoS instead of the recorded one"
+    )
+    parser.add_argument(
+        "--retain",
+        choices=["true", "false"],
+        help="Force the retain flag instead of using the recorded one"
+    )
+    parser.add_argument(
+        "--no-properties",
+        action="store_true",
+        help="Do not replay recorded MQTT v5 properties"
     )
     parser.add_argument(
         "--list", "-l", 
@@ -279,9 +558,7 @@ def main():
             if recordings:
                 print("Available recording files:")
                 for i, recording in enumerate(recordings, 1):
-                    file_size = os.path.getsize(recording)
-                    file_time = time.ctime(os.path.getmtime(recording))
-                    print(f"  {i}. {recording} ({file_size:,} bytes, {file_time})")
+                    print(f"  {i}. {recording}")
             else:
                 print("No recording files found.")
             return
@@ -291,6 +568,15 @@ def main():
                 print(f"Error: File '{args.file}' not found.")
                 sys.exit(1)
             publisher.storage_file = args.file
+        publisher.start_offset = args.offset
+        publisher.start_time = args.start
+        if args.qos is not None:
+            publisher.overrides["qos"] = args.qos
+        if args.retain is not None:
+            publisher.overrides["retain"] = args.retain == "true"
+        if args.no_properties:
+            publisher.overrides["properties"] = False
+        publisher.end_time = args.end
         
         publisher.start()
         
@@ -0,0 +1,2074 @@
+#!/usr/bin/env python3
+"""
+MQTT Recording Storage
+
+Shared helpers for reading and writing recording files: the JSON Lines and
+length-prefixed binary formats with auto-detection, optional block
+compression with a seekable block index, a persistent, buffered file
+handle, size- and time-based segment rotation with a manifest, the
+durability policy that decides when data is fsynced, the flush
+controller that decides when buffered messages are written and the
+write-ahead journal that protects buffered messages against crashes.
+
+Run as a script to convert recordings between formats, merge recordings
+from several recorder instances into one timestamp-ordered recording or
+build the time index of recordings made without one:
+    python recording.py convert mqtt_record_1.json mqtt_record_1.mqr --format binary
+    python recording.py merge merged.mqr host_a/mqtt_record_1.mqr host_b/mqtt_record_1.mqr
+    python recording.py index mqtt_record_1.json
+"""
+
+import argparse
+import base64
+import collections
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import BinaryIO, Callable, Dict, Any, Iterable, Iterator, List, Optional, Set, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from serialization import json_dumps, json_loads
+
+
+PAYLOAD_ENCODINGS = ("text", "base64")
+
+# Binary recording format: header, then length-prefixed records
+BINARY_MAGIC = b"MQRB"
+BINARY_VERSION = 9
+RECORD_MESSAGE = 0
+RECORD_TOPIC = 1
+RECORD_MESSAGE_REF = 2
+RECORD_MESSAGE_OFFSET = 3
+RECORD_MESSAGE_FLAGS = 4
+RECORD_GAP = 5
+RECORD_NUMERIC = 6
+RECORD_BLOCK = 7
+
+# Message flag bits of binary message records
+FLAG_QOS_MASK = 0x03
+FLAG_RETAIN = 0x04
+FLAG_DUP = 0x08
+FLAG_PROPERTIES = 0x10
+FLAG_SOURCE = 0x20
+FLAG_PAYLOAD_REF = 0x40
+FLAG_NUMERIC_SCALE = 0x80  # Numeric records: the decimal scale changed
+
+# (qos, retain, dup) for the low flag bits, looked up instead of computed per record
+_MESSAGE_FLAG_FIELDS_MASK = FLAG_QOS_MASK | FLAG_RETAIN | FLAG_DUP
+_MESSAGE_FLAG_FIELDS = tuple(
+    (flags & FLAG_QOS_MASK, bool(flags & FLAG_RETAIN), bool(flags & FLAG_DUP))
+    for flags in range(_MESSAGE_FLAG_FIELDS_MASK + 1)
+)
+
+# Decimal payloads that numeric records rebuild byte for byte: no leading
+# zeros, no exponent, a plain "-" sign and at most 15 decimals
+_NUMERIC_PAYLOAD = re.compile(rb"-?(?:0|[1-9][0-9]{0,17})(?:\.([0-9]{1,15}))?")
+
+# Distinct decimal payloads a reader keeps formatted per recording
+DECIMAL_CACHE_SIZE = 65536
+
+# MQTT v5 PUBLISH properties worth replaying; topic aliases and subscription
+# identifiers only make sense on the connection they were received on
+REPLAY_PROPERTIES = (
+    "PayloadFormatIndicator",
+    "MessageExpiryInterval",
+    "ContentType",
+    "ResponseTopic",
+    "CorrelationData",
+    "UserProperty",
+)
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Compressed recordings are concatenated gzip members or zstd frames
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+BLOCK_INDEX_SUFFIX = ".blocks"
+
+# Repeated payloads of binary recordings can live once in a side file
+PAYLOAD_STORE_SUFFIX = ".payloads"
+PAYLOAD_CACHE_SIZE = 10000
+
+RECORDING_PREFIX = "mqtt_record_"
+RECORDING_EXTENSIONS = (".json", ".mqr", ".manifest")
+MANIFEST_EXTENSION = ".manifest"
+COMPRESSION_EXTENSIONS = (".gz", ".zst")
+
+# Write-ahead journal: a header page, then entries from the data start on
+JOURNAL_MAGIC = b"MQRJ"
+JOURNAL_VERSION = 1
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_DATA_START = 4096
+
+_RECORD_HEADER = struct.Struct("<Bq")
+_FLAGS_RECORD_HEADER = struct.Struct("<BqB")
+_JOURNAL_HEAD = struct.Struct("<QQ")  # Head offset and sequence number, at byte 8
+_JOURNAL_METADATA_LENGTH = struct.Struct("<I")  # At byte 24, metadata follows
+_JOURNAL_ENTRY = struct.Struct("<QII")  # Sequence number, body length, CRC32 of the body
+_COMPACT_RECORD = struct.Struct("<qBHH")  # Timestamp, flags, topic and source lengths
+
+
+def gap_record(timestamp_ns: int) -> Dict[str, Any]:
+    """Create a gap marker: messages dropped by the recorder, counted per topic."""
+    return {"timestamp_ns": timestamp_ns, "dropped": {}}
+
+
+def is_gap_record(record: Dict[str, Any]) -> bool:
+    """Return True for gap markers, which stand in for dropped messages."""
+    return "dropped" in record
+
+
+def encode_properties(properties) -> Optional[Dict[str, Any]]:
+    """Convert MQTT v5 message properties into a JSON-compatible dict, None if empty."""
+    if properties is None:
+        return None
+    
+    result = {}
+    for name in REPLAY_PROPERTIES:
+        if isinstance(properties, dict):
+            value = properties.get(name)
+        else:
+            value = getattr(properties, name, None)
+        if value is None:
+            continue
+        
+        if isinstance(value, (bytes, bytearray)):
+            value = {"base64": base64.b64encode(value).decode('ascii')}
+        elif name == "UserProperty":
+            value = [list(pair) for pair in value]
+        result[name] = value
+    return result or None
+
+
+def decode_properties(properties: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Restore bytes and user property pairs of properties stored by encode_properties."""
+    if not properties:
+        return None
+    
+    result = {}
+    for name, value in properties.items():
+        if isinstance(value, dict) and "base64" in value:
+            value = base64.b64decode(value["base64"])
+        elif name == "UserProperty":
+            value = [tuple(pair) for pair in value]
+        result[name] = value
+    return result
+
+
+def encode_json_record(message: Dict[str, Any], payload_encoding: str = "text") -> Dict[str, Any]:
+    """Convert an in-memory message with a bytes payload into its JSON Lines form."""
+    if is_gap_record(message):
+        return message
+    payload = message["payload"]
+    record = dict(message)
+    record.pop("journal_seq", None)
+    
+    properties = encode_properties(record.pop("properties", None))
+    if properties:
+        record["properties"] = properties
+    
+    if payload_encoding == "base64":
+        # Lossless: raw payload bytes survive protobuf, CBOR or compressed data
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        del record["payload"]
+        record["payload_b64"] = base64.b64encode(payload).decode('ascii')
+    elif isinstance(payload, (bytes, bytearray, memoryview)):
+        record["payload"] = bytes(payload).decode('utf-8', errors='ignore')
+    
+    return record
+
+
+def decode_json_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Restore raw payload bytes and integer nanosecond timestamps of a JSON record."""
+    if "payload_b64" in record:
+        record["payload"] = base64.b64decode(record.pop("payload_b64"))
+    if "properties" in record:
+        record["properties"] = decode_properties(record["properties"])
+    if "timestamp" in record:
+        # Older recordings store float seconds
+        record["timestamp_ns"] = int(round(record.pop("timestamp") * 1_000_000)) * 1000
+    return record
+
+
+class RecordingClock:
+    """Monotonic nanosecond clock anchored to the wall clock once, at start.
+    
+    Timestamps never jump when NTP adjusts the system clock and stay exact
+    integers, so inter-arrival gaps are preserved on long captures.
+    """
+    
+    def __init__(self):
+        """Capture the wall-clock and monotonic anchors."""
+        self.wall_anchor_ns = time.time_ns()
+        self.monotonic_anchor_ns = time.monotonic_ns()
+    
+    def now_ns(self) -> int:
+        """Return the current time as anchored wall-clock nanoseconds."""
+        return self.wall_anchor_ns + time.monotonic_ns() - self.monotonic_anchor_ns
+
+
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as a LEB128 varint."""
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(buffer: bytes, pos: int) -> Tuple[int, int]:
+    """Decode a varint at pos, returning (value, next position).
+    
+    Raises IndexError if the buffer ends in the middle of the varint.
+    """
+    byte = buffer[pos]
+    if byte < 0x80:
+        return byte, pos + 1
+    
+    value = byte & 0x7F
+    shift = 7
+    pos += 1
+    while True:
+        byte = buffer[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value: int) -> int:
+    """Map a signed integer to a non-negative one so small magnitudes stay small varints."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    """Invert zigzag()."""
+    return (value >> 1) ^ -(value & 1)
+
+
+def parse_decimal(payload: bytes) -> Optional[Tuple[int, int]]:
+    """Return (mantissa, scale) of a plain decimal payload, None for anything else.
+    
+    format_decimal(mantissa, scale) gives back the exact payload bytes.
+    """
+    if len(payload) > 34:
+        return None
+    match = _NUMERIC_PAYLOAD.fullmatch(payload)
+    if match is None:
+        return None
+    decimals = match.group(1)
+    if decimals is None:
+        mantissa, scale = int(payload), 0
+    else:
+        mantissa, scale = int(payload.replace(b".", b"")), len(decimals)
+    if mantissa == 0 and payload[0] == 0x2D:
+        # Negative zero has no integer mantissa
+        return None
+    return mantissa, scale
+
+
+def format_decimal(mantissa: int, scale: int) -> bytes:
+    """Format a mantissa and decimal scale back into the payload parse_decimal() read."""
+    if not scale:
+        return b"%d" % mantissa
+    whole, fraction = divmod(abs(mantissa), 10 ** scale)
+    return b"%s%d.%0*d" % (b"-" if mantissa < 0 else b"", whole, scale, fraction)
+
+
+class JsonLinesCodec:
+    """Encodes messages as one JSON object per line."""
+    
+    name = "json"
+    extension = ".json"
+    
+    def __init__(self, payload_encoding: str = "text"):
+        """Initialize the codec with the payload encoding mode."""
+        if payload_encoding not in PAYLOAD_ENCODINGS:
+            raise ValueError(f"Unknown payload encoding: {payload_encoding} (expected one of {', '.join(PAYLOAD_ENCODINGS)})")
+        self.payload_encoding = payload_encoding
+    
+    def header(self) -> bytes:
+        """JSON Lines files have no header."""
+        return b""
+    
+    def reset(self):
+        """JSON Lines records are self-contained, there is no state to reset."""
+    
+    def start_block(self) -> bytes:
+        """JSON Lines blocks need no marker."""
+        return b""
+    
+    def new_topics(self) -> List[List[Any]]:
+        """JSON Lines records carry their topics inline."""
+        return []
+    
+    def encode(self, messages: List[Dict[str, Any]], payload_store=None) -> bytes:
+        """Serialize a batch of messages; payloads are always stored inline."""
+        return b"".join(
+            json_dumps(encode_json_record(msg, self.payload_encoding)) + b"\n"
+            for msg in messages
+        )
+
+
+class BinaryCodec:
+    """Encodes messages as length-prefixed binary records.
+    
+    File layout: magic, version byte, varint-prefixed JSON metadata holding
+    the wall-clock anchor, then records of varint body length followed by
+    the body, which starts with a record type byte. Topics and source IDs
+    are interned into a dictionary: a topic record (varint ID, string)
+    defines an ID the first time a string is seen, and message records carry
+    the int64 nanosecond offset from the anchor, a flags byte (QoS, retain,
+    dup, has properties, has source, payload reference), the varint topic
+    ID, an optional varint source ID, optional varint-prefixed JSON MQTT v5
+    properties and the raw payload, or the varint offset and length of the
+    payload in the recording's payload store. Gap records (int64 offset,
+    JSON per-topic counts) mark where the recorder dropped messages under
+    overload. The dictionary restarts at every compressed block so blocks
+    can be decoded independently. Uncompressed recordings keep one
+    dictionary; their block index lists the topics each block adds instead.
+    
+    With numeric encoding, plain decimal payloads such as b"21.5" are
+    written as numeric records instead: flags, varint topic ID, optional
+    source ID and scale byte, then the zigzag varint delta-of-delta of the
+    timestamp and the zigzag varint delta of the integer mantissa, both
+    against the previous numeric record of the same topic. That state
+    restarts whenever the topic ID is (re)defined and at block records,
+    which mark the block boundaries of uncompressed recordings.
+    """
+    
+    name = "binary"
+    extension = ".mqr"
+    
+    def __init__(self, wall_anchor_ns: Optional[int] = None, numeric: bool = False):
+        """Initialize the codec with an empty topic dictionary and the time anchor.
+        
+        numeric enables the delta encoding of decimal payloads.
+        """
+        self.topic_ids: Dict[str, int] = {}
+        self.topics: List[str] = []
+        self.indexed_topics = 0
+        self.wall_anchor_ns = wall_anchor_ns if wall_anchor_ns is not None else time.time_ns()
+        self.numeric = numeric
+        
+        # Per topic ID: previous offset, offset delta, mantissa and scale
+        self.numeric_state: Dict[int, List[int]] = {}
+    
+    def header(self) -> bytes:
+        """Return the file header with magic number, version and metadata."""
+        metadata = json.dumps({"wall_anchor_ns": self.wall_anchor_ns}).encode('utf-8')
+        return BINARY_MAGIC + bytes((BINARY_VERSION,)) + encode_varint(len(metadata)) + metadata
+    
+    def reset(self):
+        """Start a new topic dictionary for a new file or block."""
+        self.topic_ids = {}
+        self.topics = []
+        self.indexed_topics = 0
+        self.numeric_state = {}
+    
+    def start_block(self) -> bytes:
+        """Start a block of an uncompressed recording, returning the block record to write first.
+        
+        Numeric records restart their state at the block record, so a reader
+        can start decoding there; other records need no marker.
+        """
+        if not self.numeric:
+            return b""
+        self.numeric_state = {}
+        return encode_varint(1) + bytes((RECORD_BLOCK,))
+    
+    def new_topics(self) -> List[List[Any]]:
+        """Return the [id, topic] pairs defined since the last call, for the block index."""
+        start = self.indexed_topics
+        self.indexed_topics = len(self.topics)
+        return [[start + i, topic] for i, topic in enumerate(self.topics[start:])]
+    
+    def _define(self, out: bytearray, value: str) -> int:
+        """Assign the next dictionary ID to a string and emit its definition."""
+        value_id = len(self.topic_ids)
+        self.topic_ids[value] = value_id
+        self.topics.append(value)
+        definition = bytes((RECORD_TOPIC,)) + encode_varint(value_id) + value.encode('utf-8')
+        out += encode_varint(len(definition))
+        out += definition
+        return value_id
+    
+    def encode(self, messages: List[Dict[str, Any]], payload_store: Optional["PayloadStore"] = None) -> bytes:
+        """Serialize a batch of messages, referencing repeated payloads in the payload store."""
+        out = bytearray()
+        topic_ids = self.topic_ids
+        anchor = self.wall_anchor_ns
+        for msg in messages:
+            if is_gap_record(msg):
+                dropped = json_dumps(msg["dropped"])
+                out += encode_varint(_RECORD_HEADER.size + len(dropped))
+                out += _RECORD_HEADER.pack(RECORD_GAP, msg["timestamp_ns"] - anchor)
+                out += dropped
+                continue
+            
+            topic = msg["topic"]
+            topic_id = topic_ids.get(topic)
+            if topic_id is None:
+                topic_id = self._define(out, topic)
+            
+            payload = msg["payload"]
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            topic_ref = encode_varint(topic_id)
+            
+            if self.numeric and not msg.get("properties"):
+                decimal = parse_decimal(payload)
+                if decimal is not None:
+                    self._encode_numeric(out, msg, topic_ref, topic_id, decimal)
+                    continue
+            
+            flags = msg.get("qos", 0) & FLAG_QOS_MASK
+            if msg.get("retain"):
+                flags |= FLAG_RETAIN
+            if msg.get("dup"):
+                flags |= FLAG_DUP
+            source = msg.get("source")
+            if source is not None:
+                flags |= FLAG_SOURCE
+                source_id = topic_ids.get(source)
+                if source_id is None:
+                    source_id = self._define(out, source)
+                topic_ref += encode_varint(source_id)
+            properties = encode_properties(msg.get("properties"))
+            if properties:
+                flags |= FLAG_PROPERTIES
+                properties_json = json_dumps(properties)
+                topic_ref += encode_varint(len(properties_json)) + properties_json
+            if payload_store is not None:
+                payload_offset = payload_store.reference(payload)
+                if payload_offset is not None:
+                    flags |= FLAG_PAYLOAD_REF
+                    payload = encode_varint(payload_offset) + encode_varint(len(payload))
+            
+            out += encode_varint(_FLAGS_RECORD_HEADER.size + len(topic_ref) + len(payload))
+            out += _FLAGS_RECORD_HEADER.pack(RECORD_MESSAGE_FLAGS, msg["timestamp_ns"] - anchor, flags)
+            out += topic_ref
+            out += payload
+        return bytes(out)
+    
+    def _encode_numeric(self, out: bytearray, msg: Dict[str, Any], topic_ref: bytes, topic_id: int,
+                        decimal: Tuple[int, int]):
+        """Append a decimal payload as a numeric record relative to the topic's previous one."""
+        mantissa, scale = decimal
+        state = self.numeric_state.get(topic_id)
+        if state is None:
+            state = self.numeric_state[topic_id] = [0, 0, 0, 0]
+        previous_offset, previous_delta, previous_mantissa, previous_scale = state
+        
+        flags = msg.get("qos", 0) & FLAG_QOS_MASK
+        if msg.get("retain"):
+            flags |= FLAG_RETAIN
+        if msg.get("dup"):
+            flags |= FLAG_DUP
+        source = msg.get("source")
+        if source is not None:
+            flags |= FLAG_SOURCE
+            source_id = self.topic_ids.get(source)
+            if source_id is None:
+                source_id = self._define(out, source)
+            topic_ref += encode_varint(source_id)
+        if scale != previous_scale:
+            flags |= FLAG_NUMERIC_SCALE
+            topic_ref += bytes((scale,))
+        
+        offset = msg["timestamp_ns"] - self.wall_anchor_ns
+        delta = offset - previous_offset
+        values = encode_varint(zigzag(delta - previous_delta)) + encode_varint(zigzag(mantissa - previous_mantissa))
+        state[0], state[1], state[2], state[3] = offset, delta, mantissa, scale
+        
+        out += encode_varint(2 + len(topic_ref) + len(values))
+        out.append(RECORD_NUMERIC)
+        out.append(flags)
+        out += topic_ref
+        out += values
+
+
+def make_codec(storage_config: Dict[str, Any], wall_anchor_ns: Optional[int] = None):
+    """Build the codec selected by the storage.format config option."""
+    recording_format = storage_config.get("format", "json")
+    if recording_format == "json":
+        return JsonLinesCodec(storage_config.get("payload_encoding", "text"))
+    if recording_format == "binary":
+        return BinaryCodec(wall_anchor_ns, numeric=storage_config.get("numeric_encoding", False))
+    raise ValueError(f"Unknown recording format: {recording_format} (expected json or binary)")
+
+
+class GzipCompressor:
+    """Compresses each block as an independent gzip member."""
+    
+    name = "gzip"
+    extension = ".gz"
+    
+    def __init__(self, level: int = 6):
+        """Initialize the compressor with a gzip compression level."""
+        self.level = level
+    
+    def compress(self, data: bytes) -> bytes:
+        """Compress one block."""
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+
+class ZstdCompressor:
+    """Compresses each block as an independent zstd frame."""
+    
+    name = "zstd"
+    extension = ".zst"
+    
+    def __init__(self, level: int = 3):
+        """Initialize the compressor with a zstd compression level."""
+        self._compressor = zstandard.ZstdCompressor(level=level)
+    
+    def compress(self, data: bytes) -> bytes:
+        """Compress one block."""
+        return self._compressor.compress(data)
+
+
+def make_compressor(storage_config: Dict[str, Any]):
+    """Build the block compressor selected by storage.compression, None when disabled."""
+    compression = storage_config.get("compression", "none")
+    level = storage_config.get("compression_level")
+    
+    if compression == "none":
+        return None
+    if compression == "zstd":
+        if zstandard is not None:
+            return ZstdCompressor(level if level is not None else 3)
+        logging.warning("zstandard is not installed, falling back to gzip compression")
+        compression = "gzip"
+    if compression == "gzip":
+        return GzipCompressor(level if level is not None else 6)
+    raise ValueError(f"Unknown compression: {compression} (expected none, gzip or zstd)")
+
+
+def _detect_compression(file: BinaryIO) -> Optional[str]:
+    """Detect a compressed recording from its first bytes and rewind the file."""
+    magic = file.read(len(ZSTD_MAGIC))
+    file.seek(0)
+    
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("Recording is zstd compressed but zstandard is not installed")
+        return "zstd"
+    return None
+
+
+def _decompressed_stream(file: BinaryIO, compression: Optional[str]) -> BinaryIO:
+    """Wrap a file positioned at a block boundary in a streaming decompressor."""
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    if compression == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True, closefd=False)
+        return io.BufferedReader(reader, READ_CHUNK_SIZE)
+    return file
+
+
+def payload_store_path(path: str) -> str:
+    """Return the path of the payload store of a binary recording."""
+    return path + PAYLOAD_STORE_SUFFIX
+
+
+class PayloadStore:
+    """Append-only side file that holds repeated payloads once, addressed by offset.
+    
+    A payload stays inline the first time it is seen. From its second
+    occurrence on it is written to the store once and messages reference
+    it by offset and length. Seen payloads are tracked by a 128-bit BLAKE2b
+    digest in a bounded LRU index, so memory stays flat on long captures.
+    """
+    
+    def __init__(self, path: str, min_size: int = 16, max_entries: int = 100000):
+        """Initialize the store; the file is created on the first stored payload."""
+        self.path = path
+        self.min_size = min_size
+        self.max_entries = max_entries
+        self.file = None
+        
+        # Digest -> offset in the store, None while a payload was seen only once
+        self.index: "collections.OrderedDict[bytes, Optional[int]]" = collections.OrderedDict()
+        
+        # Statistics
+        self.stored_bytes = 0
+        self.referenced_bytes = 0
+    
+    def reference(self, payload: bytes) -> Optional[int]:
+        """Return the store offset to reference a payload by, None to keep it inline."""
+        if len(payload) < self.min_size:
+            return None
+        
+        digest = hashlib.blake2b(payload, digest_size=16).digest()
+        index = self.index
+        if digest not in index:
+            index[digest] = None
+            if len(index) > self.max_entries:
+                index.popitem(last=False)
+            return None
+        
+        index.move_to_end(digest)
+        offset = index[digest]
+        if offset is None:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+            offset = self.file.tell()
+            self.file.write(payload)
+            index[digest] = offset
+            self.stored_bytes += len(payload)
+        self.referenced_bytes += len(payload)
+        return offset
+    
+    def flush(self):
+        """Hand stored payloads to the OS; call before writing records referencing them."""
+        if self.file is not None:
+            self.file.flush()
+    
+    def sync(self):
+        """Flush and fsync the store."""
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    
+    def close(self):
+        """Close the store file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class PayloadStoreReader:
+    """Reads payloads from a payload store through a bounded LRU cache."""
+    
+    def __init__(self, path: str, cache_size: int = PAYLOAD_CACHE_SIZE):
+        """Open the store for random access reads."""
+        self.fd = os.open(path, os.O_RDONLY)
+        self.cache_size = cache_size
+        self.cache: "collections.OrderedDict[int, bytes]" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, offset: int, length: int) -> bytes:
+        """Return the payload stored at an offset."""
+        cache = self.cache
+        payload = cache.get(offset)
+        if payload is not None:
+            cache.move_to_end(offset)
+            self.hits += 1
+            return payload
+        
+        payload = os.pread(self.fd, length, offset)
+        if len(payload) != length:
+            raise ValueError(f"Payload store is truncated at offset {offset}")
+        self.misses += 1
+        cache[offset] = payload
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return payload
+    
+    def close(self):
+        """Close the store file."""
+        os.close(self.fd)
+
+
+def block_index_path(path: str) -> str:
+    """Return the path of the block index for a compressed recording."""
+    return path + BLOCK_INDEX_SUFFIX
+
+
+def read_block_index(path: str) -> List[Dict[str, Any]]:
+    """Load the block index of a compressed recording, empty if it has none."""
+    index_path = block_index_path(path)
+    if not os.path.exists(index_path):
+        return []
+    
+    blocks = []
+    with open(index_path, "r", encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                blocks.append(json.loads(line))
+    return blocks
+
+
+def write_block_index(path: str, blocks: List[Dict[str, Any]]):
+    """Atomically replace the block index of a recording."""
+    temp_path = block_index_path(path) + ".tmp"
+    with open(temp_path, "w", encoding='utf-8') as file:
+        for block in blocks:
+            file.write(json.dumps(block) + "\n")
+    os.replace(temp_path, block_index_path(path))
+
+
+def recount_last_block(path: str):
+    """Count the messages of an uncompressed recording's last block again.
+    
+    After a crash the data written after the last index entry has no entry
+    of its own; its messages are added to the last entry, which keeps
+    message offsets right and time seeks on the safe side.
+    """
+    blocks = read_block_index(path)
+    if not blocks:
+        return
+    messages = sum(1 for _ in read_messages(path, len(blocks) - 1))
+    if messages != blocks[-1]["messages"]:
+        blocks[-1]["messages"] = messages
+        write_block_index(path, blocks)
+
+
+def _read_json_lines(file: BinaryIO) -> Iterator[Dict[str, Any]]:
+    """Read messages from a JSON Lines recording."""
+    for line_num, line in enumerate(file, 1):
+        line = line.strip()
+        if not line:
+            continue
+        
+        try:
+            yield decode_json_record(json_loads(line))
+        except ValueError as e:
+            logging.warning(f"Invalid JSON on line {line_num}: {e}")
+            continue
+
+
+def _read_binary_header(file: BinaryIO) -> Dict[str, Any]:
+    """Read the binary file header and return its metadata."""
+    header = file.read(len(BINARY_MAGIC) + 1)
+    if header[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a binary MQTT recording")
+    if header[-1] > BINARY_VERSION:
+        raise ValueError(f"Unsupported binary recording version {header[-1]}")
+    
+    length_bytes = bytearray()
+    while True:
+        byte = file.read(1)
+        if not byte:
+            raise ValueError("Truncated binary recording header")
+        length_bytes += byte
+        if byte[0] < 0x80:
+            break
+    
+    metadata_length, _ = decode_varint(length_bytes, 0)
+    metadata = json.loads(file.read(metadata_length))
+    metadata["version"] = header[-1]
+    return metadata
+
+
+def _read_binary(file: BinaryIO, metadata: Optional[Dict[str, Any]] = None,
+                 payloads: Optional[PayloadStoreReader] = None,
+                 topics: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+    """Read messages from a binary recording in constant memory.
+    
+    When metadata is given the file is positioned after the header, e.g. at
+    a block boundary. payloads resolves payload references. topics is the
+    topic dictionary in effect at a block boundary of an index built
+    offline, where blocks do not define their own topics.
+    """
+    if metadata is None:
+        metadata = _read_binary_header(file)
+    anchor = metadata.get("wall_anchor_ns", 0)
+    buffer = file.read(READ_CHUNK_SIZE)
+    pos = 0
+    
+    # Topic dictionary, indexed by topic ID
+    topics = list(topics or [])
+    
+    # Numeric record state, indexed by topic ID like the dictionary: previous
+    # offset, offset delta, mantissa and scale
+    numeric_offsets = [0] * len(topics)
+    numeric_deltas = [0] * len(topics)
+    numeric_mantissas = [0] * len(topics)
+    numeric_scales = [0] * len(topics)
+    decimals: Dict[int, bytes] = {}
+    
+    # Hot loop lookups bound to locals
+    decode = decode_varint
+    unpack_flags_header = _FLAGS_RECORD_HEADER.unpack_from
+    flag_fields = _MESSAGE_FLAG_FIELDS
+    
+    while True:
+        end = len(buffer)
+        while pos < end:
+            # Most records are shorter than 128 bytes: one length byte
+            length = buffer[pos]
+            if length < 0x80:
+                body = pos + 1
+            else:
+                try:
+                    length, body = decode(buffer, pos)
+                except IndexError:
+                    break
+            record_end = body + length
+            if record_end > end:
+                break
+            
+            kind = buffer[body]
+            if kind == RECORD_MESSAGE_FLAGS:
+                _, offset_ns, flags = unpack_flags_header(buffer, body)
+                payload_start = body + _FLAGS_RECORD_HEADER.size
+                topic_id = buffer[payload_start]
+                if topic_id < 0x80:
+                    payload_start += 1
+                else:
+                    topic_id, payload_start = decode(buffer, payload_start)
+                qos, retain, dup = flag_fields[flags & _MESSAGE_FLAG_FIELDS_MASK]
+                if not flags & (FLAG_SOURCE | FLAG_PROPERTIES | FLAG_PAYLOAD_REF):
+                    yield {
+                        "topic": topics[topic_id],
+                        "timestamp_ns": anchor + offset_ns,
+                        "qos": qos,
+                        "retain": retain,
+                        "dup": dup,
+                        "payload": buffer[payload_start:record_end],
+                    }
+                    pos = record_end
+                    continue
+                
+                message = {
+                    "topic": topics[topic_id],
+                    "timestamp_ns": anchor + offset_ns,
+                    "qos": qos,
+                    "retain": retain,
+                    "dup": dup,
+                }
+                if flags & FLAG_SOURCE:
+                    source_id, payload_start = decode(buffer, payload_start)
+                    message["source"] = topics[source_id]
+                if flags & FLAG_PROPERTIES:
+                    properties_length, properties_start = decode(buffer, payload_start)
+                    payload_start = properties_start + properties_length
+                    message["properties"] = decode_properties(
+                        json_loads(buffer[properties_start:payload_start])
+                    )
+                if flags & FLAG_PAYLOAD_REF:
+                    if payloads is None:
+                        raise ValueError("Recording references a payload store that does not exist")
+                    payload_offset, payload_start = decode(buffer, payload_start)
+                    payload_length, _ = decode(buffer, payload_start)
+                    message["payload"] = payloads.get(payload_offset, payload_length)
+                else:
+                    message["payload"] = buffer[payload_start:record_end]
+                yield message
+            elif kind == RECORD_NUMERIC:
+                flags = buffer[body + 1]
+                value_start = body + 2
+                topic_id = buffer[value_start]
+                if topic_id < 0x80:
+                    value_start += 1
+                else:
+                    topic_id, value_start = decode(buffer, value_start)
+                source_id = None
+                if flags & FLAG_SOURCE:
+                    source_id, value_start = decode(buffer, value_start)
+                if flags & FLAG_NUMERIC_SCALE:
+                    numeric_scales[topic_id] = buffer[value_start]
+                    value_start += 1
+                
+                # Both zigzag varints are usually one byte; unzigzag() inlined
+                delta_of_delta = buffer[value_start]
+                if delta_of_delta < 0x80:
+                    value_start += 1
+                else:
+                    delta_of_delta, value_start = decode(buffer, value_start)
+                mantissa_delta = buffer[value_start]
+                if mantissa_delta >= 0x80:
+                    mantissa_delta, _ = decode(buffer, value_start)
+                delta = numeric_deltas[topic_id] + ((delta_of_delta >> 1) ^ -(delta_of_delta & 1))
+                numeric_deltas[topic_id] = delta
+                offset_ns = numeric_offsets[topic_id] + delta
+                numeric_offsets[topic_id] = offset_ns
+                mantissa = numeric_mantissas[topic_id] + ((mantissa_delta >> 1) ^ -(mantissa_delta & 1))
+                numeric_mantissas[topic_id] = mantissa
+                
+                # Sensor values repeat, so their payload bytes are formatted once
+                key = (mantissa << 8) | numeric_scales[topic_id]
+                payload = decimals.get(key)
+                if payload is None:
+                    payload = format_decimal(mantissa, numeric_scales[topic_id])
+                    if len(decimals) < DECIMAL_CACHE_SIZE:
+                        decimals[key] = payload
+                
+                qos, retain, dup = flag_fields[flags & _MESSAGE_FLAG_FIELDS_MASK]
+                message = {
+                    "topic": topics[topic_id],
+                    "timestamp_ns": anchor + offset_ns,
+                    "qos": qos,
+                    "retain": retain,
+                    "dup": dup,
+                    "payload": payload,
+                }
+                if source_id is not None:
+                    message["source"] = topics[source_id]
+                yield message
+            elif kind == RECORD_GAP:
+                _, offset_ns = _RECORD_HEADER.unpack_from(buffer, body)
+                yield {
+                    "timestamp_ns": anchor + offset_ns,
+                    "dropped": json_loads(buffer[body + _RECORD_HEADER.size:record_end]),
+                }
+            elif kind == RECORD_MESSAGE_OFFSET:
+                # Version 3 records have no QoS, retain or properties
+                _, offset_ns = _RECORD_HEADER.unpack_from(buffer, body)
+                topic_id, payload_start = decode(buffer, body + _RECORD_HEADER.size)
+                yield {
+                    "topic": topics[topic_id],
+                    "payload": buffer[payload_start:record_end],
+                    "timestamp_ns": anchor + offset_ns,
+                }
+            elif kind == RECORD_MESSAGE_REF:
+                # Version 2 records carry an absolute int64 timestamp
+                _, timestamp_ns = _RECORD_HEADER.unpack_from(buffer, body)
+                topic_id, payload_start = decode(buffer, body + _RECORD_HEADER.size)
+                yield {
+                    "topic": topics[topic_id],
+                    "payload": buffer[payload_start:record_end],
+                    "timestamp_ns": timestamp_ns,
+                }
+            elif kind == RECORD_BLOCK:
+                count = len(topics)
+                numeric_offsets = [0] * count
+                numeric_deltas = [0] * count
+                numeric_mantissas = [0] * count
+                numeric_scales = [0] * count
+            elif kind == RECORD_TOPIC:
+                topic_id, topic_start = decode(buffer, body + 1)
+                topic = buffer[topic_start:record_end].decode('utf-8')
+                if topic_id < len(topics):
+                    topics[topic_id] = topic
+                    numeric_offsets[topic_id] = numeric_deltas[topic_id] = 0
+                    numeric_mantissas[topic_id] = numeric_scales[topic_id] = 0
+                else:
+                    topics.append(topic)
+                    numeric_offsets.append(0)
+                    numeric_deltas.append(0)
+                    numeric_mantissas.append(0)
+                    numeric_scales.append(0)
+            elif kind == RECORD_MESSAGE:
+                # Version 1 records carry the topic inline
+                _, timestamp_ns = _RECORD_HEADER.unpack_from(buffer, body)
+                topic_length, topic_start = decode(buffer, body + _RECORD_HEADER.size)
+                payload_start = topic_start + topic_length
+                yield {
+                    "topic": buffer[topic_start:payload_start].decode('utf-8'),
+                    "payload": buffer[payload_start:record_end],
+                    "timestamp_ns": timestamp_ns,
+                }
+            pos = record_end
+        
+        chunk = file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer = buffer[pos:] + chunk
+        pos = 0
+    
+    if pos < len(buffer):
+        logging.warning(f"Ignoring {len(buffer) - pos} bytes of truncated record at end of file")
+
+
+def read_messages(path: str, start_block: int = 0,
+                  payload_cache_size: int = PAYLOAD_CACHE_SIZE) -> Iterator[Dict[str, Any]]:
+    """Read messages from a recording, detecting its format from the first bytes.
+    
+    For recordings with a block index, start_block selects the block to
+    start reading (and decompressing) at without reading the blocks before it.
+    A manifest path replays every segment of the session in order.
+    Payloads kept in a payload store are read through an LRU cache of
+    payload_cache_size entries.
+    """
+    if is_manifest(path):
+        for segment in read_manifest(path):
+            yield from read_messages(segment["path"], payload_cache_size=payload_cache_size)
+        return
+    
+    with open(path, "rb") as file:
+        compression = _detect_compression(file)
+        stream = _decompressed_stream(file, compression)
+        binary = stream.peek(len(BINARY_MAGIC))[:len(BINARY_MAGIC)] == BINARY_MAGIC
+        metadata = None
+        topics: List[str] = []
+        
+        if start_block:
+            # The header with the time anchor is only at the start of the file
+            if binary:
+                metadata = _read_binary_header(stream)
+            blocks = read_block_index(path)
+            if start_block >= len(blocks):
+                raise ValueError(f"Recording {path} has no block {start_block} to seek to")
+            for block in blocks[:start_block + 1]:
+                for topic_id, topic in block.get("topics", ()):
+                    if topic_id < len(topics):
+                        topics[topic_id] = topic
+                    else:
+                        topics.append(topic)
+            file.seek(blocks[start_block]["offset"])
+            stream = _decompressed_stream(file, compression)
+        
+        if binary:
+            payloads = None
+            if os.path.exists(payload_store_path(path)):
+                payloads = PayloadStoreReader(payload_store_path(path), payload_cache_size)
+            try:
+                yield from _read_binary(stream, metadata, payloads, topics)
+            finally:
+                if payloads is not None:
+                    payloads.close()
+        else:
+            yield from _read_json_lines(stream)
+
+
+def is_manifest(path: str) -> bool:
+    """Return True if the path is a segmented recording manifest."""
+    return path.endswith(MANIFEST_EXTENSION)
+
+
+def read_manifest(path: str) -> List[Dict[str, Any]]:
+    """Load the segments of a segmented recording, with paths resolved next to the manifest."""
+    with open(path, "r", encoding='utf-8') as file:
+        manifest = json.load(file)
+    
+    dir_path = os.path.dirname(path)
+    segments = manifest["segments"]
+    for segment in segments:
+        segment["path"] = os.path.join(dir_path, segment["path"])
+    return segments
+
+
+def remove_recording(path: str):
+    """Delete a recording with its block index and payload store, or a manifest with all its segments."""
+    paths = [path]
+    if is_manifest(path):
+        paths += [segment["path"] for segment in read_manifest(path)]
+    
+    for file_path in paths:
+        for candidate in (file_path, block_index_path(file_path), payload_store_path(file_path)):
+            if os.path.exists(candidate):
+                os.remove(candidate)
+
+
+def recording_number(path: str) -> Optional[int]:
+    """Return N for a mqtt_record_N.<ext> file name, None for other files."""
+    filename = os.path.basename(path)
+    name, ext = os.path.splitext(filename)
+    if ext in COMPRESSION_EXTENSIONS:
+        name, ext = os.path.splitext(name)
+    if not filename.startswith(RECORDING_PREFIX) or ext not in RECORDING_EXTENSIONS:
+        return None
+    number_str = name[len(RECORDING_PREFIX):]
+    return int(number_str) if number_str.isdigit() else None
+
+
+def find_recordings(dir_path: str = ".") -> List[str]:
+    """Return all recording files in a directory, ordered by recording number."""
+    recordings = [
+        path for path in glob.glob(os.path.join(dir_path, f"{RECORDING_PREFIX}*"))
+        if recording_number(path) is not None
+    ]
+    recordings.sort(key=recording_number)
+    return recordings
+
+
+class DurabilityPolicy:
+    """Decides when buffered recording data is fsynced to disk."""
+    
+    MODES = ("never", "messages", "interval", "on_rotate")
+    
+    def __init__(self, mode: str = "never", every_messages: int = 1000, every_ms: int = 1000):
+        """Initialize the policy with a mode and its threshold."""
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown durability mode: {mode} (expected one of {', '.join(self.MODES)})")
+        
+        self.mode = mode
+        self.every_messages = every_messages
+        self.every_ms = every_ms
+    
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> "DurabilityPolicy":
+        """Build a policy from the storage.durability config section."""
+        config = config or {}
+        return cls(
+            mode=config.get("mode", "never"),
+            every_messages=config.get("every_messages", 1000),
+            every_ms=config.get("every_ms", 1000)
+        )
+    
+    def should_sync(self, unsynced_messages: int, last_sync: float) -> bool:
+        """Return True when the data written since the last sync must be fsynced."""
+        if self.mode == "messages":
+            return unsynced_messages >= self.every_messages
+        if self.mode == "interval":
+            return (time.monotonic() - last_sync) * 1000 >= self.every_ms
+        return False
+    
+    def sync_on_close(self) -> bool:
+        """Return True when the file must be fsynced before it is closed."""
+        return self.mode != "never"
+
+
+class FlushController:
+    """Triggers flushes on message count, byte volume or age and tunes the batch size."""
+    
+    def __init__(self, batch_size: int = 1000, max_bytes: int = 4 * 1024 * 1024,
+                 max_age_ms: int = 1000, target_write_ms: float = 20.0,
+                 min_batch_size: int = 100, max_batch_size: int = 100000,
+                 adaptive: bool = True):
+        """Initialize the controller with flush triggers and tuning bounds."""
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age_ms / 1000
+        self.target_write_ms = target_write_ms
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.adaptive = adaptive
+        
+        # Pending (not yet flushed) data
+        self.pending_messages = 0
+        self.pending_bytes = 0
+        self.oldest_pending = 0.0
+        
+        # Smoothed write cost per message in milliseconds
+        self.write_cost_ms: Optional[float] = None
+    
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> "FlushController":
+        """Build a controller from the storage.flush config section."""
+        config = config or {}
+        return cls(
+            batch_size=config.get("batch_size", 1000),
+            max_bytes=config.get("max_bytes", 4 * 1024 * 1024),
+            max_age_ms=config.get("max_age_ms", 1000),
+            target_write_ms=config.get("target_write_ms", 20.0),
+            min_batch_size=config.get("min_batch_size", 100),
+            max_batch_size=config.get("max_batch_size", 100000),
+            adaptive=config.get("adaptive", True)
+        )
+    
+    def add(self, size: int):
+        """Account for one more buffered message of the given size in bytes."""
+        if self.pending_messages == 0:
+            self.oldest_pending = time.monotonic()
+        self.pending_messages += 1
+        self.pending_bytes += size
+    
+    def should_flush(self) -> bool:
+        """Return True when count, bytes or age of the pending data hits its limit."""
+        if self.pending_messages == 0:
+            return False
+        return (
+            self.pending_messages >= self.batch_size
+            or self.pending_bytes >= self.max_bytes
+            or time.monotonic() - self.oldest_pending >= self.max_age
+        )
+    
+    def time_until_due(self) -> Optional[float]:
+        """Return seconds until the pending data becomes too old, None if nothing is pending."""
+        if self.pending_messages == 0:
+            return None
+        return max(0.0, self.max_age - (time.monotonic() - self.oldest_pending))
+    
+    def take(self) -> int:
+        """Reset the pending counters and return how many messages were pending."""
+        count = self.pending_messages
+        self.pending_messages = 0
+        self.pending_bytes = 0
+        return count
+    
+    def record_flush(self, elapsed: float, count: Optional[int] = None):
+        """Reset pending counters and retune the batch size from the observed write time.
+        
+        count is the size of a batch handed off earlier with take(); without
+        it the currently pending messages make up the batch.
+        """
+        if count is None:
+            count = self.take()
+        
+        if not self.adaptive or count == 0:
+            return
+        
+        # Size batches so one write takes about target_write_ms
+        cost_ms = elapsed * 1000 / count
+        if self.write_cost_ms is None:
+            self.write_cost_ms = cost_ms
+        else:
+            self.write_cost_ms = 0.8 * self.write_cost_ms + 0.2 * cost_ms
+        
+        ideal = int(self.target_write_ms / max(self.write_cost_ms, 1e-6))
+        self.batch_size = min(self.max_batch_size, max(self.min_batch_size, ideal))
+
+
+class RecordingFile:
+    """Append-only recording file kept open for the whole recording session."""
+    
+    def __init__(self, path: str, durability: Optional[DurabilityPolicy] = None,
+                 buffer_size: int = 1024 * 1024, codec=None, compressor=None,
+                 block_size: int = 1024 * 1024, block_max_age_ms: int = 10000,
+                 dedup: Optional[Dict[str, Any]] = None,
+                 on_persist: Optional[Callable[[List[int]], None]] = None,
+                 time_index: bool = True):
+        """Initialize the recording file; it is opened on the first write.
+        
+        With time_index, uncompressed recordings are also split into blocks
+        of about block_size bytes that are listed in the block index, so
+        replay can seek to a time or message offset. Unlike compressed
+        blocks they share one topic dictionary, the index lists the topics
+        each block needs.
+        dedup is a storage.dedup config section; when enabled, repeated
+        payloads of binary recordings go to a payload store next to the file.
+        on_persist is called with the timestamps of written messages once
+        they are persisted: handed to the OS in durability mode never (after
+        their compressed block is written), fsynced in every other mode.
+        """
+        self.path = path
+        self.durability = durability or DurabilityPolicy()
+        self.codec = codec or JsonLinesCodec()
+        self.buffer_size = buffer_size
+        self.file = None
+        
+        # Payload deduplication, only the binary format can reference payloads
+        self.payload_store = None
+        if dedup and dedup.get("enabled", False) and self.codec.name == "binary":
+            self.payload_store = PayloadStore(
+                payload_store_path(path),
+                min_size=dedup.get("min_size", 16),
+                max_entries=dedup.get("max_entries", 100000)
+            )
+        
+        # Block compression: encoded data is collected into independent blocks
+        self.compressor = compressor
+        self.block_size = block_size
+        self.block_max_age = block_max_age_ms / 1000
+        self.index_file = None
+        self._block = bytearray()
+        self._block_messages = 0
+        self._block_first_timestamp = None
+        self._block_started = 0.0
+        self.time_index = time_index and compressor is None
+        self._block_offset = None
+        self._block_topics = None
+        
+        # Timestamps of written messages waiting to be persisted
+        self.on_persist = on_persist
+        self._unpersisted: List[int] = []
+        
+        # Write statistics
+        self.message_count = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.topics: Set[str] = set()
+        self.opened_at = None
+        self.sync_count = 0
+        self._unsynced_messages = 0
+        self._last_sync = time.monotonic()
+    
+    def _open(self):
+        """Open the file in append mode with a large write buffer."""
+        self.file = open(self.path, "ab", buffering=self.buffer_size)
+        self.opened_at = time.monotonic()
+        self.codec.reset()
+        if self.file.tell() == 0:
+            self._write_data(self.codec.header())
+        elif self.time_index:
+            if os.path.exists(block_index_path(self.path)):
+                recount_last_block(self.path)
+            else:
+                # Blocks appended to a recording without an index would miscount
+                self.time_index = False
+    
+    def _write_data(self, data: bytes):
+        """Write encoded data directly, or into the pending compressed block."""
+        if self.compressor is None:
+            self.file.write(data)
+            return
+        
+        if not self._block:
+            self._block_started = time.monotonic()
+        self._block += data
+        if (len(self._block) >= self.block_size
+                or time.monotonic() - self._block_started >= self.block_max_age):
+            self._write_block()
+    
+    def _write_block(self):
+        """Compress the pending block, append it and record it in the block index."""
+        if not self._block:
+            return
+        
+        offset = self.file.tell()
+        self.file.write(self.compressor.compress(bytes(self._block)))
+        self._block = bytearray()
+        
+        # Each block carries its own topic dictionary so it can be read on its own
+        self.codec.reset()
+        self._end_block(offset)
+    
+    def _end_block(self, offset: int):
+        """List the finished block at offset in the block index and start a new one."""
+        entry = {
+            "offset": offset,
+            "messages": self._block_messages,
+            "first_timestamp": self._block_first_timestamp,
+        }
+        if self._block_topics:
+            entry["topics"] = self._block_topics
+        
+        if self.index_file is None:
+            self.index_file = open(block_index_path(self.path), "a", encoding='utf-8')
+        self.index_file.write(json.dumps(entry) + "\n")
+        self.index_file.flush()
+        
+        self._block_offset = None
+        self._block_topics = None
+        self._block_messages = 0
+        self._block_first_timestamp = None
+    
+    def write(self, messages: List[Dict[str, Any]]):
+        """Append a batch of messages and apply the durability policy."""
+        if self.file is None:
+            self._open()
+        
+        if self.compressor is not None or self.time_index:
+            if self._block_first_timestamp is None:
+                self._block_first_timestamp = messages[0]["timestamp_ns"] / 1e9
+                self._block_offset = self.file.tell()
+                if self.time_index:
+                    # Topics defined before the block are listed in its index entry
+                    self._block_topics = self.codec.new_topics()
+                    self.file.write(self.codec.start_block())
+            self._block_messages += len(messages)
+        self._write_data(self.codec.encode(messages, self.payload_store))
+        
+        if self.first_timestamp is None:
+            self.first_timestamp = messages[0]["timestamp_ns"] / 1e9
+        self.last_timestamp = messages[-1]["timestamp_ns"] / 1e9
+        self.topics.update(message["topic"] for message in messages if "topic" in message)
+        
+        # Hand the batch to the OS so it survives a process crash, with the
+        # payloads it references first
+        if self.payload_store is not None:
+            self.payload_store.flush()
+        self.file.flush()
+        if self.time_index and self.file.tell() - self._block_offset >= self.block_size:
+            self._end_block(self._block_offset)
+        
+        if self.on_persist is not None:
+            self._unpersisted.extend(message["timestamp_ns"] for message in messages if "topic" in message)
+            if self.durability.mode == "never" and not self._block:
+                self._persisted()
+        
+        self.message_count += len(messages)
+        self._unsynced_messages += len(messages)
+        if self.durability.should_sync(self._unsynced_messages, self._last_sync):
+            self.sync()
+    
+    def _persisted(self):
+        """Report the messages written so far as persisted."""
+        if self._unpersisted:
+            timestamps, self._unpersisted = self._unpersisted, []
+            self.on_persist(timestamps)
+    
+    @property
+    def buffered(self) -> bool:
+        """True while written messages are still held in memory in an unfinished block."""
+        return bool(self._block)
+    
+    @property
+    def size(self) -> int:
+        """Bytes written to the file so far."""
+        if self.file is None:
+            return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return self.file.tell()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return the message count, time range, topic count and size of what was written."""
+        return {
+            "messages": self.message_count,
+            "first_timestamp": self.first_timestamp,
+            "last_timestamp": self.last_timestamp,
+            "topics": len(self.topics),
+            "bytes": self.size,
+        }
+    
+    def sync(self):
+        """Flush buffered data and fsync it to disk."""
+        if self.file is None:
+            return
+        
+        self._write_block()
+        if self.payload_store is not None:
+            self.payload_store.sync()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.index_file is not None:
+            os.fsync(self.index_file.fileno())
+        if self.on_persist is not None:
+            self._persisted()
+        self.sync_count += 1
+        self._unsynced_messages = 0
+        self._last_sync = time.monotonic()
+    
+    def close(self):
+        """Flush, optionally fsync, and close the file."""
+        if self.file is None:
+            return
+        
+        self._write_block()
+        if self.time_index and self._block_offset is not None:
+            self._end_block(self._block_offset)
+        if self.durability.sync_on_close():
+            self.sync()
+        if self.payload_store is not None:
+            self.payload_store.close()
+        self.file.close()
+        self.file = None
+        if self.on_persist is not None:
+            self._persisted()
+        
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+
+class SegmentedRecording:
+    """Recording session split into segments rolled on size or duration, tracked by a manifest."""
+    
+    def __init__(self, manifest_path: str, segment_extension: str,
+                 make_segment: Callable[[str], RecordingFile],
+                 max_bytes: int = 0, max_duration_s: float = 0):
+        """Initialize the session; segments are created on the first write."""
+        self.path = manifest_path
+        self.segment_extension = segment_extension
+        self.make_segment = make_segment
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration_s
+        
+        self.segments: List[Dict[str, Any]] = []
+        self.current: Optional[RecordingFile] = None
+        self.message_count = 0
+        self.topics: Set[str] = set()
+        self._closed_sync_count = 0
+    
+    @property
+    def sync_count(self) -> int:
+        """Number of fsyncs across all segments."""
+        return self._closed_sync_count + (self.current.sync_count if self.current else 0)
+    
+    @property
+    def buffered(self) -> bool:
+        """True while written messages are still held in memory by the current segment."""
+        return self.current is not None and self.current.buffered
+    
+    def _segment_path(self, number: int) -> str:
+        """Return the path of segment number N of this session."""
+        base = self.path[:-len(MANIFEST_EXTENSION)]
+        return f"{base}-{number:04d}{self.segment_extension}"
+    
+    def _open_segment(self):
+        """Start a new segment and list it in the manifest."""
+        path = self._segment_path(len(self.segments) + 1)
+        self.current = self.make_segment(path)
+        self.segments.append({"path": os.path.basename(path)})
+        self._update_segment_entry()
+        self._write_manifest()
+        logging.info(f"Recording segment: {path}")
+    
+    def _update_segment_entry(self):
+        """Refresh the manifest entry of the current segment from its statistics."""
+        self.segments[-1].update({
+            "first_timestamp": self.current.first_timestamp,
+            "last_timestamp": self.current.last_timestamp,
+            "messages": self.current.message_count,
+            "bytes": self.current.size,
+        })
+    
+    def _write_manifest(self):
+        """Atomically rewrite the manifest file."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as file:
+            json.dump({"segments": self.segments}, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+    
+    def _close_segment(self):
+        """Close the current segment and record its final statistics."""
+        self.current.close()
+        self._closed_sync_count += self.current.sync_count
+        self.topics |= self.current.topics
+        self._update_segment_entry()
+        self._write_manifest()
+        self.current = None
+    
+    def write(self, messages: List[Dict[str, Any]]):
+        """Append a batch to the current segment, rolling over when a limit is reached."""
+        if self.current is None:
+            self._open_segment()
+        
+        self.current.write(messages)
+        self.message_count += len(messages)
+        
+        if ((self.max_bytes and self.current.size >= self.max_bytes)
+                or (self.max_duration and time.monotonic() - self.current.opened_at >= self.max_duration)):
+            self._close_segment()
+    
+    def sync(self):
+        """Fsync the current segment."""
+        if self.current is not None:
+            self.current.sync()
+    
+    def close(self):
+        """Close the current segment and finalize the manifest."""
+        if self.current is not None:
+            self._close_segment()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return the message count, time range, topic count and size across all segments."""
+        if self.current is not None:
+            self._update_segment_entry()
+        topics = self.topics | self.current.topics if self.current is not None else self.topics
+        return {
+            "messages": self.message_count,
+            "first_timestamp": self.segments[0]["first_timestamp"] if self.segments else None,
+            "last_timestamp": self.segments[-1]["last_timestamp"] if self.segments else None,
+            "topics": len(topics),
+            "bytes": sum(segment.get("bytes", 0) for segment in self.segments),
+        }
+
+
+def _encode_compact_record(record: Dict[str, Any]) -> bytes:
+    """Serialize one message into a self-contained body for the journal or the ring."""
+    topic = record["topic"].encode('utf-8')
+    payload = record["payload"]
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    
+    flags = record.get("qos", 0) & FLAG_QOS_MASK
+    if record.get("retain"):
+        flags |= FLAG_RETAIN
+    if record.get("dup"):
+        flags |= FLAG_DUP
+    source = record.get("source")
+    source = source.encode('utf-8') if source is not None else b""
+    if source:
+        flags |= FLAG_SOURCE
+    extra = b""
+    properties = encode_properties(record.get("properties"))
+    if properties:
+        flags |= FLAG_PROPERTIES
+        properties_json = json_dumps(properties)
+        extra = encode_varint(len(properties_json)) + properties_json
+    
+    return b"".join((
+        _COMPACT_RECORD.pack(record["timestamp_ns"], flags, len(topic), len(source)),
+        topic, source, extra, payload,
+    ))
+
+
+def _decode_compact_record(body: bytes) -> Dict[str, Any]:
+    """Restore a message from a journal entry or ring body."""
+    timestamp_ns, flags, topic_length, source_length = _COMPACT_RECORD.unpack_from(body)
+    pos = _COMPACT_RECORD.size
+    message = {
+        "topic": body[pos:pos + topic_length].decode('utf-8'),
+        "timestamp_ns": timestamp_ns,
+        "qos": flags & FLAG_QOS_MASK,
+        "retain": bool(flags & FLAG_RETAIN),
+        "dup": bool(flags & FLAG_DUP),
+    }
+    pos += topic_length
+    if flags & FLAG_SOURCE:
+        message["source"] = body[pos:pos + source_length].decode('utf-8')
+    pos += source_length
+    if flags & FLAG_PROPERTIES:
+        properties_length, properties_start = decode_varint(body, pos)
+        pos = properties_start + properties_length
+        message["properties"] = decode_properties(json_loads(body[properties_start:pos]))
+    message["payload"] = body[pos:]
+    return message
+
+
+class Journal:
+    """Memory-mapped write-ahead journal of messages not yet persisted in the recording.
+    
+    Messages are appended before they are buffered and released with
+    checkpoint() once the recording has handed them to the OS, so after a
+    crash, even SIGKILL, the journal holds exactly the messages lost from
+    memory. Appends are memory copies into the page cache, without system
+    calls. Entries carry a sequence number and a CRC32; recovery reads from
+    the checkpointed head for as long as the sequence continues. When the
+    file fills up, the live entries are moved to the front if the space
+    before them is free, otherwise the file grows.
+    """
+    
+    def __init__(self, path: str, metadata: Dict[str, Any], size: int = 16 * 1024 * 1024):
+        """Create the journal file; metadata says which recording it belongs to."""
+        self.path = path
+        self.lock = threading.Lock()
+        
+        metadata_json = json.dumps(metadata).encode('utf-8')
+        if 28 + len(metadata_json) > JOURNAL_DATA_START:
+            raise ValueError("Journal metadata does not fit in the header")
+        size = max(size, 2 * JOURNAL_DATA_START)
+        
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.map[0:5] = JOURNAL_MAGIC + bytes((JOURNAL_VERSION,))
+        _JOURNAL_METADATA_LENGTH.pack_into(self.map, 24, len(metadata_json))
+        self.map[28:28 + len(metadata_json)] = metadata_json
+        
+        # Live entries are [head, tail); head_seq is the sequence number at head
+        self.head = self.tail = JOURNAL_DATA_START
+        self.head_seq = self.next_seq = 1
+        self._write_head()
+    
+    def _write_head(self):
+        """Persist the head offset and sequence number in the header."""
+        _JOURNAL_HEAD.pack_into(self.map, 8, self.head, self.head_seq)
+    
+    def _make_room(self, size: int):
+        """Compact or grow the journal so an entry of this size fits at the tail."""
+        live = self.tail - self.head
+        if (self.head - JOURNAL_DATA_START >= live
+                and JOURNAL_DATA_START + live + size <= len(self.map)):
+            # The old copy stays intact until the head points at the new one
+            self.map.move(JOURNAL_DATA_START, self.head, live)
+            self.head = JOURNAL_DATA_START
+            self._write_head()
+            self.tail = JOURNAL_DATA_START + live
+            return
+        
+        new_size = len(self.map)
+        while self.tail + size > new_size:
+            new_size *= 2
+        self.map.resize(new_size)
+    
+    def append(self, record: Dict[str, Any]) -> int:
+        """Append a message and return its sequence number."""
+        body = _encode_compact_record(record)
+        size = _JOURNAL_ENTRY.size + len(body)
+        with self.lock:
+            if self.tail + size > len(self.map):
+                self._make_room(size)
+            
+            # Body first: the entry only counts once its header is in place
+            seq = self.next_seq
+            start = self.tail + _JOURNAL_ENTRY.size
+            self.map[start:start + len(body)] = body
+            _JOURNAL_ENTRY.pack_into(self.map, self.tail, seq, len(body), zlib.crc32(body))
+            self.tail = start + len(body)
+            self.next_seq = seq + 1
+            return seq
+    
+    def checkpoint(self, seq: int):
+        """Release all entries up to and including sequence number seq."""
+        with self.lock:
+            while self.head < self.tail and self.head_seq <= seq:
+                _, length, _ = _JOURNAL_ENTRY.unpack_from(self.map, self.head)
+                self.head += _JOURNAL_ENTRY.size + length
+                self.head_seq += 1
+            if self.head == self.tail:
+                # Nothing is live, start over at the front
+                self.head = self.tail = JOURNAL_DATA_START
+            self._write_head()
+    
+    def sync(self):
+        """Flush the journal to disk, for protection against power loss."""
+        with self.lock:
+            self.map.flush()
+    
+    def close(self):
+        """Close and remove the journal after a clean shutdown."""
+        with self.lock:
+            self.map.close()
+            self.file.close()
+        os.remove(self.path)
+
+
+class MessageRing:
+    """Fixed-size, preallocated in-memory ring of the most recent messages.
+    
+    Messages are stored in the compact journal encoding, back to back in one
+    bytearray; when the ring is full, the oldest messages are overwritten.
+    """
+    
+    def __init__(self, capacity: int):
+        """Allocate the ring with room for capacity bytes of encoded messages."""
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.lock = threading.Lock()
+        
+        # Oldest first: (offset, length, timestamp_ns) of each stored message
+        self.entries: "collections.deque[Tuple[int, int, int]]" = collections.deque()
+        self.tail = 0
+        self.overwritten_count = 0
+    
+    def append(self, record: Dict[str, Any]):
+        """Store a message, overwriting the oldest ones as needed."""
+        body = _encode_compact_record(record)
+        length = len(body)
+        if length > self.capacity:
+            logging.warning(f"Message on {record['topic']} is larger than the ring, not kept")
+            return
+        
+        with self.lock:
+            entries = self.entries
+            pos = self.tail
+            if pos + length > self.capacity:
+                # Wrap around; whatever is left past the tail is the oldest data
+                while entries and entries[0][0] >= pos:
+                    entries.popleft()
+                    self.overwritten_count += 1
+                pos = 0
+            while entries and pos <= entries[0][0] < pos + length:
+                entries.popleft()
+                self.overwritten_count += 1
+            
+            self.buffer[pos:pos + length] = body
+            entries.append((pos, length, record["timestamp_ns"]))
+            self.tail = pos + length
+    
+    def snapshot(self, since_ns: int = 0) -> List[bytes]:
+        """Copy out the encoded messages received at or after since_ns, oldest first."""
+        with self.lock:
+            return [
+                bytes(self.buffer[offset:offset + length])
+                for offset, length, timestamp_ns in self.entries
+                if timestamp_ns >= since_ns
+            ]
+    
+    @staticmethod
+    def decode(snapshot: List[bytes]) -> List[Dict[str, Any]]:
+        """Restore the messages of a snapshot."""
+        return [_decode_compact_record(body) for body in snapshot]
+    
+    def __len__(self) -> int:
+        """Number of messages held."""
+        return len(self.entries)
+
+
+def read_journal(path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Return the metadata and the unpersisted messages of a journal."""
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[:4] != JOURNAL_MAGIC:
+        raise ValueError(f"{path} is not a recording journal")
+    if data[4] > JOURNAL_VERSION:
+        raise ValueError(f"Unsupported journal version {data[4]}")
+    
+    head, seq = _JOURNAL_HEAD.unpack_from(data, 8)
+    (metadata_length,) = _JOURNAL_METADATA_LENGTH.unpack_from(data, 24)
+    metadata = json.loads(data[28:28 + metadata_length])
+    
+    # Entries continue for as long as sequence numbers and checksums match
+    messages = []
+    pos = head
+    while pos + _JOURNAL_ENTRY.size <= len(data):
+        entry_seq, length, crc = _JOURNAL_ENTRY.unpack_from(data, pos)
+        body = data[pos + _JOURNAL_ENTRY.size:pos + _JOURNAL_ENTRY.size + length]
+        if entry_seq != seq or len(body) != length or zlib.crc32(body) != crc:
+            break
+        messages.append(_decode_compact_record(body))
+        pos += _JOURNAL_ENTRY.size + length
+        seq += 1
+    return metadata, messages
+
+
+def recover_journal(path: str, on_recovered: Optional[Callable[[str], None]] = None) -> int:
+    """Append the messages left in a crashed session's journal to its recording.
+    
+    Returns the number of recovered messages. The journal is removed once
+    its messages are written; on_recovered is then called with the path of
+    the completed recording.
+    """
+    metadata, messages = read_journal(path)
+    recording_path = os.path.join(os.path.dirname(path), metadata["recording"])
+    
+    # Data written since the last block index entry has no entry of its own
+    if os.path.exists(recording_path):
+        if is_manifest(recording_path):
+            segments = read_manifest(recording_path)
+            if segments and os.path.exists(segments[-1]["path"]):
+                recount_last_block(segments[-1]["path"])
+        else:
+            recount_last_block(recording_path)
+    
+    if messages:
+        storage_config = metadata.get("storage") or {}
+        codec = make_codec(storage_config, metadata.get("wall_anchor_ns"))
+        compressor = make_compressor(storage_config)
+        
+        def make_segment(segment_path: str) -> RecordingFile:
+            return RecordingFile(
+                segment_path,
+                codec=codec,
+                compressor=compressor,
+                block_size=storage_config.get("block_size", 1024 * 1024),
+                dedup=storage_config.get("dedup"),
+                time_index=storage_config.get("time_index", True)
+            )
+        
+        if recording_path.endswith(MANIFEST_EXTENSION):
+            # Recovered messages become one more segment of the session
+            extension = codec.extension + (compressor.extension if compressor else "")
+            recording = SegmentedRecording(recording_path, extension, make_segment)
+            if os.path.exists(recording_path):
+                with open(recording_path, "r", encoding='utf-8') as file:
+                    recording.segments = json.load(file).get("segments", [])
+        else:
+            recording = make_segment(recording_path)
+        recording.write(messages)
+        recording.close()
+    
+    os.remove(path)
+    if on_recovered is not None and os.path.exists(recording_path):
+        on_recovered(recording_path)
+    return len(messages)
+
+
+def recover_journals(dir_path: str = ".", on_recovered: Optional[Callable[[str], None]] = None) -> int:
+    """Recover every journal left behind by crashed sessions in a directory."""
+    recovered = 0
+    for path in sorted(glob.glob(os.path.join(dir_path, f"{RECORDING_PREFIX}*{JOURNAL_SUFFIX}"))):
+        count = recover_journal(path, on_recovered)
+        logging.info(f"Recovered {count} messages from {path}")
+        recovered += count
+    return recovered
+
+
+def write_recording(messages: Iterable[Dict[str, Any]], destination: str, codec, compressor=None,
+                    dedup: Optional[Dict[str, Any]] = None) -> int:
+    """Write a stream of messages to a new recording, returning the message count."""
+    recording = RecordingFile(destination, codec=codec, compressor=compressor, dedup=dedup)
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) >= 10000:
+            recording.write(batch)
+            batch = []
+    if batch:
+        recording.write(batch)
+    recording.close()
+    return recording.message_count
+
+
+def convert_recording(source: str, destination: str, codec, compressor=None,
+                      dedup: Optional[Dict[str, Any]] = None) -> int:
+    """Rewrite a recording in another format, returning the message count."""
+    return write_recording(read_messages(source), destination, codec, compressor, dedup)
+
+
+def merge_messages(sources: List[str]) -> Iterator[Dict[str, Any]]:
+    """Stream the messages of several recordings as one timestamp-ordered sequence.
+    
+    Each source must itself be in timestamp order; only one pending message
+    per source is held in memory.
+    """
+    return heapq.merge(*(read_messages(source) for source in sources), key=lambda message: message["timestamp_ns"])
+
+
+def merge_recordings(sources: List[str], destination: str, codec, compressor=None,
+                     dedup: Optional[Dict[str, Any]] = None) -> int:
+    """Merge several recordings into one timestamp-ordered recording."""
+    return write_recording(merge_messages(sources), destination, codec, compressor, dedup)
+
+
+def _index_json_lines(file: BinaryIO, block_size: int) -> List[Dict[str, Any]]:
+    """List blocks of about block_size bytes of a JSON Lines recording, starting at line boundaries."""
+    blocks: List[Dict[str, Any]] = []
+    block = None
+    offset = 0
+    for line in file:
+        stripped = line.strip()
+        if stripped:
+            if block is None or offset - block["offset"] >= block_size:
+                try:
+                    record = decode_json_record(json_loads(stripped))
+                except ValueError:
+                    # The reader skips invalid lines, so they start no block
+                    offset += len(line)
+                    continue
+                block = {"offset": offset, "messages": 0, "first_timestamp": record["timestamp_ns"] / 1e9}
+                blocks.append(block)
+            block["messages"] += 1
+        offset += len(line)
+    return blocks
+
+
+def _index_binary(file: BinaryIO, block_size: int) -> List[Dict[str, Any]]:
+    """List blocks of about block_size bytes of a binary recording, starting at message records.
+    
+    The blocks of an existing file do not define their own topics, so each
+    block lists the topics defined since the previous one as [id, topic] pairs.
+    """
+    metadata = _read_binary_header(file)
+    anchor = metadata.get("wall_anchor_ns", 0)
+    base = file.tell()
+    buffer = file.read(READ_CHUNK_SIZE)
+    pos = 0
+    
+    blocks: List[Dict[str, Any]] = []
+    block = None
+    new_topics: List[List[Any]] = []
+    while True:
+        end = len(buffer)
+        while pos < end:
+            try:
+                length, body = decode_varint(buffer, pos)
+            except IndexError:
+                break
+            if body + length > end:
+                break
+            
+            kind = buffer[body]
+            if kind == RECORD_TOPIC:
+                topic_id, topic_start = decode_varint(buffer, body + 1)
+                new_topics.append([topic_id, buffer[topic_start:body + length].decode('utf-8')])
+            elif kind == RECORD_NUMERIC:
+                # Numeric records continue the previous value of their topic
+                raise ValueError("Recording has delta-encoded numeric payloads, rewrite it with convert to index it")
+            elif kind in (RECORD_MESSAGE_FLAGS, RECORD_GAP, RECORD_MESSAGE_OFFSET, RECORD_MESSAGE_REF, RECORD_MESSAGE):
+                offset = base + pos
+                if block is None or offset - block["offset"] >= block_size:
+                    _, timestamp_ns = _RECORD_HEADER.unpack_from(buffer, body)
+                    if kind not in (RECORD_MESSAGE_REF, RECORD_MESSAGE):
+                        timestamp_ns += anchor
+                    block = {"offset": offset, "messages": 0, "first_timestamp": timestamp_ns / 1e9}
+                    if new_topics:
+                        block["topics"] = new_topics
+                        new_topics = []
+                    blocks.append(block)
+                block["messages"] += 1
+            pos = body + length
+        
+        chunk = file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        base += pos
+        buffer = buffer[pos:] + chunk
+        pos = 0
+    return blocks
+
+
+def build_block_index(path: str, block_size: int = 1024 * 1024) -> int:
+    """Write the block index of a recording made without one, returning its number of blocks.
+    
+    Reads the file once and lists a block about every block_size bytes, so
+    replay can seek into recordings made before they were indexed.
+    Compressed recordings are always indexed as they are written.
+    """
+    if is_manifest(path):
+        return sum(build_block_index(segment["path"], block_size) for segment in read_manifest(path))
+    
+    with open(path, "rb") as file:
+        if _detect_compression(file):
+            blocks = read_block_index(path)
+            if not blocks:
+                raise ValueError(f"Compressed recording {path} has no block index to seek with")
+            return len(blocks)
+        if file.peek(len(BINARY_MAGIC))[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            blocks = _index_binary(file, block_size)
+        else:
+            blocks = _index_json_lines(file, block_size)
+    
+    write_block_index(path, blocks)
+    return len(blocks)
+
+
+def _add_output_arguments(parser: argparse.ArgumentParser):
+    """Add the output format options shared by the recording tools."""
+    parser.add_argument("--format", choices=["json", "binary"], default="binary", help="Output format")
+    parser.add_argument("--payload-encoding", choices=PAYLOAD_ENCODINGS, default="base64",
+                        help="Payload encoding for JSON output")
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], default="none",
+                        help="Block compression for the output")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Store repeated payloads of binary output once in a payload store")
+    parser.add_argument("--numeric", action="store_true",
+                        help="Delta encode decimal payloads of binary output")
+
+
+def _output_config(args: argparse.Namespace) -> Dict[str, Any]:
+    """Build a storage config for the output options."""
+    return {
+        "format": args.format,
+        "payload_encoding": args.payload_encoding,
+        "compression": args.compression,
+        "dedup": {"enabled": args.dedup},
+        "numeric_encoding": args.numeric,
+    }
+
+
+def main():
+    """Command line entry point for recording maintenance tasks."""
+    parser = argparse.ArgumentParser(description="MQTT recording tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    convert_parser = subparsers.add_parser("convert", help="Convert a recording to another format")
+    convert_parser.add_argument("source", help="Recording to read (format is auto-detected)")
+    convert_parser.add_argument("destination", help="Recording to write")
+    _add_output_arguments(convert_parser)
+    
+    merge_parser = subparsers.add_parser("merge", help="Merge recordings into one timestamp-ordered recording")
+    merge_parser.add_argument("destination", help="Recording to write")
+    merge_parser.add_argument("sources", nargs="+", help="Recordings or manifests to merge")
+    _add_output_arguments(merge_parser)
+    
+    index_parser = subparsers.add_parser("index", help="Build the time index of recordings made without one")
+    index_parser.add_argument("sources", nargs="+", help="Recordings or manifests to index")
+    index_parser.add_argument("--block-size", type=int, default=1024 * 1024,
+                              help="Bytes of recording per index entry")
+    
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    
+    sources = [args.source] if args.command == "convert" else args.sources
+    for source in sources:
+        if not os.path.exists(source):
+            print(f"Error: File '{source}' not found.")
+            sys.exit(1)
+    
+    if args.command == "index":
+        for source in args.sources:
+            try:
+                count = build_block_index(source, args.block_size)
+            except ValueError as e:
+                print(f"Error: {source}: {e}")
+                sys.exit(1)
+            print(f"Indexed {source} in {count} blocks")
+        return
+    
+    output_config = _output_config(args)
+    codec = make_codec(output_config)
+    compressor = make_compressor(output_config)
+    dedup = output_config["dedup"]
+    
+    if args.command == "convert":
+        count = convert_recording(args.source, args.destination, codec, compressor, dedup)
+        print(f"Converted {count} messages to {args.destination}")
+    elif args.command == "merge":
+        count = merge_recordings(args.sources, args.destination, codec, compressor, dedup)
+        print(f"Merged {count} messages from {len(args.sources)} recordings into {args.destination}")
+
+
+if __name__ == "__main__":
+    main()
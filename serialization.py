@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+JSON Serialization Backend
+
+Picks the fastest JSON library installed at import time: orjson, then
+ujson, then simdjson (parsing only), falling back to the standard library.
+json_dumps always returns UTF-8 bytes, so records go to the file without
+an intermediate str, and json_loads accepts bytes or str. Set the
+MQTT_JSON_BACKEND environment variable to stdlib, orjson, ujson or
+simdjson to force a backend.
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+
+# Backends in order of preference
+BACKEND_PREFERENCE = ("orjson", "ujson", "simdjson", "stdlib")
+
+
+def _stdlib_dumps(value: Any) -> bytes:
+    """Serialize with the standard library."""
+    return json.dumps(value).encode('utf-8')
+
+
+def _ujson_dumps(value: Any) -> bytes:
+    """Serialize with ujson, without escaping the slashes of topics."""
+    return ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+_simdjson_local = threading.local()
+
+
+def _simdjson_loads(data: Union[bytes, str]) -> Any:
+    """Parse with a per-thread simdjson parser into plain Python objects."""
+    parser = getattr(_simdjson_local, "parser", None)
+    if parser is None:
+        parser = _simdjson_local.parser = simdjson.Parser()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return parser.parse(data, recursive=True)
+
+
+# Available backends: name -> (dumps returning bytes, loads)
+BACKENDS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[Union[bytes, str]], Any]]] = {
+    "stdlib": (_stdlib_dumps, json.loads),
+}
+if orjson is not None:
+    BACKENDS["orjson"] = (orjson.dumps, orjson.loads)
+if ujson is not None:
+    BACKENDS["ujson"] = (_ujson_dumps, ujson.loads)
+if simdjson is not None:
+    # simdjson only parses; serialize with the standard library
+    BACKENDS["simdjson"] = (_stdlib_dumps, _simdjson_loads)
+
+
+def _select_backend() -> str:
+    """Return the forced backend if it is available, else the preferred one."""
+    forced = os.environ.get("MQTT_JSON_BACKEND")
+    if forced:
+        if forced in BACKENDS:
+            return forced
+        logging.warning(f"JSON backend {forced} is not installed, choosing one automatically")
+    return next(name for name in BACKEND_PREFERENCE if name in BACKENDS)
+
+
+JSON_BACKEND = _select_backend()
+json_dumps, json_loads = BACKENDS[JSON_BACKEND]
@@ -3,11 +3,10 @@
 MQTT Message Subscriber and Recorder
 
 This script subscribes to all MQTT topics and saves the received messages
-to a JSON file with timestamps for later replay.
+to a JSON Lines or binary recording with timestamps for later replay.
 """
 
 import paho.mqtt.client as mqtt
-import json
 import time
 import yaml
 import logging
@@ -15,33 +14,717 @@ import ssl
 import sys
 import signal
 import os
-import glob
-from typing import Dict, List, Any
+import queue
+import re
+import socket
+import threading
+import argparse
+import collections
+import itertools
+import multiprocessing
+import sqlite3
+from typing import Callable, Dict, List, Any, Optional, Tuple
+
+from catalog import RecordingCatalog
+from metrics import WRITE_SECONDS_BUCKETS, HdrHistogram, Metrics, MetricsExporter
+from recording import (
+    JOURNAL_SUFFIX,
+    MANIFEST_EXTENSION,
+    DurabilityPolicy,
+    FlushController,
+    Journal,
+    MessageRing,
+    RecordingClock,
+    RecordingFile,
+    SegmentedRecording,
+    find_recordings,
+    gap_record,
+    is_gap_record,
+    make_codec,
+    make_compressor,
+    merge_messages,
+    recording_number,
+    recover_journals,
+    remove_recording,
+)
+
+
+# Supported MQTT protocol versions, by config value
+MQTT_PROTOCOLS = {
+    "3.1": mqtt.MQTTv31,
+    "3.1.1": mqtt.MQTTv311,
+    "5": mqtt.MQTTv5,
+}
+
+# What the writer queue does with a new message when it is full
+OVERLOAD_POLICIES = ("block", "drop_oldest", "drop_newest", "sample")
+
+# How often the main thread checks for a shutdown or dump requested by a signal
+SHUTDOWN_POLL_INTERVAL = 0.1
+
+
+def record_size(record: Dict[str, Any]) -> int:
+    """Approximate the size of a recorded message in bytes."""
+    if is_gap_record(record):
+        return 0
+    return len(record["topic"]) + len(record["payload"])
+
+
+def filters_overlap(first: str, second: str) -> bool:
+    """Return whether some topic matches both MQTT topic filters."""
+    first_levels, second_levels = first.split("/"), second.split("/")
+    # Wildcards at the first level do not match topics starting with $
+    if first_levels[0].startswith("$") != second_levels[0].startswith("$"):
+        if first_levels[0] in ("+", "#") or second_levels[0] in ("+", "#"):
+            return False
+    for first_level, second_level in itertools.zip_longest(first_levels, second_levels):
+        if first_level == "#" or second_level == "#":
+            return True
+        if first_level is None or second_level is None:
+            return False
+        if first_level != second_level and "+" not in (first_level, second_level):
+            return False
+    return True
+
+
+class RecordQueue:
+    """Bounded FIFO of records handed from the network thread to the writer.
+    
+    The queue holds at most max_messages messages and, if set, max_bytes
+    bytes of topics and payloads. When a new message does not fit, the
+    overload policy decides: block the network thread until the writer
+    catches up, drop the oldest or the newest messages, or sample, admitting
+    one in every sample_every new messages at the expense of the oldest.
+    Dropped messages are counted per topic and replaced in the stream by a
+    gap marker, so the recording shows where data is missing.
+    """
+    
+    def __init__(self, max_messages: int = 100000, max_bytes: int = 0,
+                 policy: str = "block", sample_every: int = 10):
+        """Initialize an empty queue with its budget and overload policy."""
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy: {policy} (expected {', '.join(OVERLOAD_POLICIES)})")
+        self.records: "collections.deque[Dict[str, Any]]" = collections.deque()
+        self.condition = threading.Condition()
+        self.max_messages = max(1, max_messages)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.sample_every = max(1, sample_every)
+        self.closed = False
+        
+        # Queued messages and bytes, gap markers excluded
+        self.message_count = 0
+        self.byte_count = 0
+        
+        # Overload statistics
+        self.dropped: Dict[str, int] = {}
+        self.dropped_count = 0
+        self.max_block_time = 0.0
+        self._overload_count = 0
+    
+    @classmethod
+    def from_config(cls, storage_config: Dict[str, Any]) -> "RecordQueue":
+        """Create a queue from the storage section and its overload settings."""
+        overload = storage_config.get("overload") or {}
+        return cls(
+            max_messages=storage_config.get("queue_size", 100000),
+            max_bytes=overload.get("max_bytes", 0),
+            policy=overload.get("policy", "block"),
+            sample_every=overload.get("sample_every", 10)
+        )
+    
+    def _fits(self, size: int) -> bool:
+        """Return True if a message of this size fits in the budget."""
+        if self.message_count == 0:
+            # Always admit one message, however large
+            return True
+        if self.message_count >= self.max_messages:
+            return False
+        return not self.max_bytes or self.byte_count + size <= self.max_bytes
+    
+    def put(self, record: Dict[str, Any]):
+        """Queue a record, applying the overload policy when the queue is full."""
+        size = record_size(record)
+        with self.condition:
+            if not self._fits(size):
+                if self.policy == "block":
+                    # The network thread has to wait for the writer
+                    block_start = time.monotonic()
+                    while not self._fits(size) and not self.closed:
+                        self.condition.wait()
+                    blocked = time.monotonic() - block_start
+                    if blocked > self.max_block_time:
+                        self.max_block_time = blocked
+                elif self.policy == "drop_newest":
+                    self._drop_newest(record)
+                    return
+                elif self.policy == "drop_oldest":
+                    self._drop_oldest(size)
+                else:
+                    self._overload_count += 1
+                    if self._overload_count % self.sample_every:
+                        self._drop_newest(record)
+                        return
+                    self._drop_oldest(size)
+            
+            self.records.append(record)
+            self.message_count += 1
+            self.byte_count += size
+            self.condition.notify_all()
+    
+    def get(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Remove and return the oldest record, None once closed and drained.
+        
+        Raises queue.Empty if nothing arrives within the timeout.
+        """
+        with self.condition:
+            if not self.records and not self.closed:
+                self.condition.wait(timeout)
+            if not self.records:
+                if self.closed:
+                    return None
+                raise queue.Empty
+            
+            record = self.records.popleft()
+            if not is_gap_record(record):
+                self.message_count -= 1
+                self.byte_count -= record_size(record)
+            self.condition.notify_all()
+            return record
+    
+    def close(self):
+        """Stop accepting records; get returns None once the queue is drained."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+    
+    def _count_drop(self, marker: Optional[Dict[str, Any]], record: Dict[str, Any]) -> Dict[str, Any]:
+        """Count a dropped message into the totals and a gap marker."""
+        topic = record["topic"]
+        self.dropped[topic] = self.dropped.get(topic, 0) + 1
+        self.dropped_count += 1
+        if marker is None:
+            marker = gap_record(record["timestamp_ns"])
+        marker["dropped"][topic] = marker["dropped"].get(topic, 0) + 1
+        return marker
+    
+    def _drop_newest(self, record: Dict[str, Any]):
+        """Drop an incoming message, extending the gap marker at the tail."""
+        if self.records and is_gap_record(self.records[-1]):
+            self._count_drop(self.records[-1], record)
+        else:
+            self.records.append(self._count_drop(None, record))
+            self.condition.notify_all()
+    
+    def _drop_oldest(self, size: int):
+        """Drop the oldest messages until one of this size fits.
+        
+        The dropped messages, and any gap markers among them, collapse into
+        one marker at the head of the queue.
+        """
+        marker = None
+        while not self._fits(size):
+            record = self.records.popleft()
+            if is_gap_record(record):
+                if marker is None:
+                    marker = record
+                else:
+                    for topic, count in record["dropped"].items():
+                        marker["dropped"][topic] = marker["dropped"].get(topic, 0) + count
+            else:
+                self.message_count -= 1
+                self.byte_count -= record_size(record)
+                marker = self._count_drop(marker, record)
+        if marker is not None:
+            self.records.appendleft(marker)
+
+
+class RecordingWriter(threading.Thread):
+    """Background thread that drains recorded messages from a bounded queue to storage."""
+    
+    def __init__(self, write_batch: Callable[[List[Dict[str, Any]]], None],
+                 flush_controller: FlushController, record_queue: Optional[RecordQueue] = None):
+        """Initialize the writer with the batch write callback and its queue."""
+        super().__init__(name="recording-writer", daemon=True)
+        self.queue = record_queue or RecordQueue()
+        self.write_batch = write_batch
+        self.flush_controller = flush_controller
+        self.pending: List[Dict[str, Any]] = []
+        
+        # Writer statistics
+        self.drained_count = 0
+        self.start_time = time.monotonic()
+        self._last_report_time = self.start_time
+        self._last_report_count = 0
+    
+    def submit(self, record: Dict[str, Any]):
+        """Hand a record to the writer; the queue's overload policy applies when full."""
+        self.queue.put(record)
+    
+    def run(self):
+        """Drain the queue in batches until the stop sentinel is received."""
+        running = True
+        while running:
+            try:
+                # Wake up in time to flush pending data before it gets too old
+                record = self.queue.get(timeout=self.flush_controller.time_until_due())
+                
+                # A None sentinel marks the end of the recording
+                if record is None:
+                    running = False
+                else:
+                    self.pending.append(record)
+                    self.flush_controller.add(record_size(record))
+            except queue.Empty:
+                pass
+            
+            if self.pending and (not running or self.flush_controller.should_flush()):
+                self._flush()
+    
+    def _flush(self):
+        """Write the pending batch and feed the write time back to the controller."""
+        write_start = time.monotonic()
+        self.write_batch(self.pending)
+        self.flush_controller.record_flush(time.monotonic() - write_start)
+        self.drained_count += len(self.pending)
+        self.pending = []
+    
+    def close(self):
+        """Signal the writer to finish draining and wait for it to exit."""
+        self.queue.close()
+        self.join()
+    
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, drain rate, drops and the longest network thread block."""
+        now = time.monotonic()
+        interval = now - self._last_report_time
+        drained_since = self.drained_count - self._last_report_count
+        self._last_report_time = now
+        self._last_report_count = self.drained_count
+        
+        return {
+            "queue_depth": self.queue.message_count,
+            "queue_bytes": self.queue.byte_count,
+            "drained": self.drained_count,
+            "drain_rate": drained_since / interval if interval > 0 else 0.0,
+            "dropped": self.queue.dropped_count,
+            "max_block_ms": self.queue.max_block_time * 1000,
+            "batch_size": self.flush_controller.batch_size,
+        }
+
+
+class SamplingRule:
+    """Downsampling rule for the topics matching one topic filter.
+    
+    A message is kept when it passes every condition the rule sets: it is
+    the first of each `every` messages, it falls in a new 1/max_rate second
+    slot, and (on_change) its payload differs from the last kept payload.
+    State is kept per topic and source, so every matching topic is sampled
+    on its own.
+    """
+    
+    def __init__(self, topic_filter: str, every: int = 0, max_rate: float = 0, on_change: bool = False):
+        """Initialize the rule; at least one condition must be set."""
+        if not every and not max_rate and not on_change:
+            raise ValueError(f"Sampling rule for {topic_filter} needs every, max_rate or on_change")
+        self.topic_filter = topic_filter
+        self.every = every
+        self.interval_ns = int(1_000_000_000 / max_rate) if max_rate else 0
+        self.on_change = on_change
+        
+        # Per (source, topic): messages seen, next rate slot and last kept payload
+        self.seen: Dict[Tuple[Optional[str], str], int] = {}
+        self.next_slot_ns: Dict[Tuple[Optional[str], str], int] = {}
+        self.last_payload: Dict[Tuple[Optional[str], str], bytes] = {}
+        
+        # Statistics
+        self.kept = 0
+        self.dropped = 0
+    
+    def describe(self) -> str:
+        """Return a short description of the rule for logs."""
+        conditions = []
+        if self.every:
+            conditions.append(f"1 in {self.every}")
+        if self.interval_ns:
+            conditions.append(f"max {1_000_000_000 / self.interval_ns:g}/s")
+        if self.on_change:
+            conditions.append("on change")
+        return f"{self.topic_filter} ({', '.join(conditions)})"
+    
+    def keep(self, key: Tuple[Optional[str], str], payload: bytes, timestamp_ns: int) -> bool:
+        """Return True if the message passes the rule, updating the counters."""
+        keep = True
+        if self.every:
+            count = self.seen.get(key, 0)
+            self.seen[key] = count + 1
+            keep = count % self.every == 0
+        if keep and self.interval_ns:
+            next_slot = self.next_slot_ns.get(key, 0)
+            if timestamp_ns < next_slot:
+                keep = False
+            else:
+                # Stay on the slot grid unless the topic fell a whole slot behind
+                next_slot += self.interval_ns
+                self.next_slot_ns[key] = next_slot if next_slot > timestamp_ns else timestamp_ns + self.interval_ns
+        if keep and self.on_change:
+            if self.last_payload.get(key) == payload:
+                keep = False
+            else:
+                self.last_payload[key] = payload
+        
+        if keep:
+            self.kept += 1
+        else:
+            self.dropped += 1
+        return keep
+
+
+class TopicSampler:
+    """Applies per-topic-filter sampling rules to received messages.
+    
+    The first rule whose filter matches a topic applies to it; topics no
+    rule matches are always kept. Rule lookups are cached per topic.
+    """
+    
+    # Cached topic lookups before the cache is cleared
+    MAX_CACHED_TOPICS = 100000
+    
+    def __init__(self, rules: List[SamplingRule]):
+        """Initialize the sampler with rules in priority order."""
+        self.rules = rules
+        self.lock = threading.Lock()
+        self._rule_cache: Dict[str, Optional[SamplingRule]] = {}
+    
+    @classmethod
+    def from_config(cls, rules_config: Optional[List[Dict[str, Any]]]) -> Optional["TopicSampler"]:
+        """Build a sampler from the storage.sampling config list, None when it is empty."""
+        if not rules_config:
+            return None
+        return cls([
+            SamplingRule(
+                rule["topic"],
+                every=rule.get("every", 0),
+                max_rate=rule.get("max_rate", 0),
+                on_change=rule.get("on_change", False)
+            )
+            for rule in rules_config
+        ])
+    
+    def _rule_for(self, topic: str) -> Optional[SamplingRule]:
+        """Return the first rule matching a topic, None if no rule does."""
+        try:
+            return self._rule_cache[topic]
+        except KeyError:
+            pass
+        
+        rule = next((rule for rule in self.rules if mqtt.topic_matches_sub(rule.topic_filter, topic)), None)
+        if len(self._rule_cache) >= self.MAX_CACHED_TOPICS:
+            self._rule_cache.clear()
+        self._rule_cache[topic] = rule
+        return rule
+    
+    def keep(self, topic: str, payload: bytes, timestamp_ns: int, source: Optional[str] = None) -> bool:
+        """Return True if a received message should be recorded."""
+        rule = self._rule_for(topic)
+        if rule is None:
+            return True
+        with self.lock:
+            return rule.keep((source, topic), payload, timestamp_ns)
+    
+    def log_stats(self):
+        """Log how many messages each rule kept and dropped."""
+        for rule in self.rules:
+            if rule.kept or rule.dropped:
+                logging.info(f"Sampling {rule.describe()}: kept {rule.kept}, dropped {rule.dropped}")
+
+
+class FlightRecorder:
+    """Keeps recent messages in a memory ring and dumps them when triggered.
+    
+    Nothing is written to disk until a trigger fires: SIGUSR1, a message
+    matching a trigger rule (topic filter and optional payload regex) or a
+    "dump" command on the local control socket. A dump holds the ring's
+    messages from the last window_s seconds (all of them if 0) and, with
+    post_trigger_s, the messages received for that long after the trigger.
+    Dumps are written from their own thread.
+    """
+    
+    def __init__(self, dump: Callable[[List[Dict[str, Any]], str], None], clock: RecordingClock,
+                 size: int = 256 * 1024 * 1024, window_s: float = 0, post_trigger_s: float = 0,
+                 triggers: Optional[List[Dict[str, Any]]] = None, control_socket: Optional[str] = None):
+        """Allocate the ring; dump(messages, reason) writes a triggered recording."""
+        self.ring = MessageRing(size)
+        self.dump = dump
+        self.clock = clock
+        self.window_ns = int(window_s * 1_000_000_000)
+        self.post_trigger_s = post_trigger_s
+        self.control_socket = control_socket
+        self.lock = threading.Lock()
+        self.dump_count = 0
+        
+        # Messages received, and how many of them the last dump had seen
+        self.received_count = 0
+        self._dumped_count = 0
+        
+        # Compiled trigger rules: topic filter and payload regex (or None)
+        self.triggers = [
+            (rule.get("topic", "#"), re.compile(rule["payload"].encode('utf-8')) if rule.get("payload") else None)
+            for rule in triggers or []
+        ]
+        
+        # Snapshot and messages collected after the trigger of the pending dump
+        self._pending: Optional[Tuple[List[bytes], List[Dict[str, Any]], str]] = None
+        self._dump_thread: Optional[threading.Thread] = None
+    
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], dump: Callable[[List[Dict[str, Any]], str], None],
+                    clock: RecordingClock) -> "FlightRecorder":
+        """Build a flight recorder from the storage.flight_recorder config section."""
+        return cls(
+            dump,
+            clock,
+            size=config.get("size", 256 * 1024 * 1024),
+            window_s=config.get("window_s", 0),
+            post_trigger_s=config.get("post_trigger_s", 0),
+            triggers=config.get("triggers"),
+            control_socket=config.get("control_socket") or None
+        )
+    
+    def add(self, record: Dict[str, Any]):
+        """Keep a message in the ring and check it against the trigger rules."""
+        self.ring.append(record)
+        self.received_count += 1
+        if self._pending is not None:
+            with self.lock:
+                if self._pending is not None:
+                    self._pending[1].append(record)
+        
+        for topic_filter, pattern in self.triggers:
+            if mqtt.topic_matches_sub(topic_filter, record["topic"]) and (
+                    pattern is None or pattern.search(record["payload"])):
+                self.trigger(f"message on {record['topic']}")
+                break
+    
+    def trigger(self, reason: str, background: bool = True) -> bool:
+        """Start a dump; returns False if one is already in progress.
+        
+        With background=False the dump is written right away, skipping the
+        post-trigger window.
+        """
+        with self.lock:
+            dump_thread = self._dump_thread
+            if self._pending is not None or (dump_thread is not None and dump_thread.is_alive()):
+                logging.info(f"Ignoring trigger ({reason}), a dump is already in progress")
+                return False
+            since_ns = self.clock.now_ns() - self.window_ns if self.window_ns else 0
+            self._pending = (self.ring.snapshot(since_ns), [], reason)
+        
+        logging.info(f"Flight recorder triggered by {reason}")
+        if not background:
+            self._finish()
+        elif self.post_trigger_s > 0:
+            logging.info(f"Recording {self.post_trigger_s} more seconds before dumping")
+            self._dump_thread = threading.Timer(self.post_trigger_s, self._finish)
+            self._dump_thread.daemon = True
+            self._dump_thread.start()
+        else:
+            self._dump_thread = threading.Thread(target=self._finish, name="flight-dump", daemon=True)
+            self._dump_thread.start()
+        return True
+    
+    def _finish(self):
+        """Write the pending dump."""
+        with self.lock:
+            if self._pending is None:
+                return
+            snapshot, after, reason = self._pending
+            self._pending = None
+            self._dumped_count = self.received_count
+        
+        messages = MessageRing.decode(snapshot) + after
+        try:
+            self.dump(messages, reason)
+            self.dump_count += 1
+        except Exception as e:
+            logging.error(f"Failed to dump flight recording: {e}")
+    
+    def start_control_socket(self):
+        """Listen for commands on the local control socket, if configured."""
+        if not self.control_socket:
+            return
+        if os.path.exists(self.control_socket):
+            os.remove(self.control_socket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.control_socket)
+        server.listen(1)
+        threading.Thread(target=self._serve_control_socket, args=(server,), name="flight-control",
+                         daemon=True).start()
+        logging.info(f"Flight recorder control socket: {self.control_socket} (send \"dump\")")
+    
+    def _serve_control_socket(self, server: socket.socket):
+        """Answer "dump" commands from the control socket."""
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                command = connection.recv(1024).strip()
+                if command == b"dump":
+                    connection.sendall(b"ok\n" if self.trigger("control socket") else b"busy\n")
+                else:
+                    connection.sendall(b"unknown command\n")
+    
+    def close(self, dump: bool = False):
+        """Finish pending dumps, optionally dump the ring, and remove the socket.
+        
+        A dump still waiting for its post-trigger window is written right away.
+        The shutdown dump is skipped when no message arrived since the last dump.
+        """
+        dump_thread = self._dump_thread
+        if dump_thread is not None:
+            if isinstance(dump_thread, threading.Timer):
+                dump_thread.cancel()
+            dump_thread.join()
+        self._finish()
+        if dump:
+            if self.dump_count and self.received_count == self._dumped_count:
+                logging.info("No messages since the last flight recorder dump, not dumping on exit")
+            else:
+                self.trigger("shutdown", background=False)
+        if self.control_socket and os.path.exists(self.control_socket):
+            os.remove(self.control_socket)
 
 
 class MQTTSubscriber:
-    """MQTT Subscriber that records all messages to a JSON file."""
+    """MQTT Subscriber that records all messages to a JSON Lines or binary file."""
     
-    def __init__(self, config_file: str = "config.yml"):
-        """Initialize the MQTT subscriber with configuration."""
+    # Whether storage.writer_thread can move writes to a background thread
+    supports_writer_thread = True
+    
+    def __init__(self, config_file: str = "config.yml", topics: Optional[List[str]] = None,
+                 storage_file: Optional[str] = None):
+        """Initialize the MQTT subscriber with configuration.
+        
+        topics and storage_file override the configured topic filters and the
+        next incremental file name; the sharded recorder uses them for shards.
+        """
         # Setup logging first, before any logging calls
         self._setup_logging()
         
+        self.config_file = config_file
         self.config = self._load_config(config_file)
-        self.mqtt_config = self.config["mqtt"]
-        self.storage_file = self._get_next_filename(self.config["storage"]["file_path"])
+        self.mqtt_config = dict(self.config["mqtt"])
+        if topics:
+            self.mqtt_config["topics"] = topics
+        self.clock = RecordingClock()
+        self.codec = make_codec(self.config["storage"], self.clock.wall_anchor_ns)
+        self.compressor = make_compressor(self.config["storage"])
+        self.rotation_config = self.config["storage"].get("rotation") or {}
+        self.journal_config = self.config["storage"].get("journal") or {}
+        self.flight_config = self.config["storage"].get("flight_recorder") or {}
+        self.dedup_config = self.config["storage"].get("dedup") or {}
+        if self.dedup_config.get("enabled") and self.codec.name != "binary":
+            logging.warning("Payload deduplication needs the binary format, storing payloads inline")
+        
+        # Broker-to-disk latency: from receipt in _on_message until persisted
+        self.persist_latency: Optional[HdrHistogram] = None
+        metrics_enabled = (self.config.get("metrics") or {}).get("enabled", False)
+        if self.config["storage"].get("track_latency", metrics_enabled) and not self.flight_config.get("enabled"):
+            self.persist_latency = HdrHistogram()
+        
+        # Catalog of the recording directory; shard files are not cataloged
+        self.catalog: Optional[RecordingCatalog] = None
+        if storage_file is None:
+            self.catalog = RecordingCatalog.from_config(
+                self.config["storage"], os.path.dirname(self.config["storage"]["file_path"]) or "."
+            )
+        if storage_file is None and self.journal_config.get("enabled"):
+            # Finish the recordings of sessions that crashed before this one
+            self._recover_journals()
+        self.storage_file = storage_file or self._get_next_filename(self.config["storage"]["file_path"])
+        self.recording = self._setup_recording()
+        self.journal = self._setup_journal()
         
         # Message buffering
+        storage_config = self.config["storage"]
         self.buffer: List[Dict[str, Any]] = []
-        self.buffer_size = 1000
+        self.buffer_lock = threading.RLock()
+        self.flush_controller = FlushController.from_config(storage_config.get("flush"))
         self.message_count = 0
+        self._stopping = threading.Event()
+        self._shutdown_requested = False
+        self._dump_requested: Optional[str] = None
+        
+        # Per-topic downsampling before anything is journaled or buffered
+        self.sampler = TopicSampler.from_config(storage_config.get("sampling"))
+        
+        # Flight recorder mode keeps messages in memory until a trigger fires
+        self.flight_recorder = None
+        if self.flight_config.get("enabled"):
+            self.flight_recorder = FlightRecorder.from_config(
+                self.flight_config, self._dump_flight_recording, self.clock
+            )
+        
+        # Optional background writer so the network thread never touches the
+        # disk; a memory budget for queued messages implies the writer
+        self.writer = None
+        overload_config = storage_config.get("overload") or {}
+        if (self.supports_writer_thread and not self.flight_recorder
+                and (storage_config.get("writer_thread") or overload_config.get("max_bytes"))):
+            self.writer = RecordingWriter(
+                self._write_messages,
+                self.flush_controller,
+                RecordQueue.from_config(storage_config)
+            )
+        
+        # Live metrics, exported over HTTP and/or a periodically rewritten file
+        self.metrics: Optional[Metrics] = None
+        self.metrics_exporter: Optional[MetricsExporter] = None
+        metrics_config = self.config.get("metrics") or {}
+        if metrics_config.get("enabled"):
+            self._setup_metrics(metrics_config)
         
-        # Setup MQTT client
-        self.client = self._setup_mqtt_client()
+        # Setup one MQTT client per source broker, all sharing the clock above
+        self.sources = self._source_configs()
+        self.clients = {
+            source_id: self._setup_mqtt_client(source_config, source_id)
+            for source_id, source_config in self.sources.items()
+        }
+        self.client = next(iter(self.clients.values()))
         
         # Setup signal handlers for graceful shutdown
+        self._install_signal_handlers()
+    
+    def _setup_metrics(self, metrics_config: Dict[str, Any]):
+        """Create the metrics registry, its gauges and histograms, and the exporter."""
+        self.metrics = Metrics("mqtt_recorder", metrics_config.get("topic_depth", 1))
+        self.metrics_exporter = MetricsExporter.from_config(metrics_config, self.metrics)
+        self.write_seconds = self.metrics.histogram(
+            "write_seconds", "Time to write one batch to the recording.", WRITE_SECONDS_BUCKETS
+        )
+        self.metrics.gauge("received_messages", "Messages received, before sampling.", lambda: self.message_count)
+        self.metrics.gauge("buffer_messages", "Messages buffered for the next write.", lambda: len(self.buffer))
+        if self.writer:
+            queue = self.writer.queue
+            self.metrics.gauge("queue_messages", "Messages queued for the writer thread.", lambda: queue.message_count)
+            self.metrics.gauge("queue_bytes", "Bytes queued for the writer thread.", lambda: queue.byte_count)
+            self.metrics.gauge("dropped_messages", "Messages dropped under overload.", lambda: queue.dropped_count)
+        if self.sampler:
+            self.metrics.gauge(
+                "sampled_out_messages", "Messages dropped by sampling rules.",
+                lambda: sum(rule.dropped for rule in self.sampler.rules)
+            )
+        if self.persist_latency:
+            self.metrics.summary(
+                "persist_latency_seconds", "Time from receiving a message until it is persisted.",
+                self.persist_latency, 1e-9
+            )
+    
+    def _install_signal_handlers(self):
+        """Stop gracefully on SIGINT and SIGTERM."""
         signal.signal(signal.SIGINT, self._signal_handler)
         signal.signal(signal.SIGTERM, self._signal_handler)
+        if self.flight_recorder:
+            signal.signal(signal.SIGUSR1, self._dump_signal_handler)
     
     def _load_config(self, config_file: str) -> Dict[str, Any]:
         """Load configuration from YAML file."""
@@ -77,22 +760,22 @@ class MQTTSubscriber:
             name_part = base_name
             ext = ""
         
-        # Find existing files with pattern mqtt_record_*.json
-        pattern = os.path.join(dir_path, "mqtt_record_*.json")
-        existing_files = glob.glob(pattern)
-        
-        # Extract numbers from existing files
-        existing_numbers = []
-        for file_path in existing_files:
-            filename = os.path.basename(file_path)
-            if filename.startswith("mqtt_record_") and filename.endswith(".json"):
-                try:
-                    # Extract number from mqtt_record_X.json
-                    number_str = filename[12:-5]  # Remove "mqtt_record_" and ".json"
-                    if number_str.isdigit():
-                        existing_numbers.append(int(number_str))
-                except (ValueError, IndexError):
-                    continue
+        if self._rotation_enabled():
+            extension = MANIFEST_EXTENSION
+        else:
+            extension = self._recording_extension()
+        
+        # The catalog hands out the next number without scanning the directory
+        if self.catalog:
+            try:
+                new_filepath = self.catalog.reserve(extension)
+                logging.info(f"Recording to: {new_filepath}")
+                return new_filepath
+            except sqlite3.Error as e:
+                logging.warning(f"Recording catalog unavailable, scanning the directory instead: {e}")
+        
+        # Extract numbers from existing mqtt_record_X files of any format
+        existing_numbers = [recording_number(file_path) for file_path in find_recordings(dir_path)]
         
         # Find the next available number
         next_number = 1
@@ -100,12 +783,105 @@ class MQTTSubscriber:
             next_number = max(existing_numbers) + 1
         
         # Generate new filename
-        new_filename = f"mqtt_record_{next_number}.json"
+        new_filename = f"mqtt_record_{next_number}{extension}"
         new_filepath = os.path.join(dir_path, new_filename)
         
         logging.info(f"Recording to: {new_filepath}")
         return new_filepath
     
+    def _recording_extension(self) -> str:
+        """Return the file extension of a single recording file."""
+        extension = self.codec.extension
+        if self.compressor:
+            extension += self.compressor.extension
+        return extension
+    
+    def _rotation_enabled(self) -> bool:
+        """Return True when the session is split into size- or time-limited segments."""
+        return bool(self.rotation_config.get("max_bytes") or self.rotation_config.get("max_duration_s"))
+    
+    def _make_recording_file(self, path: str) -> RecordingFile:
+        """Create a recording file with the configured format and durability."""
+        return RecordingFile(
+            path,
+            DurabilityPolicy.from_config(self.config["storage"].get("durability")),
+            codec=self.codec,
+            compressor=self.compressor,
+            block_size=self.config["storage"].get("block_size", 1024 * 1024),
+            dedup=self.dedup_config,
+            on_persist=self._record_persisted if self.persist_latency else None,
+            time_index=self.config["storage"].get("time_index", True)
+        )
+    
+    def _setup_recording(self, path: Optional[str] = None):
+        """Create the recording target: one file, or segments tracked by a manifest."""
+        path = path or self.storage_file
+        if not self._rotation_enabled():
+            return self._make_recording_file(path)
+        
+        return SegmentedRecording(
+            path,
+            self._recording_extension(),
+            self._make_recording_file,
+            max_bytes=self.rotation_config.get("max_bytes", 0),
+            max_duration_s=self.rotation_config.get("max_duration_s", 0)
+        )
+    
+    def _recover_journals(self):
+        """Append messages left in the journals of crashed sessions to their recordings."""
+        dir_path = os.path.dirname(self.config["storage"]["file_path"]) or "."
+        try:
+            recovered = recover_journals(dir_path, on_recovered=self._catalog_scan if self.catalog else None)
+            if recovered:
+                logging.warning(f"Recovered {recovered} messages from crashed recording sessions")
+        except Exception as e:
+            logging.error(f"Failed to recover journals: {e}")
+    
+    def _catalog_recording(self, path: str, recording):
+        """Store the statistics of a finished recording in the catalog."""
+        if not self.catalog:
+            return
+        try:
+            if os.path.exists(path):
+                self.catalog.update(path, recording.stats())
+            else:
+                # Nothing was written, e.g. in flight recorder mode
+                self.catalog.remove(path)
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to catalog {path}: {e}")
+    
+    def _catalog_scan(self, path: str):
+        """Read a recovered recording and store its statistics in the catalog."""
+        try:
+            self.catalog.scan(path)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logging.warning(f"Failed to catalog {path}: {e}")
+    
+    def _setup_journal(self) -> Optional[Journal]:
+        """Create the write-ahead journal of this session, if enabled."""
+        if not self.journal_config.get("enabled") or self.flight_config.get("enabled"):
+            return None
+        
+        storage_config = self.config["storage"]
+        metadata = {
+            "recording": os.path.basename(self.storage_file),
+            "wall_anchor_ns": self.clock.wall_anchor_ns,
+            "storage": {
+                "format": self.codec.name,
+                "payload_encoding": storage_config.get("payload_encoding", "text"),
+                "compression": self.compressor.name if self.compressor else "none",
+                "block_size": storage_config.get("block_size", 1024 * 1024),
+                "numeric_encoding": storage_config.get("numeric_encoding", False),
+                "dedup": self.dedup_config,
+                "time_index": storage_config.get("time_index", True),
+            },
+        }
+        return Journal(
+            self.storage_file + JOURNAL_SUFFIX,
+            metadata,
+            size=self.journal_config.get("size", 16 * 1024 * 1024)
+        )
+    
     def _setup_logging(self):
         """Setup logging configuration."""
         # Clear any existing handlers
@@ -123,12 +899,42 @@ class MQTTSubscriber:
             force=True  # Force reconfiguration
         )
     
-    def _setup_mqtt_client(self) -> mqtt.Client:
-        """Setup and configure MQTT client."""
-        client = mqtt.Client()
+    def _source_configs(self) -> Dict[Optional[str], Dict[str, Any]]:
+        """Return the connection settings of each source broker by source ID.
+        
+        Without a sources list there is a single, unnamed source. Each entry
+        of mqtt.sources needs an id and inherits unset keys from the mqtt
+        section.
+        """
+        sources = self.mqtt_config.get("sources")
+        if not sources:
+            return {None: self.mqtt_config}
+        
+        defaults = {key: value for key, value in self.mqtt_config.items() if key != "sources"}
+        configs = {}
+        for source in sources:
+            source_config = {**defaults, **source}
+            source_id = source_config.pop("id", None)
+            if source_id is None:
+                raise ValueError("Every entry of mqtt.sources needs an id")
+            source_id = str(source_id)
+            if source_id in configs:
+                raise ValueError(f"Duplicate source id: {source_id}")
+            configs[source_id] = source_config
+        return configs
+    
+    def _setup_mqtt_client(self, mqtt_config: Optional[Dict[str, Any]] = None,
+                           source_id: Optional[str] = None) -> mqtt.Client:
+        """Setup and configure an MQTT client for one source broker."""
+        mqtt_config = mqtt_config or self.mqtt_config
+        protocol = str(mqtt_config.get("protocol", "3.1.1"))
+        if protocol not in MQTT_PROTOCOLS:
+            raise ValueError(f"Unknown MQTT protocol version: {protocol} (expected 3.1, 3.1.1 or 5)")
+        # The source ID comes back as userdata in every callback
+        client = mqtt.Client(protocol=MQTT_PROTOCOLS[protocol], userdata=source_id)
         client.username_pw_set(
-            self.mqtt_config["username"], 
-            self.mqtt_config["password"]
+            mqtt_config["username"], 
+            mqtt_config["password"]
         )
         
         # Set callbacks
@@ -137,112 +943,444 @@ class MQTTSubscriber:
         client.on_disconnect = self._on_disconnect
         
         # Setup TLS if required
-        if self.mqtt_config.get("tls"):
+        if mqtt_config.get("tls"):
             client.tls_set(tls_version=ssl.PROTOCOL_TLSv1_2)
-            if not self.mqtt_config.get("validate_certificate"):
+            if not mqtt_config.get("validate_certificate"):
                 client.tls_insecure_set(True)
         
         return client
     
-    def _on_connect(self, client, userdata, flags, rc):
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
         """Callback for when the client connects to the broker."""
+        mqtt_config = self.sources[userdata]
+        source = f" {userdata}" if userdata is not None else ""
         if rc == 0:
-            logging.info("Successfully connected to MQTT broker")
-            client.subscribe("#")  # Subscribe to all topics
+            logging.info(f"Successfully connected to MQTT broker{source}")
+            subscriptions = [
+                (topic, mqtt_config.get("qos", 0)) for topic in self._topic_filters(mqtt_config)
+            ]
+            client.subscribe(subscriptions)
+            logging.info(f"Subscribed{source} to: {', '.join(topic for topic, _ in subscriptions)}")
         else:
-            logging.error(f"Failed to connect, return code {rc}")
+            logging.error(f"Failed to connect{source}, return code {rc}")
             sys.exit(1)
     
+    def _topic_filters(self, mqtt_config: Optional[Dict[str, Any]] = None) -> List[str]:
+        """Return the topic filters to subscribe to, as shared subscriptions if configured."""
+        mqtt_config = mqtt_config or self.mqtt_config
+        topics = mqtt_config.get("topics") or ["#"]  # Default to all topics
+        if isinstance(topics, str):
+            topics = [topics]
+        
+        # Shared subscriptions let several recorders split the load of one filter
+        group = mqtt_config.get("shared_group")
+        if group:
+            topics = [f"$share/{group}/{topic}" for topic in topics]
+        return topics
+    
     def _on_message(self, client, userdata, message):
         """Callback for when a message is received."""
         try:
+            self.message_count += 1
+            timestamp_ns = self.clock.now_ns()
+            if self.sampler and not self.sampler.keep(message.topic, message.payload, timestamp_ns, userdata):
+                return
+            
+            # Keep the raw payload bytes; encoding happens at write time
             data = {
                 "topic": message.topic,
-                "payload": message.payload.decode('utf-8', errors='ignore'),
-                "timestamp": time.time()
+                "payload": message.payload,
+                "timestamp_ns": timestamp_ns,
+                "qos": message.qos,
+                "retain": bool(message.retain),
+                "dup": bool(message.dup),
             }
             
-            self.buffer.append(data)
-            self.message_count += 1
+            # MQTT v5 properties are converted on the write path
+            properties = getattr(message, "properties", None)
+            if properties is not None:
+                data["properties"] = properties
             
-            # Flush buffer when it reaches the buffer size
-            if len(self.buffer) >= self.buffer_size:
-                self._flush_buffer()
+            # Tag messages with the broker they came from when recording several
+            if userdata is not None:
+                data["source"] = userdata
+            
+            if self.metrics:
+                self.metrics.count_message(message.topic, len(message.payload))
+            
+            # Journal the message before it is buffered, so a crash cannot lose it
+            if self.journal:
+                data["journal_seq"] = self.journal.append(data)
+            
+            self._enqueue(data)
             
             # Log progress every 10000 messages
             if self.message_count % 10000 == 0:
                 logging.info(f"Received {self.message_count} messages")
-                
+                if self.writer:
+                    self._log_writer_stats()
+                    
         except Exception as e:
             logging.error(f"Error processing message: {e}")
     
-    def _on_disconnect(self, client, userdata, rc):
+    def _enqueue(self, data: Dict[str, Any]):
+        """Buffer a received message for writing."""
+        if self.flight_recorder:
+            self.flight_recorder.add(data)
+        elif self.writer:
+            # Hand off to the writer thread, no disk I/O on the network thread
+            self.writer.submit(data)
+        else:
+            with self.buffer_lock:
+                self.buffer.append(data)
+                self.flush_controller.add(record_size(data))
+                
+                # Flush buffer when it reaches the count, size or age limit
+                if self.flush_controller.should_flush():
+                    self._flush_buffer()
+    
+    def _on_disconnect(self, client, userdata, rc, properties=None):
         """Callback for when the client disconnects."""
+        source = f" {userdata}" if userdata is not None else ""
         if rc != 0:
-            logging.error(f"Unexpected disconnection, return code {rc}")
+            logging.error(f"Unexpected disconnection{source}, return code {rc}")
         else:
-            logging.info("Disconnected from MQTT broker")
+            logging.info(f"Disconnected from MQTT broker{source}")
     
     def _flush_buffer(self):
-        """Write buffered messages to file."""
+        """Write buffered messages to file; the caller holds buffer_lock."""
         if not self.buffer:
             return
         
+        write_start = time.monotonic()
+        self._write_messages(self.buffer)
+        self.flush_controller.record_flush(time.monotonic() - write_start)
+        self.buffer.clear()
+    
+    def _age_flush_loop(self):
+        """Flush the buffer when messages sit in it longer than the max age."""
+        interval = max(0.01, self.flush_controller.max_age / 4)
+        while not self._stopping.wait(interval):
+            with self.buffer_lock:
+                if self.flush_controller.should_flush():
+                    self._flush_buffer()
+    
+    def _write_messages(self, messages: List[Dict[str, Any]]):
+        """Append a batch of messages to the storage file."""
         try:
-            with open(self.storage_file, "a", encoding='utf-8') as file:
-                for msg in self.buffer:
-                    file.write(json.dumps(msg) + "\n")
+            write_start = time.monotonic()
+            self.recording.write(messages)
+            if self.metrics:
+                self.metrics.observe(self.write_seconds, time.monotonic() - write_start)
             
-            logging.debug(f"Flushed {len(self.buffer)} messages to {self.storage_file}")
-            self.buffer.clear()
+            # Release journaled messages once the OS has them
+            if self.journal and not self.recording.buffered:
+                for message in reversed(messages):
+                    if "journal_seq" in message:
+                        self.journal.checkpoint(message["journal_seq"])
+                        break
+            
+            logging.debug(f"Flushed {len(messages)} messages to {self.storage_file}")
             
         except Exception as e:
             logging.error(f"Error writing to file: {e}")
     
+    def _record_persisted(self, timestamps: List[int]):
+        """Record the broker-to-disk latency of messages the recording persisted."""
+        if self.persist_latency is None:
+            return
+        now_ns = self.clock.now_ns()
+        self.persist_latency.record_many(now_ns - timestamp_ns for timestamp_ns in timestamps)
+    
+    def _log_persist_latency(self):
+        """Log the broker-to-disk latency percentiles."""
+        if not self.persist_latency or not self.persist_latency.total:
+            return
+        latency = self.persist_latency
+        logging.info(
+            f"Broker-to-disk latency over {latency.total} messages: "
+            f"p50 {latency.percentile(0.5) / 1e6:.3f} ms, p99 {latency.percentile(0.99) / 1e6:.3f} ms, "
+            f"p999 {latency.percentile(0.999) / 1e6:.3f} ms, max {latency.max / 1e6:.3f} ms"
+        )
+    
+    def _log_writer_stats(self):
+        """Log background writer queue depth, drain rate and blocking time."""
+        stats = self.writer.stats()
+        logging.info(
+            f"Writer queue depth: {stats['queue_depth']} ({stats['queue_bytes']} bytes), "
+            f"drain rate: {stats['drain_rate']:.0f} msg/s, "
+            f"dropped: {stats['dropped']}, "
+            f"max network thread block: {stats['max_block_ms']:.1f} ms, "
+            f"batch size: {stats['batch_size']}"
+        )
+    
+    def _log_drops(self):
+        """Log the messages dropped under overload, per topic."""
+        dropped = self.writer.queue.dropped
+        if not dropped:
+            return
+        
+        logging.warning(
+            f"Dropped {self.writer.queue.dropped_count} messages under overload "
+            f"(policy: {self.writer.queue.policy})"
+        )
+        for topic, count in sorted(dropped.items(), key=lambda item: item[1], reverse=True):
+            logging.warning(f"  {topic}: {count} dropped")
+    
     def _signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully."""
+        """Ask the main thread to shut down gracefully.
+        
+        Only sets a flag: stop() takes the journal, metrics and histogram
+        locks, which the interrupted code may be holding.
+        """
         logging.info(f"Received signal {signum}, shutting down gracefully...")
-        self.stop()
+        self._shutdown_requested = True
+    
+    def _dump_signal_handler(self, signum, frame):
+        """Ask the main thread to dump the flight recorder ring on SIGUSR1.
+        
+        Triggering takes the flight recorder and ring locks, which the
+        interrupted code may be holding, so the main thread does it.
+        """
+        self._dump_requested = f"signal {signum}"
+    
+    def _dump_flight_recording(self, messages: List[Dict[str, Any]], reason: str):
+        """Write a triggered flight recorder dump to a new recording."""
+        path = self._get_next_filename(self.config["storage"]["file_path"])
+        recording = self._setup_recording(path)
+        if messages:
+            recording.write(messages)
+        recording.close()
+        self._catalog_recording(path, recording)
+        logging.info(f"Dumped {len(messages)} messages to {path} ({reason})")
     
     def start(self):
         """Start the MQTT subscriber."""
         try:
             logging.info("Starting MQTT subscriber...")
-            logging.info(f"Messages will be saved to: {self.storage_file}")
-            self.client.connect(
-                self.mqtt_config["broker"], 
-                self.mqtt_config["port"], 
-                60
-            )
-            
-            # Start the loop
-            self.client.loop_forever()
+            if self.flight_recorder:
+                logging.info(
+                    f"Flight recorder mode: keeping the last {self.flight_recorder.ring.capacity} bytes "
+                    f"of messages in memory until triggered"
+                )
+                self.flight_recorder.start_control_socket()
+            else:
+                logging.info(f"Messages will be saved to: {self.storage_file}")
+            if self.writer:
+                self.writer.start()
+            else:
+                threading.Thread(target=self._age_flush_loop, name="age-flush", daemon=True).start()
+            if self.metrics_exporter:
+                self.metrics_exporter.start()
+            for source_id, client in self.clients.items():
+                client.connect(
+                    self.sources[source_id]["broker"], 
+                    self.sources[source_id]["port"], 
+                    60
+                )
             
+            # One network thread per broker, all feeding the same recording;
+            # the main thread only waits, so signals never interrupt a holder
+            # of the recording locks
+            for client in self.clients.values():
+                client.loop_start()
+            while not self._shutdown_requested:
+                time.sleep(SHUTDOWN_POLL_INTERVAL)
+                if self._dump_requested:
+                    reason, self._dump_requested = self._dump_requested, None
+                    self.flight_recorder.trigger(reason)
+                    
         except Exception as e:
             logging.error(f"Connection failed: {e}")
             sys.exit(1)
+        
+        self.stop()
+    
+    def _shard_topics(self, shard_count: Optional[int]) -> List[List[str]]:
+        """Return the topic filters of each shard.
+        
+        With a shared subscription group every shard subscribes to all
+        filters and the broker balances messages over the shards; otherwise
+        the filters are split into disjoint shards. Raises ValueError when
+        filters of different shards overlap, which would record messages twice.
+        """
+        shards = self.mqtt_config.get("shards")
+        if shards:
+            shard_topics = [[topics] if isinstance(topics, str) else list(topics) for topics in shards]
+        else:
+            topics = self.mqtt_config.get("topics") or ["#"]  # Default to all topics
+            if isinstance(topics, str):
+                topics = [topics]
+            requested = shard_count or 1
+            
+            # The same $share/<group>/ filters on every shard
+            if self.mqtt_config.get("shared_group"):
+                return [list(topics) for _ in range(requested)]
+            
+            # Split the configured topic filters round-robin over the shards
+            shard_count = min(requested, len(topics))
+            if shard_count < requested:
+                logging.warning(
+                    f"Only {len(topics)} topic filter(s) to split, running {shard_count} shard(s) "
+                    f"instead of {requested}; set mqtt.shared_group to balance them over {requested} shards"
+                )
+            shard_topics = [topics[i::shard_count] for i in range(shard_count)]
+        
+        # Shards in one shared group may share a filter, the broker splits its messages
+        shared = bool(self.mqtt_config.get("shared_group"))
+        for (shard, topics), (other_shard, other_topics) in itertools.combinations(enumerate(shard_topics), 2):
+            for topic in topics:
+                overlapping = [
+                    other for other in other_topics
+                    if filters_overlap(topic, other) and not (shared and topic == other)
+                ]
+                if overlapping:
+                    raise ValueError(
+                        f"Topic filter {topic} of shard {shard} overlaps {', '.join(overlapping)} "
+                        f"of shard {other_shard}; messages would be recorded twice"
+                    )
+        return shard_topics
+    
+    def _shard_filename(self, shard: int) -> str:
+        """Return the file name of one shard of this recording."""
+        base, extension = self.storage_file, ""
+        for candidate in (MANIFEST_EXTENSION, self._recording_extension()):
+            if base.endswith(candidate):
+                base, extension = base[:-len(candidate)], candidate
+                break
+        return f"{base}-shard{shard}{extension}"
+    
+    def _stop_shards(self, signum, frame):
+        """Forward shutdown signals to the shard processes."""
+        logging.info(f"Received signal {signum}, stopping shard recorders...")
+        self._stopping.set()
+        for process in self.shard_processes:
+            if process.is_alive():
+                process.terminate()
+    
+    def start_sharded(self, shard_count: Optional[int] = None):
+        """Record with one process per shard of topic filters, then merge the shards.
+        
+        Each process runs its own MQTT client and writer, so recording is not
+        limited by a single interpreter's GIL. When all shards stop, their
+        outputs are merged with a streaming k-way heap merge into this
+        subscriber's recording.
+        """
+        shard_topics = self._shard_topics(shard_count)
+        shard_files = [self._shard_filename(shard) for shard in range(len(shard_topics))]
+        
+        # The shards measure broker-to-disk latency; merging is not receiving
+        self.persist_latency = None
+        
+        signal.signal(signal.SIGINT, self._stop_shards)
+        signal.signal(signal.SIGTERM, self._stop_shards)
+        
+        logging.info(f"Starting {len(shard_topics)} shard recorders...")
+        self.shard_processes = []
+        for shard, (topics, shard_file) in enumerate(zip(shard_topics, shard_files)):
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(self.config_file, topics, shard_file, shard),
+                name=f"recorder-{os.path.basename(shard_file)}"
+            )
+            process.start()
+            self.shard_processes.append(process)
+            logging.info(f"Shard {shard_file} (pid {process.pid}) records: {', '.join(topics)}")
+        
+        for process in self.shard_processes:
+            process.join()
+        
+        # Merge the shards into one globally ordered recording
+        shard_files = [shard_file for shard_file in shard_files if os.path.exists(shard_file)]
+        logging.info(f"Merging {len(shard_files)} shards into {self.storage_file}...")
+        batch = []
+        for message in merge_messages(shard_files):
+            batch.append(message)
+            self.message_count += 1
+            if len(batch) >= 10000:
+                self.recording.write(batch)
+                batch = []
+        if batch:
+            self.recording.write(batch)
+        self.recording.close()
+        if self.journal:
+            self.journal.close()
+        self._catalog_recording(self.storage_file, self.recording)
+        
+        if not self.config["storage"].get("keep_shards"):
+            for shard_file in shard_files:
+                remove_recording(shard_file)
+        
+        logging.info(f"Total messages recorded: {self.message_count}")
+        logging.info("Sharded recorder stopped")
     
     def stop(self):
         """Stop the MQTT subscriber and cleanup."""
+        if self._stopping.is_set():
+            return
+        
         logging.info("Stopping MQTT subscriber...")
+        self._stopping.set()
+        
+        # Disconnect from the brokers
+        for client in self.clients.values():
+            client.disconnect()
+            client.loop_stop()
         
         # Flush any remaining messages
-        self._flush_buffer()
+        if self.flight_recorder:
+            self.flight_recorder.close(dump=self.flight_config.get("dump_on_exit", False))
+        elif self.writer and self.writer.is_alive():
+            self.writer.close()
+            self._log_writer_stats()
+            self._log_drops()
+        else:
+            with self.buffer_lock:
+                self._flush_buffer()
         
-        # Disconnect from broker
-        self.client.disconnect()
-        self.client.loop_stop()
+        try:
+            self.recording.close()
+            if self.journal:
+                self.journal.close()
+        except Exception as e:
+            logging.error(f"Error closing recording file: {e}")
+        self._catalog_recording(self.storage_file, self.recording)
+        if self.metrics_exporter:
+            self.metrics_exporter.close()
         
         logging.info(f"Total messages received: {self.message_count}")
+        if self.sampler:
+            self.sampler.log_stats()
+        self._log_persist_latency()
         logging.info("Subscriber stopped")
         sys.exit(0)
 
 
+def run_shard(config_file: str, topics: List[str], storage_file: str, shard: int = 0):
+    """Process entry point recording one shard of topic filters."""
+    subscriber = MQTTSubscriber(config_file, topics=topics, storage_file=storage_file)
+    if subscriber.metrics_exporter:
+        subscriber.metrics_exporter.for_shard(shard)
+    subscriber.start()
+
+
 def main():
     """Main function to run the MQTT subscriber."""
+    parser = argparse.ArgumentParser(description="MQTT Message Subscriber and Recorder")
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Record with this many processes, each on a disjoint set of topic filters"
+    )
+    
+    args = parser.parse_args()
+    
     try:
         subscriber = MQTTSubscriber()
-        subscriber.start()
+        if args.shards or subscriber.mqtt_config.get("shards"):
+            subscriber.start_sharded(args.shards)
+        else:
+            subscriber.start()
     except KeyboardInterrupt:
         logging.info("Received keyboard interrupt, shutting down...")
     except Exception as e:
@@ -0,0 +1,116 @@
+"""
+Tests for the crash recovery journal.
+
+A session killed with SIGKILL leaves its unpersisted messages in the
+journal; recovery must append exactly those to the recording, so every
+message is in it once and in order, whatever the format and compression.
+"""
+
+import multiprocessing
+import os
+import signal
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import (
+    JOURNAL_SUFFIX,
+    Journal,
+    RecordingFile,
+    make_codec,
+    make_compressor,
+    read_block_index,
+    read_journal,
+    read_messages,
+    recover_journals,
+)
+
+
+START_NS = 1699123456_000_000_000
+
+MESSAGES = [
+    {"topic": f"devices/{i % 5}/state", "payload": b"%d.%d" % (i, i % 10), "timestamp_ns": START_NS + i * 1000,
+     "qos": i % 3, "retain": False, "dup": False}
+    for i in range(3000)
+]
+
+
+def crashed_session(path, storage, persisted, batch_size):
+    """Record like the subscriber, journaling every message, then die with SIGKILL."""
+    journal = Journal(path + JOURNAL_SUFFIX, {
+        "recording": os.path.basename(path), "wall_anchor_ns": START_NS, "storage": storage
+    }, size=8192)
+    recording = RecordingFile(path, codec=make_codec(storage, START_NS), compressor=make_compressor(storage),
+                              block_size=storage["block_size"])
+    sequences = [journal.append(message) for message in MESSAGES]
+    for start in range(0, persisted, batch_size):
+        recording.write(MESSAGES[start:min(start + batch_size, persisted)])
+        if not recording.buffered:
+            journal.checkpoint(sequences[min(start + batch_size, persisted) - 1])
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+@pytest.mark.parametrize("storage", [
+    {"format": "json", "payload_encoding": "base64", "compression": "none"},
+    {"format": "binary", "compression": "none"},
+    {"format": "binary", "compression": "none", "numeric_encoding": True},
+    {"format": "binary", "compression": "gzip"},
+], ids=["json", "binary", "numeric", "binary-gzip"])
+def test_recovery_after_kill(tmp_path, storage):
+    storage = dict(storage, block_size=4096)
+    path = str(tmp_path / "mqtt_record_1")
+    process = multiprocessing.get_context("fork").Process(target=crashed_session, args=(path, storage, 2000, 100))
+    process.start()
+    process.join()
+    assert process.exitcode == -signal.SIGKILL
+    assert os.path.exists(path + JOURNAL_SUFFIX)
+    
+    recovered = []
+    assert recover_journals(str(tmp_path), on_recovered=recovered.append) >= len(MESSAGES) - 2000
+    assert recovered == [path]
+    assert not os.path.exists(path + JOURNAL_SUFFIX)
+    assert list(read_messages(path)) == MESSAGES
+    
+    # The block index still counts every message
+    assert sum(block["messages"] for block in read_block_index(path)) == len(MESSAGES)
+
+
+def test_checkpoint_releases_entries(tmp_path):
+    journal = Journal(str(tmp_path / "mqtt_record_1.json.journal"), {"recording": "mqtt_record_1.json"})
+    sequences = [journal.append(message) for message in MESSAGES[:10]]
+    journal.checkpoint(sequences[6])
+    metadata, messages = read_journal(journal.path)
+    assert metadata == {"recording": "mqtt_record_1.json"}
+    assert messages == MESSAGES[7:10]
+    journal.checkpoint(sequences[-1])
+    assert read_journal(journal.path)[1] == []
+    journal.close()
+    assert not os.path.exists(journal.path)
+
+
+def test_journal_grows_and_compacts(tmp_path):
+    journal = Journal(str(tmp_path / "mqtt_record_1.json.journal"), {"recording": "mqtt_record_1.json"}, size=8192)
+    for start in range(0, len(MESSAGES), 100):
+        sequences = [journal.append(message) for message in MESSAGES[start:start + 100]]
+        journal.checkpoint(sequences[49])
+    assert read_journal(journal.path)[1] == MESSAGES[-50:]
+    
+    # Nothing released: the file has to grow
+    for message in MESSAGES:
+        journal.append(message)
+    assert os.path.getsize(journal.path) > 8192
+    assert read_journal(journal.path)[1] == MESSAGES[-50:] + MESSAGES
+    journal.close()
+
+
+def test_recovery_stops_at_torn_entry(tmp_path):
+    journal = Journal(str(tmp_path / "mqtt_record_1.json.journal"), {"recording": "mqtt_record_1.json"})
+    for message in MESSAGES[:5]:
+        journal.append(message)
+    
+    # Damage the body of the last entry, as if the process died mid-copy
+    journal.map[journal.tail - 1] ^= 0xFF
+    assert read_journal(journal.path)[1] == MESSAGES[:4]
+    journal.close()
@@ -0,0 +1,153 @@
+"""
+Tests for the live metrics registry and exporter.
+
+Messages are counted per topic prefix and rendered in the OpenMetrics text
+format, the exporter writes its file a last time on close, latency
+percentiles stay within the HDR histogram's relative error, and the
+recorder's signal handlers never wait for the registry or histogram locks
+the interrupted network thread may hold.
+"""
+
+import math
+import os
+import random
+import signal
+import sys
+import threading
+
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import HdrHistogram, Metrics, MetricsExporter
+from recording import RecordingFile
+from subscriber import MQTTSubscriber
+
+
+@pytest.fixture
+def subscriber(tmp_path, monkeypatch):
+    """Return a recorder with metrics enabled, without connecting it."""
+    config = {
+        "mqtt": {"broker": "127.0.0.1", "port": 1883, "username": "", "password": "", "topics": ["#"]},
+        "storage": {"file_path": str(tmp_path / "mqtt_record.json"), "format": "json", "catalog": False},
+        "metrics": {"enabled": True, "port": 0},
+    }
+    config_file = tmp_path / "config.yml"
+    config_file.write_text(yaml.safe_dump(config))
+    monkeypatch.chdir(tmp_path)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1)}
+    recorder = MQTTSubscriber(str(config_file))
+    yield recorder
+    recorder.recording.close()
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def run_with_lock_held(lock, target, *args):
+    """Call target in another thread while this one holds lock; True if it finished."""
+    with lock:
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        thread.join(1)
+    return not thread.is_alive()
+
+
+def test_counts_messages_per_topic_prefix():
+    metrics = Metrics("test", topic_depth=2)
+    metrics.count_message("plant/a/temperature", 4)
+    metrics.count_message("plant/a/pressure", 6)
+    metrics.count_message("plant/b", 1)
+    metrics.count_message("alerts", 0)
+    assert metrics.messages == {"plant/a": 2, "plant/b": 1, "alerts": 1}
+    assert metrics.bytes == {"plant/a": 10, "plant/b": 1, "alerts": 0}
+
+
+def test_render_openmetrics_text():
+    metrics = Metrics("test")
+    metrics.count_message('quoted"topic/x', 3)
+    metrics.gauge("buffer_messages", "Messages buffered.", lambda: 7)
+    text = metrics.render()
+    assert 'test_messages_total{prefix="quoted\\"topic"} 1' in text
+    assert 'test_bytes_total{prefix="quoted\\"topic"} 3' in text
+    assert "test_buffer_messages 7" in text
+    assert text.endswith("# EOF\n")
+
+
+def test_update_rates():
+    metrics = Metrics("test")
+    metrics._previous_time -= 2
+    for _ in range(10):
+        metrics.count_message("a", 100)
+    metrics.update_rates()
+    messages_rate, bytes_rate = metrics.rates["a"]
+    assert 4 < messages_rate <= 5
+    assert 400 < bytes_rate <= 500
+
+
+def test_exporter_writes_file_on_close(tmp_path):
+    metrics = Metrics("test")
+    path = tmp_path / "metrics.txt"
+    exporter = MetricsExporter(metrics, file_path=str(path), interval_s=60)
+    exporter.start()
+    metrics.count_message("a", 1)
+    exporter.close()
+    assert 'test_messages_total{prefix="a"} 1' in path.read_text()
+    assert not os.path.exists(str(path) + ".tmp")
+
+
+def test_exporter_for_shard():
+    exporter = MetricsExporter(Metrics("test"), port=9100, file_path="/tmp/metrics.prom")
+    exporter.for_shard(2)
+    assert exporter.port == 9102
+    assert exporter.file_path == "/tmp/metrics-shard2.prom"
+
+
+def test_signal_handler_does_not_wait_for_metrics_lock(subscriber):
+    assert run_with_lock_held(subscriber.metrics.lock, subscriber._signal_handler, signal.SIGTERM, None)
+    assert subscriber._shutdown_requested
+    assert not subscriber._stopping.is_set()
+
+
+def test_hdr_histogram_small_values_are_exact():
+    histogram = HdrHistogram()
+    histogram.record_many(range(1, 101))
+    assert histogram.total == 100
+    assert histogram.percentile(0.5) == 50
+    assert histogram.percentile(0.99) == 99
+    assert histogram.percentile(1.0) == 100
+    assert (histogram.min, histogram.max, histogram.sum) == (1, 100, 5050)
+
+
+@pytest.mark.parametrize("quantile", [0.5, 0.9, 0.99, 0.999])
+def test_hdr_histogram_relative_error(quantile):
+    values = [int(random.Random(quantile).lognormvariate(15, 3)) for _ in range(20000)]
+    histogram = HdrHistogram()
+    histogram.record_many(values)
+    expected = sorted(values)[max(1, math.ceil(quantile * len(values))) - 1]
+    assert abs(histogram.percentile(quantile) - expected) <= expected / 128
+    assert histogram.percentile(1.0) == max(values)
+
+
+def test_hdr_histogram_empty_and_negative():
+    histogram = HdrHistogram()
+    assert histogram.percentile(0.99) == 0
+    histogram.record(-5)
+    assert histogram.percentile(0.5) == 0
+
+
+def test_recording_reports_persisted_timestamps(tmp_path):
+    persisted = []
+    recording = RecordingFile(str(tmp_path / "mqtt_record.json"), on_persist=persisted.extend)
+    recording.write([
+        {"topic": "a", "payload": b"1", "timestamp_ns": 1},
+        {"topic": "b", "payload": b"2", "timestamp_ns": 2},
+    ])
+    recording.close()
+    assert persisted == [1, 2]
+
+
+def test_signal_handler_does_not_wait_for_latency_histogram_lock(subscriber):
+    assert subscriber.persist_latency is not None
+    assert run_with_lock_held(subscriber.persist_latency.lock, subscriber._signal_handler, signal.SIGINT, None)
+    assert subscriber._shutdown_requested
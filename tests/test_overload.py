@@ -0,0 +1,153 @@
+"""
+Tests for the bounded recording queue and its overload policies.
+
+Every message that does not fit is either waited for, dropped and counted
+per topic, or admitted in place of the oldest ones; dropped messages are
+always replaced in the stream by gap markers carrying the same counts.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import BinaryCodec, RecordingFile, is_gap_record, read_messages
+from subscriber import RecordQueue, record_size
+
+
+def message(number, topic="sensors/a"):
+    """Build a message whose timestamp is its number."""
+    return {"topic": topic, "payload": b"%d" % number, "timestamp_ns": number,
+            "qos": 0, "retain": False, "dup": False}
+
+
+def drain(record_queue):
+    """Close the queue and return everything left in it."""
+    record_queue.close()
+    records = []
+    while True:
+        record = record_queue.get()
+        if record is None:
+            return records
+        records.append(record)
+
+
+def assert_drops_accounted(record_queue, records, received):
+    """Check that kept and dropped messages add up and markers match the counters."""
+    messages = [record for record in records if not is_gap_record(record)]
+    markers = [record for record in records if is_gap_record(record)]
+    assert len(messages) + record_queue.dropped_count == received
+    dropped = {}
+    for marker in markers:
+        for topic, count in marker["dropped"].items():
+            dropped[topic] = dropped.get(topic, 0) + count
+    assert dropped == record_queue.dropped
+    assert sum(dropped.values()) == record_queue.dropped_count
+    timestamps = [record["timestamp_ns"] for record in messages]
+    assert timestamps == sorted(timestamps)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        RecordQueue(policy="drop_all")
+
+
+def test_from_config():
+    record_queue = RecordQueue.from_config({
+        "queue_size": 50, "overload": {"max_bytes": 4096, "policy": "sample", "sample_every": 5}
+    })
+    assert (record_queue.max_messages, record_queue.max_bytes) == (50, 4096)
+    assert (record_queue.policy, record_queue.sample_every) == ("sample", 5)
+
+
+def test_drop_newest():
+    record_queue = RecordQueue(max_messages=3, policy="drop_newest")
+    for number in range(6):
+        record_queue.put(message(number, "a" if number % 2 else "b"))
+    records = drain(record_queue)
+    assert records[:3] == [message(0, "b"), message(1, "a"), message(2, "b")]
+    assert records[3] == {"timestamp_ns": 3, "dropped": {"a": 2, "b": 1}}
+    assert record_queue.dropped == {"a": 2, "b": 1}
+    assert_drops_accounted(record_queue, records, 6)
+
+
+def test_drop_oldest():
+    record_queue = RecordQueue(max_messages=3, policy="drop_oldest")
+    for number in range(5):
+        record_queue.put(message(number, "a" if number % 2 else "b"))
+    records = drain(record_queue)
+    assert records[0] == {"timestamp_ns": 0, "dropped": {"b": 1, "a": 1}}
+    assert records[1:] == [message(2, "b"), message(3, "a"), message(4, "b")]
+    assert_drops_accounted(record_queue, records, 5)
+
+
+def test_drop_oldest_merges_gap_markers():
+    record_queue = RecordQueue(max_messages=2, policy="drop_oldest")
+    for number in range(20):
+        record_queue.put(message(number))
+    records = drain(record_queue)
+    assert records == [{"timestamp_ns": 0, "dropped": {"sensors/a": 18}}, message(18), message(19)]
+
+
+def test_sample_admits_one_in_every_sample_every():
+    record_queue = RecordQueue(max_messages=2, policy="sample", sample_every=3)
+    for number in range(8):
+        record_queue.put(message(number))
+    records = drain(record_queue)
+    # m2..m7 arrive while full: m4 and m7 are admitted at the expense of m0 and m1
+    assert [record["timestamp_ns"] for record in records if not is_gap_record(record)] == [4, 7]
+    assert record_queue.dropped_count == 6
+    assert_drops_accounted(record_queue, records, 8)
+
+
+@pytest.mark.parametrize("policy", ["drop_oldest", "drop_newest", "sample"])
+def test_byte_budget(policy):
+    size = record_size(message(100))
+    record_queue = RecordQueue(max_bytes=3 * size, policy=policy)
+    for number in range(100, 200):
+        record_queue.put(message(number))
+        assert record_queue.byte_count <= 3 * size
+    assert_drops_accounted(record_queue, drain(record_queue), 100)
+
+
+def test_oversized_message_admitted_into_empty_queue():
+    record_queue = RecordQueue(max_bytes=10, policy="drop_newest")
+    record_queue.put(dict(message(0), payload=b"x" * 100))
+    assert record_queue.message_count == 1
+    assert record_queue.dropped_count == 0
+
+
+def test_block_waits_for_the_writer():
+    record_queue = RecordQueue(max_messages=1, policy="block")
+    record_queue.put(message(0))
+    producer = threading.Thread(target=record_queue.put, args=(message(1),))
+    producer.start()
+    time.sleep(0.05)
+    assert producer.is_alive()
+    assert record_queue.get() == message(0)
+    producer.join(1)
+    assert not producer.is_alive()
+    assert record_queue.get() == message(1)
+    assert record_queue.dropped_count == 0
+    assert record_queue.max_block_time >= 0.04
+
+
+def test_get_timeout():
+    with pytest.raises(queue.Empty):
+        RecordQueue().get(timeout=0.01)
+
+
+def test_gap_markers_are_recorded(tmp_path):
+    record_queue = RecordQueue(max_messages=2, policy="drop_newest")
+    for number in range(5):
+        record_queue.put(message(number))
+    records = drain(record_queue)
+    recording = RecordingFile(str(tmp_path / "mqtt_record_1.mqr"), codec=BinaryCodec(0))
+    recording.write(records)
+    recording.close()
+    assert list(read_messages(recording.path)) == records
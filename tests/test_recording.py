@@ -0,0 +1,452 @@
+"""
+Round trip tests for the recording formats.
+
+Whatever the format and compression, a recording must give back exactly
+the messages that were written to it, the reader must detect the format
+from the file contents alone, and reading from any block of the block
+index must give the messages from that block on. Segmented sessions read
+back in order through their manifest, and deduplicated payloads through
+the payload store. Numeric encoding must give back decimal payloads byte
+for byte. The time index, written online or built afterwards, must lead
+replay to the block holding a start time.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import (
+    MANIFEST_EXTENSION,
+    BinaryCodec,
+    GzipCompressor,
+    JsonLinesCodec,
+    PayloadStore,
+    RecordingFile,
+    SegmentedRecording,
+    build_block_index,
+    convert_recording,
+    format_decimal,
+    gap_record,
+    make_codec,
+    make_compressor,
+    parse_decimal,
+    payload_store_path,
+    read_block_index,
+    read_manifest,
+    read_messages,
+    remove_recording,
+)
+from publisher import MQTTPublisher
+
+
+START_NS = 1699123456_000_000_000
+
+
+def message(topic, payload, timestamp_ns, **fields):
+    """Build a message as the recorder receives it."""
+    return dict({"topic": topic, "payload": payload, "timestamp_ns": timestamp_ns,
+                 "qos": 0, "retain": False, "dup": False}, **fields)
+
+
+MESSAGES = [
+    message("sensors/temperature", b"23.5", START_NS),
+    message("häuser/küche/temperatur", "21 °C".encode('utf-8'), START_NS + 1, qos=2, retain=True, dup=True),
+    message("sensors/temperature", b"23.6", START_NS + 1_000_000_000, qos=1),
+    message("alerts", b"", START_NS + 1_000_000_001, source="plant-a"),
+    message("rpc/request", b"ping", START_NS + 1_000_000_002, qos=1, properties={
+        "ContentType": "text/plain", "CorrelationData": b"\x00\x01\xff",
+        "MessageExpiryInterval": 60, "UserProperty": [("k", "v"), ("k", "w")],
+    }),
+    dict(gap_record(START_NS + 1_000_000_003), dropped={"sensors/temperature": 12, "alerts": 1}),
+    message("sensors/temperature", b"-0.25", START_NS + 2_000_000_000, source="plant-b"),
+]
+
+BINARY_MESSAGES = MESSAGES + [
+    message("raw/bytes", bytes(range(256)), START_NS + 2_000_000_001),
+    message("raw/invalid-utf8", b"\xff\xfe\x00", START_NS + 2_000_000_002),
+]
+
+CODECS = {
+    "json-text": lambda: JsonLinesCodec("text"),
+    "json-base64": lambda: JsonLinesCodec("base64"),
+    "binary": lambda: BinaryCodec(START_NS),
+}
+
+
+def write(path, messages, batch_size=None, **options):
+    """Write messages to a new recording, in batches of batch_size, and return its path."""
+    recording = RecordingFile(str(path), **options)
+    batch_size = batch_size or len(messages)
+    for start in range(0, len(messages), batch_size):
+        recording.write(messages[start:start + batch_size])
+    recording.close()
+    return str(path)
+
+
+def sensor_messages(count):
+    """Return count messages spread over a few topics, one millisecond apart."""
+    return [message(f"devices/{i % 7}/state", b"value %d" % i, START_NS + i * 1_000_000) for i in range(count)]
+
+
+def assert_seeks_from_every_block(path, messages):
+    """Check that reading from each block of the index gives the messages from there on."""
+    blocks = read_block_index(path)
+    assert sum(block["messages"] for block in blocks) == len(messages)
+    skipped = 0
+    for number, block in enumerate(blocks):
+        assert block["first_timestamp"] == messages[skipped]["timestamp_ns"] / 1e9
+        assert list(read_messages(path, number)) == messages[skipped:]
+        skipped += block["messages"]
+    return blocks
+
+
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_round_trip(tmp_path, codec):
+    path = write(tmp_path / "mqtt_record_1", MESSAGES, codec=CODECS[codec]())
+    assert list(read_messages(path)) == MESSAGES
+
+
+def test_text_payloads_read_as_str(tmp_path):
+    path = write(tmp_path / "mqtt_record_1.json", MESSAGES, codec=CODECS["json-text"]())
+    expected = [
+        dict(record, payload=record["payload"].decode('utf-8')) if "payload" in record else record
+        for record in MESSAGES
+    ]
+    assert list(read_messages(path)) == expected
+
+
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_round_trip_arbitrary_payloads(tmp_path, codec):
+    path = write(tmp_path / "mqtt_record_1", BINARY_MESSAGES, codec=CODECS[codec]())
+    assert list(read_messages(path)) == BINARY_MESSAGES
+
+
+def test_round_trip_over_many_batches(tmp_path):
+    messages = [message(f"devices/{i % 50}/state", b"%d" % i, START_NS + i) for i in range(5000)]
+    recording = RecordingFile(str(tmp_path / "mqtt_record_1.mqr"), codec=BinaryCodec(START_NS))
+    for start in range(0, len(messages), 123):
+        recording.write(messages[start:start + 123])
+    recording.close()
+    assert list(read_messages(recording.path)) == messages
+    assert recording.stats()["topics"] == 50
+
+
+def test_binary_timestamps_before_anchor(tmp_path):
+    messages = [message("a", b"1", START_NS - 5_000_000_000), message("a", b"2", START_NS)]
+    path = write(tmp_path / "mqtt_record_1.mqr", messages, codec=BinaryCodec(START_NS))
+    assert list(read_messages(path)) == messages
+
+
+def test_format_detected_from_contents(tmp_path):
+    # A binary recording under a .json name still reads as binary
+    path = write(tmp_path / "mqtt_record_1.json", MESSAGES, codec=BinaryCodec(START_NS))
+    with open(path, "rb") as file:
+        assert not file.read(1).startswith(b"{")
+    assert list(read_messages(path)) == MESSAGES
+
+
+def test_make_codec():
+    assert isinstance(make_codec({}), JsonLinesCodec)
+    assert make_codec({"format": "binary"}, START_NS).wall_anchor_ns == START_NS
+    with pytest.raises(ValueError):
+        make_codec({"format": "xml"})
+
+
+@pytest.mark.parametrize("source, destination", [("json-base64", "binary"), ("binary", "json-base64")])
+def test_convert(tmp_path, source, destination):
+    source_path = write(tmp_path / "source", BINARY_MESSAGES, codec=CODECS[source]())
+    count = convert_recording(source_path, str(tmp_path / "destination"), CODECS[destination]())
+    assert count == len(BINARY_MESSAGES)
+    assert list(read_messages(str(tmp_path / "destination"))) == BINARY_MESSAGES
+
+
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_truncated_last_record_is_skipped(tmp_path, codec):
+    path = write(tmp_path / "mqtt_record_1", MESSAGES, codec=CODECS[codec](), time_index=False)
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 3)
+    assert list(read_messages(path)) == MESSAGES[:-1]
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_compressed_round_trip(tmp_path, codec, compression):
+    path = write(tmp_path / "mqtt_record_1", BINARY_MESSAGES, codec=CODECS[codec](),
+                 compressor=make_compressor({"compression": compression}))
+    assert list(read_messages(path)) == BINARY_MESSAGES
+
+
+def test_gzip_blocks_are_gzip_members(tmp_path):
+    messages = sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1.json.gz", messages, batch_size=50,
+                 codec=JsonLinesCodec("base64"), compressor=GzipCompressor(), block_size=4096)
+    with gzip.open(path, "rb") as file:
+        assert len(file.read().splitlines()) == len(messages)
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_compressed_seek_from_every_block(tmp_path, codec, compression):
+    messages = sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1", messages, batch_size=50, codec=CODECS[codec](),
+                 compressor=make_compressor({"compression": compression}), block_size=4096)
+    assert len(assert_seeks_from_every_block(path, messages)) > 3
+
+
+def test_seek_past_last_block(tmp_path):
+    path = write(tmp_path / "mqtt_record_1.mqr.gz", MESSAGES, codec=BinaryCodec(START_NS),
+                 compressor=GzipCompressor())
+    with pytest.raises(ValueError):
+        list(read_messages(path, len(read_block_index(path))))
+
+
+def test_make_compressor():
+    assert make_compressor({}) is None
+    assert make_compressor({"compression": "gzip", "compression_level": 1}).level == 1
+    with pytest.raises(ValueError):
+        make_compressor({"compression": "lz4"})
+
+
+def test_segments_roll_over_on_size(tmp_path):
+    messages = sensor_messages(3000)
+    manifest_path = str(tmp_path / f"mqtt_record_1{MANIFEST_EXTENSION}")
+    recording = SegmentedRecording(
+        manifest_path, ".mqr", lambda path: RecordingFile(path, codec=BinaryCodec(START_NS)), max_bytes=8192
+    )
+    for start in range(0, len(messages), 100):
+        recording.write(messages[start:start + 100])
+    stats = recording.stats()
+    recording.close()
+    
+    segments = read_manifest(manifest_path)
+    assert len(segments) > 3
+    assert all(os.path.exists(segment["path"]) for segment in segments)
+    assert sum(segment["messages"] for segment in segments) == len(messages)
+    assert segments[0]["first_timestamp"] == messages[0]["timestamp_ns"] / 1e9
+    assert segments[-1]["last_timestamp"] == messages[-1]["timestamp_ns"] / 1e9
+    assert stats["messages"] == len(messages)
+    assert stats["topics"] == 7
+    assert list(read_messages(manifest_path)) == messages
+    
+    remove_recording(manifest_path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_manifest_lists_segments_relative_to_it(tmp_path):
+    manifest_path = str(tmp_path / f"mqtt_record_1{MANIFEST_EXTENSION}")
+    recording = SegmentedRecording(manifest_path, ".json", lambda path: RecordingFile(path), max_bytes=1)
+    recording.write(MESSAGES[:1])
+    recording.write(MESSAGES[1:2])
+    recording.close()
+    with open(manifest_path, encoding='utf-8') as file:
+        names = [segment["path"] for segment in json.load(file)["segments"]]
+    assert names == ["mqtt_record_1-0001.json", "mqtt_record_1-0002.json"]
+
+
+def repeated_payload_messages(count):
+    """Return messages cycling through a few large payloads, plus small and unique ones."""
+    payloads = [bytes([i]) * 200 for i in range(5)]
+    return [
+        message("devices/state", payloads[i % 5] if i % 3 else b"unique %d" % i + bytes(100), START_NS + i,
+                qos=i % 2)
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_dedup_round_trip(tmp_path, compression):
+    messages = repeated_payload_messages(1000) + BINARY_MESSAGES
+    plain = write(tmp_path / "plain.mqr", messages, codec=BinaryCodec(START_NS),
+                  compressor=make_compressor({"compression": compression}))
+    path = write(tmp_path / "dedup.mqr", messages, batch_size=64, codec=BinaryCodec(START_NS),
+                 compressor=make_compressor({"compression": compression}), dedup={"enabled": True})
+    assert list(read_messages(path)) == messages
+    
+    # Each repeated payload is stored once
+    assert os.path.getsize(payload_store_path(path)) == 5 * 200
+    if compression == "none":
+        assert os.path.getsize(path) < os.path.getsize(plain) / 2
+
+
+def test_dedup_seek_from_every_block(tmp_path):
+    messages = repeated_payload_messages(3000)
+    path = write(tmp_path / "mqtt_record_1.mqr", messages, batch_size=50, codec=BinaryCodec(START_NS),
+                 block_size=4096, dedup={"enabled": True})
+    assert len(assert_seeks_from_every_block(path, messages)) > 3
+
+
+def test_dedup_needs_binary_format(tmp_path):
+    path = write(tmp_path / "mqtt_record_1.json", repeated_payload_messages(100), dedup={"enabled": True})
+    assert not os.path.exists(payload_store_path(path))
+
+
+def test_payload_store_references(tmp_path):
+    store = PayloadStore(str(tmp_path / "store"), min_size=4, max_entries=2)
+    assert store.reference(b"abc") is None  # Too small
+    assert store.reference(b"first") is None  # Seen once, stays inline
+    assert store.reference(b"first") == 0
+    assert store.reference(b"first") == 0
+    assert store.reference(b"second") is None
+    assert store.reference(b"third") is None  # Evicts the oldest digest, "first"
+    assert store.reference(b"first") is None
+    store.close()
+    assert store.stored_bytes == 5
+    assert store.referenced_bytes == 10
+
+
+def test_convert_with_dedup(tmp_path):
+    messages = repeated_payload_messages(500)
+    source = write(tmp_path / "source.json", messages, codec=JsonLinesCodec("base64"))
+    destination = str(tmp_path / "destination.mqr")
+    assert convert_recording(source, destination, BinaryCodec(START_NS), dedup={"enabled": True}) == 500
+    assert os.path.exists(payload_store_path(destination))
+    assert list(read_messages(destination)) == messages
+
+
+def numeric_messages(count, seed=0):
+    """Return interleaved sensor readings with drifting values, scales and intervals."""
+    rng = random.Random(seed)
+    values = {"plant/temperature": 21.5, "plant/pressure": 1013.25, "plant/counter": 0}
+    messages = []
+    timestamp_ns = START_NS
+    for i in range(count):
+        topic = rng.choice(sorted(values))
+        timestamp_ns += rng.choice((1_000_000, 1_000_000, 999_999, 5_000_000_000))
+        if topic == "plant/counter":
+            values[topic] += rng.randint(0, 3)
+            payload = b"%d" % values[topic]
+        else:
+            values[topic] += rng.uniform(-0.5, 0.5)
+            payload = b"%.*f" % (rng.choice((1, 2, 2, 2, 3)), values[topic])
+        messages.append(message(topic, payload, timestamp_ns, source=rng.choice((None, "plant-a"))))
+    for record in messages:
+        if record["source"] is None:
+            del record["source"]
+    return messages
+
+
+@pytest.mark.parametrize("payload", [
+    b"0", b"7", b"-7", b"21.5", b"1.50", b"-0.5", b"0.0", b"-12.000",
+    b"999999999999999999", b"-99999999999999999.999999999999999",
+])
+def test_decimal_round_trip(payload):
+    assert format_decimal(*parse_decimal(payload)) == payload
+
+
+@pytest.mark.parametrize("payload", [
+    b"", b"-0", b"-0.0", b"01", b".5", b"5.", b"+1", b"1e3", b" 1", b"1.2.3", b"nan",
+    b"1234567890123456789", b"1.1234567890123456",
+])
+def test_non_decimal_payloads_rejected(payload):
+    assert parse_decimal(payload) is None
+
+
+def test_numeric_round_trip_mixed_payloads(tmp_path):
+    messages = numeric_messages(2000) + BINARY_MESSAGES + [
+        message("plant/temperature", b"not a number", START_NS + 10_000_000_000_000),
+        message("plant/temperature", b"-0", START_NS + 10_000_000_000_001),
+        message("plant/temperature", b"18446744073709551615", START_NS + 10_000_000_000_002),
+        message("plant/temperature", b"22.25", START_NS + 10_000_000_000_000),
+    ]
+    path = write(tmp_path / "mqtt_record_1.mqr", messages, batch_size=77,
+                 codec=BinaryCodec(START_NS, numeric=True))
+    assert list(read_messages(path)) == messages
+
+
+def test_numeric_is_smaller(tmp_path):
+    messages = [dict(record, qos=0) for record in numeric_messages(5000)]
+    plain = write(tmp_path / "plain.mqr", messages, codec=BinaryCodec(START_NS))
+    numeric = write(tmp_path / "numeric.mqr", messages, codec=BinaryCodec(START_NS, numeric=True))
+    assert os.path.getsize(numeric) < 0.8 * os.path.getsize(plain)
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+def test_numeric_seek_from_every_block(tmp_path, compression):
+    messages = numeric_messages(3000)
+    path = write(tmp_path / "mqtt_record_1.mqr", messages, batch_size=50,
+                 codec=BinaryCodec(START_NS, numeric=True),
+                 compressor=make_compressor({"compression": compression}), block_size=2048)
+    assert len(assert_seeks_from_every_block(path, messages)) > 3
+
+
+@pytest.mark.parametrize("recording_format, compression, numeric, dedup", list(itertools.product(
+    ["json", "binary"], ["none", "gzip"], [False, True], [False, True]
+)))
+def test_storage_options_round_trip(tmp_path, recording_format, compression, numeric, dedup):
+    storage_config = {
+        "format": recording_format, "payload_encoding": "base64", "compression": compression,
+        "numeric_encoding": numeric, "dedup": {"enabled": dedup},
+    }
+    messages = numeric_messages(500) + repeated_payload_messages(200) + BINARY_MESSAGES
+    messages.sort(key=lambda record: record["timestamp_ns"])
+    path = write(tmp_path / "mqtt_record_1", messages, batch_size=100, codec=make_codec(storage_config, START_NS),
+                 compressor=make_compressor(storage_config), block_size=4096, dedup=storage_config["dedup"])
+    assert list(read_messages(path)) == messages
+
+
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_time_index_written_online(tmp_path, codec):
+    messages = sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1", messages, batch_size=50, codec=CODECS[codec](), block_size=4096)
+    assert len(assert_seeks_from_every_block(path, messages)) > 3
+
+
+@pytest.mark.parametrize("codec", ["json-base64", "binary"])
+def test_time_index_continues_on_append(tmp_path, codec):
+    messages = sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1", messages[:1000], batch_size=50, codec=CODECS[codec](), block_size=4096)
+    write(path, messages[1000:], batch_size=50, codec=CODECS[codec](), block_size=4096)
+    assert_seeks_from_every_block(path, messages)
+
+
+def test_append_to_unindexed_recording_writes_no_index(tmp_path):
+    messages = sensor_messages(1000)
+    path = write(tmp_path / "mqtt_record_1.json", messages[:500], codec=JsonLinesCodec("base64"), time_index=False)
+    write(path, messages[500:], codec=JsonLinesCodec("base64"), block_size=4096)
+    assert read_block_index(path) == []
+    assert list(read_messages(path)) == messages
+
+
+@pytest.mark.parametrize("codec, dedup", [("json-base64", None), ("binary", None), ("binary", {"enabled": True})],
+                         ids=["json", "binary", "binary-dedup"])
+def test_time_index_built_offline(tmp_path, codec, dedup):
+    messages = repeated_payload_messages(2000) if dedup else sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1", messages, batch_size=50, codec=CODECS[codec](), dedup=dedup,
+                 time_index=False)
+    assert read_block_index(path) == []
+    assert build_block_index(path, 4096) > 3
+    assert_seeks_from_every_block(path, messages)
+
+
+def test_time_index_not_built_for_numeric_payloads(tmp_path):
+    path = write(tmp_path / "mqtt_record_1.mqr", numeric_messages(500), codec=make_codec({
+        "format": "binary", "numeric_encoding": True
+    }, START_NS), time_index=False)
+    with pytest.raises(ValueError):
+        build_block_index(path, 4096)
+
+
+def test_compressed_recording_keeps_its_index(tmp_path):
+    messages = sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1.mqr.gz", messages, batch_size=50, codec=BinaryCodec(START_NS),
+                 compressor=GzipCompressor(), block_size=4096)
+    blocks = read_block_index(path)
+    assert build_block_index(path, 1024) == len(blocks)
+    assert read_block_index(path) == blocks
+
+
+def test_locate_time_finds_block_containing_start(tmp_path):
+    messages = sensor_messages(2000)
+    path = write(tmp_path / "mqtt_record_1.mqr", messages, batch_size=50, codec=BinaryCodec(START_NS), block_size=4096)
+    for skipped in range(0, len(messages), 97):
+        start_time = messages[skipped]["timestamp_ns"] / 1e9
+        replayed = list(read_messages(path, MQTTPublisher._locate_time(None, path, start_time)))
+        assert replayed[-(len(messages) - skipped):] == messages[skipped:]
+        assert len(replayed) - (len(messages) - skipped) < 4096
@@ -0,0 +1,95 @@
+"""
+Parity tests for the JSON serialization backends.
+
+Every installed backend must serialize to bytes, round trip the records
+the recorder writes exactly like the standard library, read and write
+files compatible with it, and reject truncated or invalid input with
+ValueError.
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import encode_json_record, gap_record
+from serialization import BACKENDS
+
+
+START_NS = 1699123456_000_000_000
+
+MESSAGES = [
+    # Text payload as recorded by default
+    {"topic": "sensors/temperature", "payload": b"23.5", "timestamp_ns": START_NS,
+     "qos": 0, "retain": False, "dup": False},
+    # Non-ASCII topic and payload, QoS 2 and retained
+    {"topic": "häuser/küche/temperatur", "payload": "21 °C".encode('utf-8'),
+     "timestamp_ns": START_NS + 1, "qos": 2, "retain": True, "dup": True},
+    # JSON payload with characters that need escaping
+    {"topic": "devices/d1/state", "payload": b'{"msg": "line\\nbreak \\"quoted\\""}',
+     "timestamp_ns": START_NS + 999_999_999, "qos": 1, "retain": False, "dup": False},
+    # Recorded from one of several brokers
+    {"topic": "alerts", "payload": b"", "timestamp_ns": START_NS + 2,
+     "qos": 0, "retain": False, "dup": False, "source": "plant-a"},
+    # MQTT v5 properties with bytes and user property pairs
+    {"topic": "rpc/request", "payload": b"ping", "timestamp_ns": START_NS + 3,
+     "qos": 1, "retain": False, "dup": False,
+     "properties": {"ContentType": "text/plain", "CorrelationData": b"\x00\x01\xff",
+                    "MessageExpiryInterval": 60, "UserProperty": [("k", "v"), ("k", "w")]}},
+]
+
+RECORDS = (
+    [encode_json_record(message) for message in MESSAGES]
+    + [encode_json_record(message, "base64") for message in MESSAGES]
+    + [encode_json_record(dict(MESSAGES[0], payload=bytes(range(256))), "base64")]
+    + [dict(gap_record(START_NS + 4), dropped={"sensors/temperature": 12, "alerts": 1})]
+)
+
+
+@pytest.fixture(params=sorted(BACKENDS))
+def backend(request):
+    """Return the (dumps, loads) pair of each installed backend."""
+    return BACKENDS[request.param]
+
+
+def test_dumps_returns_bytes(backend):
+    dumps, _ = backend
+    for record in RECORDS:
+        assert isinstance(dumps(record), bytes)
+
+
+@pytest.mark.parametrize("record", RECORDS)
+def test_round_trip_matches_stdlib(backend, record):
+    dumps, loads = backend
+    expected = json.loads(json.dumps(record))
+    assert loads(dumps(record)) == expected
+
+
+@pytest.mark.parametrize("record", RECORDS)
+def test_reads_and_writes_stdlib_compatible_lines(backend, record):
+    dumps, loads = backend
+    expected = json.loads(json.dumps(record))
+    assert json.loads(dumps(record)) == expected
+    assert loads(json.dumps(record).encode('utf-8')) == expected
+
+
+def test_loads_accepts_str(backend):
+    _, loads = backend
+    assert loads('{"topic": "a/b"}') == {"topic": "a/b"}
+
+
+@pytest.mark.parametrize("data", [
+    b'{"topic": "a/b", "payload": ',
+    b'{"topic": "a/b"',
+    b'{"topic": "a/b", "payload": "unterminated',
+    b'not json',
+    b'{"topic": a/b}',
+    b'',
+])
+def test_invalid_input_raises_value_error(backend, data):
+    _, loads = backend
+    with pytest.raises(ValueError):
+        loads(data)
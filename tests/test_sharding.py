@@ -0,0 +1,136 @@
+"""
+Tests for the sharded recorder.
+
+Topic filters are split over shards without overlap, shared subscription
+groups put the same filters on every shard, and the shard recordings are
+merged back into one timestamp-ordered recording.
+"""
+
+import logging
+import os
+import signal
+import sys
+
+import pytest
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import (
+    BinaryCodec,
+    GzipCompressor,
+    JsonLinesCodec,
+    RecordingFile,
+    merge_messages,
+    merge_recordings,
+    read_messages,
+)
+from subscriber import MQTTSubscriber, filters_overlap
+
+
+START_NS = 1699123456_000_000_000
+
+
+@pytest.fixture
+def subscriber(tmp_path, monkeypatch):
+    """Return a recorder without connecting it; tests set its mqtt config."""
+    config = {
+        "mqtt": {"broker": "127.0.0.1", "port": 1883, "username": "", "password": ""},
+        "storage": {"file_path": str(tmp_path / "mqtt_record.json"), "format": "json", "catalog": False},
+    }
+    config_file = tmp_path / "config.yml"
+    config_file.write_text(yaml.safe_dump(config))
+    monkeypatch.chdir(tmp_path)
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+    recorder = MQTTSubscriber(str(config_file))
+    yield recorder
+    recorder.recording.close()
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def write(path, timestamps, **options):
+    """Write one message per timestamp, the topic naming the file, and return its path."""
+    name = os.path.basename(str(path))
+    recording = RecordingFile(str(path), **options)
+    recording.write([
+        {"topic": name, "payload": b"%d" % timestamp_ns, "timestamp_ns": timestamp_ns,
+         "qos": 0, "retain": False, "dup": False}
+        for timestamp_ns in timestamps
+    ])
+    recording.close()
+    return str(path)
+
+
+@pytest.mark.parametrize("first, second, expected", [
+    ("a/b", "a/b", True),
+    ("a/b", "a/c", False),
+    ("a/#", "a/b/c", True),
+    ("a", "a/#", True),
+    ("a/+", "a/b/c", False),
+    ("a/+/c", "a/b/+", True),
+    ("a/+", "+/b", True),
+    ("#", "$SYS/broker", False),
+    ("+/broker", "$SYS/broker", False),
+    ("$SYS/#", "$SYS/broker", True),
+])
+def test_filters_overlap(first, second, expected):
+    assert filters_overlap(first, second) is expected
+    assert filters_overlap(second, first) is expected
+
+
+def test_merge_messages_in_timestamp_order(tmp_path):
+    sources = [
+        write(tmp_path / "mqtt_record_1.json", [START_NS + 1, START_NS + 4, START_NS + 7]),
+        write(tmp_path / "mqtt_record_2.mqr", [START_NS, START_NS + 4, START_NS + 8], codec=BinaryCodec(START_NS)),
+        write(tmp_path / "mqtt_record_3.json.gz", [START_NS + 2, START_NS + 3, START_NS + 9],
+              codec=JsonLinesCodec("base64"), compressor=GzipCompressor()),
+    ]
+    merged = list(merge_messages(sources))
+    assert [message["timestamp_ns"] - START_NS for message in merged] == [0, 1, 2, 3, 4, 4, 7, 8, 9]
+    # Equal timestamps keep the order of the sources
+    assert [message["topic"] for message in merged[4:6]] == ["mqtt_record_1.json", "mqtt_record_2.mqr"]
+
+
+def test_merge_recordings(tmp_path):
+    sources = [
+        write(tmp_path / "shard0.mqr", range(START_NS, START_NS + 1000, 2), codec=BinaryCodec(START_NS)),
+        write(tmp_path / "shard1.mqr", range(START_NS + 1, START_NS + 1000, 2), codec=BinaryCodec(START_NS)),
+    ]
+    destination = str(tmp_path / "mqtt_record_1.mqr")
+    assert merge_recordings(sources, destination, BinaryCodec(START_NS)) == 1000
+    timestamps = [message["timestamp_ns"] for message in read_messages(destination)]
+    assert timestamps == list(range(START_NS, START_NS + 1000))
+
+
+def test_shard_topics_round_robin(subscriber):
+    subscriber.mqtt_config["topics"] = ["a/#", "b/#", "c"]
+    assert subscriber._shard_topics(2) == [["a/#", "c"], ["b/#"]]
+
+
+def test_shard_count_capped_by_topics(subscriber, caplog):
+    subscriber.mqtt_config["topics"] = ["a/#", "b/#"]
+    with caplog.at_level(logging.WARNING):
+        assert subscriber._shard_topics(4) == [["a/#"], ["b/#"]]
+    assert "instead of 4" in caplog.text
+
+
+def test_shared_group_puts_all_topics_on_every_shard(subscriber):
+    subscriber.mqtt_config.update(topics=["a/#"], shared_group="recorders")
+    assert subscriber._shard_topics(3) == [["a/#"], ["a/#"], ["a/#"]]
+
+
+def test_explicit_shards(subscriber):
+    subscriber.mqtt_config["shards"] = [["a/#", "b"], "c/+"]
+    assert subscriber._shard_topics(None) == [["a/#", "b"], ["c/+"]]
+
+
+@pytest.mark.parametrize("mqtt_config", [
+    {"topics": ["a/#", "a/b"]},
+    {"shards": [["a/+"], ["+/b"]]},
+    {"shards": [["#"], ["a"]]},
+])
+def test_overlapping_shards_rejected(subscriber, mqtt_config):
+    subscriber.mqtt_config.update(mqtt_config)
+    with pytest.raises(ValueError):
+        subscriber._shard_topics(2)